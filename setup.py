@@ -1,4 +1,5 @@
 import os.path
+import re
 import sys
 
 from setuptools import setup, find_packages
@@ -15,10 +16,13 @@ else:
     # this branch should work only when running under the tox
     requirements = []
 
+# version is read without importing thebot, because it's dependencies could be not installed yet
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thebot', 'version.py')) as f:
+    version = re.search(r"^__version__ = '(.+)'$", f.read(), re.M).group(1)
 
 setup(
     name='thebot',
-    version='0.4.1',
+    version=version,
     description=(
     ),
     keywords='chat irc xmpp basecamp jira fun',
@@ -2,23 +2,40 @@
 from __future__ import absolute_import, unicode_literals
 
 import argparse
+import copy
 import importlib
+import json
 import logging
 import os
-import pickle
-import pkg_resources
 import re
-import server_reloader
-import shelve
 import six
+import sys
 import textwrap
-import threading
 import time
 import yaml
 
 from .utils import MutableMapping, force_str, printable
+from .utils.executor import KeyedExecutor
+from .utils.lru import LRUCache
+from .utils.ratelimit import RateLimiter
+from .utils.scheduler import COALESCE, SKIP, Cron, Interval, Scheduler
+from .utils.stats import Stats, StartupProfile
+from .process import ProcessPool, in_process
+from .storage import Stub, Pickler, Unpickler, Storage, StorageCache, WriteBehindBackend, get_backend
+from .version import __version__
 
-__version__ = pkg_resources.get_distribution(__name__).version
+__all__ = [
+    'Adapter', 'Bot', 'CommandRe', 'Config', 'EXIT', 'HelpPlugin', 'PatternRe', 'Plugin',
+    'Request', 'Room', 'Router', 'ThreadedPlugin', 'User', 'get_version', 'on_command', 'on_pattern',
+    # re-exported from other modules
+    'COALESCE', 'SKIP', 'Cron', 'Interval', 'MutableMapping', 'Pickler', 'Storage', 'StorageCache',
+    'Stub', 'Unpickler', 'force_str', 'in_process',
+]
+
+
+def get_version():
+    """Returns TheBot's version."""
+    return __version__
 
 
 # pass this object to callback, to terminate the bot
@@ -51,6 +68,10 @@ class Room(object):
 
 @printable
 class Request(object):
+    # if True, then Bot will wait until request will be processed,
+    # even if callbacks are executed in the thread pool
+    synchronous = False
+
     def __init__(self, adapter, message, user, room=None, refer_by_name=False):
         self.adapter = adapter
         self.message = message
@@ -65,7 +86,7 @@ class Request(object):
         return result
 
     def respond(self, message):
-        self.adapter.send(
+        return self.adapter.send(
             message,
             user=self.user,
             room=self.room,
@@ -74,7 +95,7 @@ class Request(object):
 
     def shout(self, message):
         """This method should be used to say something to the channel or a chatroom."""
-        self.adapter.send(
+        return self.adapter.send(
             message,
             room=self.room,
         )
@@ -100,7 +121,41 @@ class Adapter(object):
         return False
 
 
+class PluginMeta(type):
+    """Collects plugin's routes once, when plugin's class is created.
+
+    Routes are taken from the `_patterns` attribute, which is set by
+    `on_command` and `on_pattern` decorators. Methods are processed in
+    alphabetical order, like `dir` returns them, and class attributes are
+    inspected without calling any descriptors or properties.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(PluginMeta, cls).__init__(name, bases, attrs)
+
+        names = set()
+        for klass in cls.__mro__:
+            names.update(vars(klass))
+
+        routes = []
+        for attr in sorted(names):
+            # looking for the attribute the same way as getattr does
+            for klass in cls.__mro__:
+                if attr in vars(klass):
+                    value = vars(klass)[attr]
+                    break
+
+            if isinstance(value, (staticmethod, classmethod)):
+                value = value.__func__
+
+            patterns = getattr(value, '_patterns', None) if callable(value) else None
+            if isinstance(patterns, list) and patterns:
+                routes.append((attr, tuple(patterns)))
+
+        cls._routes = routes
+
+
 @printable
+@six.add_metaclass(PluginMeta)
 class Plugin(object):
     def __init__(self, bot):
         self.bot = bot
@@ -111,75 +166,81 @@ class Plugin(object):
         return self.name
 
     def get_callbacks(self):
-        for name in dir(self):
-            value = getattr(self, name)
-            if callable(value):
-                patterns = getattr(value, '_patterns', [])
-                for pattern in patterns:
-                    pattern.plugin_name = self.name
-                    yield (pattern, value)
+        for name, patterns in self._routes:
+            callback = getattr(self, name)
+            for pattern in patterns:
+                yield (pattern.for_plugin(self.name), callback)
 
 
 class ThreadedPlugin(Plugin):
-    """ThreadedPlugin allows you to do some processing in a background thread.
+    """ThreadedPlugin allows you to do some processing in background.
 
-    This class will take care on proper thread execution and termination.
+    This class will take care on proper job execution and termination.
 
     * First, implement method `do_job`, which will be executed with given interval.
-    * Then run method `self.start_worker(interval=60)` to run a thread.
-      It will call your do_job callback each 60 seconds.
+    * Then run method `self.start_worker(interval=60)` to start it.
+      It will call your do_job callback each 60 seconds. Instead of
+      interval, a schedule could be given, like `Cron('0 9 * * 1-5')`.
     * To stop job execution, call `self.stop_worker()`.
 
+    Jobs of all plugins are run by the bot's scheduler, in a few
+    shared threads (see `--scheduler-threads` option).
+
     See `thebot-instagram`, as an example.
     """
     def do_job(self):
         raise NotImplemented('Implement "do_job" method to get real work done.')
 
     def is_working(self):
-        thread = getattr(self, '_thread', None)
-        return thread is not None and thread.is_alive()
+        job = getattr(self, '_job', None)
+        return job is not None and not job.cancelled
+
+    def start_worker(self, interval=60, jitter=0, misfire=COALESCE):
+        """Runs `do_job` right now and then by the schedule.
 
-    def start_worker(self, interval=60):
+        See `thebot.utils.scheduler.Scheduler.add` for the description of arguments.
+        """
         if self.is_working():
             return
 
-        self._event = threading.Event()
-        self._thread = threading.Thread(target=self._worker, kwargs=dict(interval=interval))
-        self._thread.daemon = True
-        self._thread.start()
+        self._started = False
+        self._job = self.bot.scheduler.add(
+            self._worker,
+            interval,
+            name='plugin {0}'.format(self.name),
+            jitter=jitter,
+            misfire=misfire,
+            start_at=time.time(),
+        )
+
+    def run_job_at(self, timestamp):
+        """Makes the next `do_job` call not later than given timestamp."""
+        if self.is_working():
+            self._job.run_at(timestamp)
 
     def stop_worker(self, wait=True):
-        event = getattr(self, '_event', None)
-        if event is not None:
-            event.set()
+        job = getattr(self, '_job', None)
+        if job is None:
+            return
 
-        if wait:
-            self._thread.join()
+        job.cancel(wait=wait)
+        on_stop = getattr(self, 'on_stop', None)
+        if on_stop is not None and self._started:
+            on_stop()
 
-    def _worker(self, interval=60):
-        countdown = 0
+    def _worker(self):
         logger = logging.getLogger('thebot.' + self.__class__.__name__)
 
-        on_start = getattr(self, 'on_start', None)
-        if on_start is not None:
-            on_start()
+        if not self._started:
+            self._started = True
+            on_start = getattr(self, 'on_start', None)
+            if on_start is not None:
+                on_start()
 
-        while not self._event.is_set():
-            if countdown == 0:
-                try:
-                    self.do_job()
-                except Exception:
-                    logger.exception('Error during the task execution')
-
-                countdown = interval
-            else:
-                countdown -= 1
-
-            time.sleep(1)
-
-        on_stop = getattr(self, 'on_stop', None)
-        if on_stop is not None:
-            on_stop()
+        try:
+            self.do_job()
+        except Exception:
+            logger.exception('Error during the task execution')
 
 
 @printable
@@ -191,6 +252,16 @@ class Re(object):
     def __unicode__(self):
         return self.pattern
 
+    def for_plugin(self, plugin_name):
+        """Returns a copy of this pattern, bound to the plugin.
+
+        Original pattern is shared among all instances of the plugin's class,
+        so we don't modify it.
+        """
+        pattern = copy.copy(self)
+        pattern.plugin_name = plugin_name
+        return pattern
+
     def match(self, message, direct):
         if self._re is not None:
             return self._re.match(message)
@@ -229,6 +300,209 @@ on_pattern = _make_routing_decorator(PatternRe)
 on_command = _make_routing_decorator(CommandRe)
 
 
+_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+_QUANTIFIERS = frozenset('*+?{')
+_INLINE_FLAGS_RE = re.compile(r'\(\?[aiLmsux]')
+
+
+def _has_top_level_alternation(pattern):
+    """Checks if there is a '|' outside of any group or character class."""
+    depth = 0
+    idx = 0
+    length = len(pattern)
+
+    while idx < length:
+        char = pattern[idx]
+        if char == '\\':
+            idx += 1
+        elif char == '[':
+            # skipping the character class, keeping in mind,
+            # that ']' right after the '[' or '[^' is a literal
+            idx += 1
+            if idx < length and pattern[idx] == '^':
+                idx += 1
+            if idx < length and pattern[idx] == ']':
+                idx += 1
+            while idx < length and pattern[idx] != ']':
+                if pattern[idx] == '\\':
+                    idx += 1
+                idx += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        idx += 1
+    return False
+
+
+def _literal_prefix(pattern):
+    """Returns a text, which any string matched by the pattern starts with.
+
+    Result is conservative: an empty string means that we know nothing
+    about the pattern and it should be tried against every message.
+    """
+    if _INLINE_FLAGS_RE.search(pattern) or _has_top_level_alternation(pattern):
+        return ''
+
+    prefix = []
+    idx = 0
+    length = len(pattern)
+
+    while idx < length:
+        char = pattern[idx]
+        if char == '\\':
+            if idx + 1 < length and not pattern[idx + 1].isalnum():
+                literal = pattern[idx + 1]
+                idx += 2
+            else:
+                break
+        elif char in _SPECIAL_CHARS:
+            break
+        else:
+            literal = char
+            idx += 1
+
+        if idx < length and pattern[idx] in _QUANTIFIERS:
+            # this char is optional or repeated
+            break
+        prefix.append(literal)
+
+    return ''.join(prefix)
+
+
+class RouteList(list):
+    """A list of (pattern, callback) pairs, which knows when it was changed.
+
+    Bot uses `version` attribute to rebuild it's router.
+    """
+    version = 0
+
+    def _changed(self):
+        self.version += 1
+
+
+def _make_tracking_method(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+    wrapper.__name__ = str(name)
+    return wrapper
+
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'sort', 'reverse',
+              'clear', '__setitem__', '__delitem__', '__iadd__', '__imul__',
+              '__setslice__', '__delslice__'):
+    if hasattr(list, _name):
+        setattr(RouteList, _name, _make_tracking_method(_name))
+del _name
+
+
+_MISSING = object()
+
+
+class Router(object):
+    """An index over routes, to find a matching one without trying all of them.
+
+    Commands are stored in a trie by their literal prefix, so only those
+    commands, which could match the message, are tried. Patterns are filtered
+    by a literal substring. Routes without any literal part are always tried.
+
+    Candidates are checked in the original order, so the first matching
+    route is the same as if we tried every route one by one.
+
+    If `cache` is given, decisions for short messages are remembered there,
+    including the fact, that there is no route for the message. Cache is
+    used only if all patterns are CommandRe and PatternRe, because we can't
+    be sure that custom Re's always give the same result.
+
+    Cache could be shared by routers for different versions of routes,
+    so keys contain a router's own token. Otherwise a decision, which old
+    router writes after the cache was cleared, would point to a wrong route.
+    """
+    max_cached_length = 256
+
+    def __init__(self, routes, cache=None):
+        self.routes = list(routes)
+        self.cache = cache
+        self._token = object()
+        # a trie, where each node is a dict char -> node,
+        # and node[None] is a list of route indexes
+        self._commands = {}
+        # routes without a literal prefix, which may match direct messages only
+        self._direct = []
+        # (index, literal) for patterns, which may match any message
+        self._patterns = []
+
+        for idx, (pattern, callback) in enumerate(self.routes):
+            cls = type(pattern)
+            if cls is CommandRe:
+                prefix = _literal_prefix(pattern.pattern)
+                if prefix:
+                    node = self._commands
+                    for char in prefix:
+                        node = node.setdefault(char, {})
+                    node.setdefault(None, []).append(idx)
+                else:
+                    self._direct.append(idx)
+            elif cls is PatternRe:
+                self._patterns.append((idx, _literal_prefix(pattern.pattern)))
+            else:
+                # we don't know anything about custom Re's
+                self._patterns.append((idx, ''))
+                self.cache = None
+
+    def _candidates(self, message, direct):
+        candidates = [
+            idx
+            for idx, literal in self._patterns
+                if literal in message
+        ]
+
+        if direct:
+            candidates.extend(self._direct)
+
+            node = self._commands
+            for char in message:
+                node = node.get(char)
+                if node is None:
+                    break
+                candidates.extend(node.get(None, ()))
+
+        candidates.sort()
+        return candidates
+
+    def _find(self, message, direct):
+        """Returns a tuple (route's index, match's groupdict) or None."""
+        routes = self.routes
+        for idx in self._candidates(message, direct):
+            match = routes[idx][0].match(message, direct)
+            if match is not None:
+                return idx, match.groupdict()
+
+    def match(self, message, direct):
+        """Returns a tuple (pattern, callback, kwargs) or None."""
+        cache = self.cache
+
+        if cache is None or len(message) > self.max_cached_length:
+            found = self._find(message, direct)
+        else:
+            key = (self._token, message, direct)
+            found = cache.get(key, _MISSING)
+            if found is _MISSING:
+                found = self._find(message, direct)
+                cache.set(key, found)
+
+        if found is not None:
+            idx, kwargs = found
+            pattern, callback = self.routes[idx]
+            return pattern, callback, dict(kwargs)
+
+
 class HelpPlugin(Plugin):
     """Shows help and basic information about TheBot."""
     name = 'help'
@@ -317,10 +591,51 @@ class HelpPlugin(Plugin):
 
         request.respond('\n'.join(lines))
 
+    @on_command('stats')
+    def show_stats(self, request):
+        """Shows where TheBot spends time, to find slow plugins."""
+        histograms = self.bot.stats.dump()
+
+        def ms(value):
+            return '{0:.2f}'.format((value or 0) * 1000)
+
+        def gen_line(name, data):
+            return '  {0} — {1} calls, total {2} ms, p50 {3} ms, p99 {4} ms, max {5} ms'.format(
+                name, data['count'], ms(data['total']), ms(data['p50']), ms(data['p99']), ms(data['max'])
+            )
+
+        lines = ['Dispatching:']
+        for name in ('dispatch.queue', 'dispatch.match'):
+            if name in histograms:
+                lines.append(gen_line(name.split('.', 1)[1], histograms[name]))
+
+        cache = self.bot.match_cache
+        if cache is not None:
+            lines.append('  match cache — {hits} hits, {misses} misses, {size} items'.format(**cache.get_stats()))
+
+        for title, prefix in (('Plugins:', 'plugin:'), ('Slowest routes:', 'route:')):
+            items = [
+                (data['total'], name[len(prefix):], data)
+                for name, data in histograms.items()
+                    if name.startswith(prefix)
+            ]
+            items.sort(key=lambda item: item[0], reverse=True)
+
+            if items:
+                lines.append(title)
+                lines.extend(gen_line(name, data) for total, name, data in items[:10])
+
+        request.respond('\n'.join(lines))
+
+    @on_command('stats json')
+    def show_stats_json(self, request):
+        """Dumps all performance counters as JSON."""
+        request.respond(json.dumps(self.bot.get_stats(), sort_keys=True))
+
     @on_command('version')
     def version(self, request):
         """Shows TheBot's version."""
-        request.respond('My version is "{}".'.format(__version__))
+        request.respond('My version is "{}".'.format(get_version()))
 
     @on_command('uptime')
     def uptime(self, request):
@@ -344,126 +659,6 @@ class HelpPlugin(Plugin):
         request.respond(uptime)
 
 
-@printable
-class Stub(object):
-    """A stub class to replace objects which can't be unpickled.
-
-    It allows to call any method or access any attribute.
-    """
-    def __init__(self, name):
-        self.name = name
-
-    def __getattr__(self, name):
-        return Stub(self.name + '.' + name)
-
-    def __call__(self, *args, **kwargs):
-        return None
-
-    def __unicode__(self):
-        return self.name
-
-
-class Pickler(pickle.Pickler):
-    def __init__(self, file, protocol=None, global_objects=None):
-        pickle.Pickler.__init__(self, file, protocol=protocol)
-        self._global_objects = dict(
-            (id(obj), persistent_id)
-            for persistent_id, obj in (global_objects or {}).items()
-        )
-
-    def persistent_id(self, obj):
-        if isinstance(obj, Stub):
-            return obj.name
-        return self._global_objects.get(id(obj))
-
-
-class Unpickler(pickle.Unpickler):
-    """A custom unpickler, to restore references to adapters, plugins and the bot."""
-    def __init__(self, file, global_objects=None):
-        pickle.Unpickler.__init__(self, file)
-        self._global_objects = global_objects or {}
-
-    def persistent_load(self, obj_id):
-        try:
-            return self._global_objects[obj_id]
-        except KeyError:
-            return Stub(obj_id)
-
-
-class Shelve(shelve.DbfilenameShelf):
-    """A custom Shelve, to use custom Pickler and Unpickler.
-    """
-    def __init__(self, filename, global_objects=None):
-        shelve.DbfilenameShelf.__init__(self, filename)
-        self._global_objects = global_objects or {}
-
-    def __getitem__(self, key):
-        try:
-            value = self.cache[key]
-        except KeyError:
-            f = six.BytesIO(self.dict[key])
-            value = Unpickler(f, global_objects=self._global_objects).load()
-            if self.writeback:
-                self.cache[key] = value
-        return value
-
-    def __setitem__(self, key, value):
-        if self.writeback:
-            self.cache[key] = value
-        f = six.BytesIO()
-        p = Pickler(f, self._protocol, global_objects=self._global_objects)
-        p.dump(value)
-        value = f.getvalue()
-        self.dict[key] = value
-
-
-class Storage(utils.MutableMapping):
-    def __init__(self, filename, prefix='', global_objects=None):
-        """Specials are used to restore references to some nonserializable objects,
-        such as TheBot itself.
-        """
-        if isinstance(filename, Shelve):
-            self._shelve = filename
-        else:
-            self._shelve = Shelve(filename, global_objects=global_objects)
-
-        self.prefix = prefix
-        self.global_objects = global_objects or {}
-
-    def __getitem__(self, name):
-        return self._shelve.__getitem__(utils.force_str(self.prefix + name))
-
-    def __setitem__(self, name, value):
-        return self._shelve.__setitem__(utils.force_str(self.prefix + name), value)
-
-    def __delitem__(self, name):
-        return self._shelve.__delitem__(utils.force_str(self.prefix + name))
-
-    def __len__(self):
-        return sum(1 for key in self)
-
-    def __iter__(self):
-        prefix_len = len(self.prefix)
-        return (
-            key[prefix_len:]
-            for key in self._shelve.keys()
-                if key.startswith(self.prefix)
-        )
-
-    def keys(self):
-        return list(self)
-
-    def clear(self):
-        for key in self.keys():
-            del self[key]
-
-    def with_prefix(self, prefix):
-        return Storage(self._shelve, prefix=self.prefix + prefix, global_objects=self.global_objects)
-
-    def close(self):
-        self._shelve.close()
-
-
 class Config(object):
     def __init__(self):
         self._data = {}
@@ -473,7 +668,11 @@ class Config(object):
             self.read_from_string(f.read())
 
     def read_from_string(self, data):
-        data = yaml.load(data)
+        self.read_from_dict(yaml.load(data))
+
+    def read_from_dict(self, data):
+        # we'll pop items from data, so make a copy
+        data = dict(data)
 
         # This complex code allows you
         # to translate such YAML config:
@@ -538,8 +737,20 @@ class Bot(object):
 
         self.adapters = []
         self.plugins = []
-        self.patterns = []
+        self.patterns = RouteList()
+        self.stats = Stats()
+        self.match_cache = None
         self.exiting = False
+        self.startup_profile = profile = StartupProfile()
+
+        def find_module(name):
+            """Checks if module exists, without importing it."""
+            try:
+                from importlib.util import find_spec
+            except ImportError:
+                import pkgutil
+                return pkgutil.find_loader(name) is not None
+            return find_spec(name) is not None
 
         def create_loader(cls='Adapter'):
             def load(name):
@@ -554,10 +765,13 @@ class Bot(object):
                 """
 
                 if isinstance(name, six.string_types):
-                    try:
+                    # a lookup is cheaper than failed import and does not
+                    # hide ImportErrors raised by the module itself
+                    if find_module('thebot_' + name):
                         module = importlib.import_module('thebot_' + name)
-                    except ImportError:
+                    else:
                         module = importlib.import_module('thebot.batteries.' + name)
+                    profile.step('import {0} {1}'.format(cls.lower(), name))
 
                     value = getattr(module, cls)
                     if not hasattr(value, 'name'):
@@ -584,31 +798,36 @@ class Bot(object):
             return loader
 
 
-        default_config = """
-            unittest: no
-        """
+        # config file is parsed only once, but applied twice:
+        # before and after plugins added their options
+        config_data = None
+        if os.path.exists(config_filename):
+            with open(config_filename) as f:
+                config_data = yaml.load(f.read())
 
-        # read config first time, to figure out possible adapter
-        config = Config()
-        config.read_from_string(default_config)
+        def make_config(args, defaults):
+            config = Config()
+            config.read_from_dict(dict(unittest=False))
+            config.update_from_dict(defaults)
 
-        parser = Bot.get_general_options()
-        defaults = dict(parser.parse_args([])._get_kwargs())
-        config.update_from_dict(defaults)
+            if config_data:
+                config.read_from_dict(config_data)
 
-        if os.path.exists(config_filename):
-            config.read_from_file(config_filename)
+            # we override options only if there was specified value different from default
+            config.update_from_dict(dict(
+                (key, value)
+                for key, value in args._get_kwargs()
+                    if value != defaults.get(key)
+            ))
+            return config
 
+        # read config first time, to figure out possible adapter
+        parser = Bot.get_general_options()
         args, unknown = parser.parse_known_args(
             list(filter(lambda x: x not in ('--help', '-h'), command_line_args))
         )
-        # we override options only if there was specified value different from default
-        args = dict(
-            (key, value)
-            for key, value in args._get_kwargs()
-                if value != defaults.get(key)
-        )
-        config.update_from_dict(args)
+        config = make_config(args, dict(parser.parse_known_args([])[0]._get_kwargs()))
+        profile.step('config')
 
 
         # now, load plugin and adapter classes, collect their options
@@ -632,27 +851,10 @@ class Bot(object):
 
 
         # now, reread config to write there all defaults from all plugins
-        config = Config()
-        config.read_from_string(default_config)
-
-        # getting options' defaults from parser
-        defaults = dict(parser.parse_args([])._get_kwargs())
-        config.update_from_dict(defaults)
-
-        # now applying settings from the config file
-        if os.path.exists(config_filename):
-            config.read_from_file(config_filename)
-
-        # and finally, override them with command line options
-        # if there was specified value different from default
-        args = parser.parse_args(command_line_args)
-        args = dict(
-            (key, value)
-            for key, value in args._get_kwargs()
-                if value != defaults.get(key)
+        self.config = make_config(
+            parser.parse_args(command_line_args),
+            dict(parser.parse_args([])._get_kwargs()),
         )
-        config.update_from_dict(args)
-        self.config = config
 
         for key, value in config_dict.items():
             setattr(self.config, key, value)
@@ -665,6 +867,44 @@ class Bot(object):
 
         with open(self.config.pid_filename, 'w') as f:
             f.write(str(os.getpid()))
+        profile.step('options')
+
+        dispatch_threads = int(self.config.dispatch_threads)
+        self.event_loop = None
+        self.executor = None
+
+        if self.config.asyncio:
+            from .aio import EventLoop
+            self.event_loop = EventLoop(self, threads=dispatch_threads or None)
+        elif dispatch_threads > 0:
+            self.executor = KeyedExecutor(
+                threads=dispatch_threads,
+                queue_size=int(self.config.dispatch_queue_size),
+                name='thebot.core.executor',
+            )
+
+        self._identity_plugin = None
+        self.rate_limiters = []
+        for kind in ('user', 'room'):
+            burst = float(getattr(self.config, 'rate_limit_{0}_burst'.format(kind)))
+            rate = float(getattr(self.config, 'rate_limit_{0}_rate'.format(kind)))
+            if burst > 0:
+                self.rate_limiters.append((
+                    kind,
+                    RateLimiter(burst, rate, window=float(self.config.rate_limit_window)),
+                ))
+
+        match_cache_size = int(self.config.match_cache_size)
+        if match_cache_size > 0:
+            self.match_cache = LRUCache(match_cache_size)
+
+        process_pool_size = int(self.config.process_pool_size)
+        self.process_pool = ProcessPool(self, processes=process_pool_size or None)
+
+        self.scheduler = Scheduler(
+            threads=int(self.config.scheduler_threads),
+            name='thebot.core.scheduler',
+        )
 
         # adapters and plugins initialization
         global_objects = dict(bot=self)
@@ -674,18 +914,56 @@ class Bot(object):
             global_objects[a.name] = a
             a.start()
             self.adapters.append(a)
-
-        self.storage = Storage(self.config.storage_filename, global_objects=global_objects)
+            profile.step('start adapter {0}'.format(a.name))
+
+        storage_backend = get_backend(self.config.storage_url or self.config.storage_filename)
+        storage_write_delay = float(self.config.storage_write_delay)
+        if storage_write_delay > 0:
+            storage_backend = WriteBehindBackend(
+                storage_backend,
+                delay=storage_write_delay,
+                max_pending=int(self.config.storage_write_batch),
+            )
+
+        storage_cache = None
+        storage_cache_size = int(self.config.storage_cache_size)
+        if storage_cache_size > 0:
+            storage_cache = StorageCache(
+                max_size=storage_cache_size,
+                max_bytes=int(float(self.config.storage_cache_memory) * 1024 * 1024),
+            )
+        self.storage = Storage(storage_backend, global_objects=global_objects, cache=storage_cache)
+
+        storage_reap_interval = float(self.config.storage_reap_interval)
+        if storage_reap_interval > 0:
+            self.scheduler.add(
+                self._reap_storage,
+                storage_reap_interval,
+                name='storage reaper',
+                jitter=storage_reap_interval / 10,
+                misfire=SKIP,
+            )
+        profile.step('storage')
 
         for plugin_cls in plugin_classes:
             p = plugin_cls(self)
             self.plugins.append(p)
             callbacks = p.get_callbacks()
             self.patterns.extend(callbacks)
+            profile.step('init plugin {0}'.format(p.name))
+
+        try:
+            self._identity_plugin = self.get_plugin('identity')
+        except KeyError:
+            self._identity_plugin = None
 
         if self.config.reload_on_changes:
+            import server_reloader
             server_reloader.trigger_on_code_changes()
 
+        if self.config.profile_startup:
+            sys.stderr.write(profile.report())
+
     @staticmethod
     def get_general_options():
         parser = argparse.ArgumentParser(
@@ -707,10 +985,89 @@ class Bot(object):
             '--storage-filename', default='thebot.storage',
             help='Path to a database file, used for TheBot\'s memory. Default: thebot.storage.'
         )
+        parser.add_argument(
+            '--storage-url', default='',
+            help='URL of the storage backend, like sqlite:///thebot.db. '
+                 'If not given, --storage-filename is used.'
+        )
+        parser.add_argument(
+            '--storage-write-delay', default=0, type=float,
+            help='Keep storage writes in memory up to this number of seconds and write them in batches. '
+                 'Repeated writes to the same key are coalesced. If 0, data is written immediately. Default: 0.'
+        )
+        parser.add_argument(
+            '--storage-write-batch', default=1000, type=int,
+            help='Write delayed changes when there are so many of them. Default: 1000.'
+        )
+        parser.add_argument(
+            '--storage-cache-size', default=1000, type=int,
+            help='How many recently used storage values to keep in memory. If 0, cache is off. Default: 1000.'
+        )
+        parser.add_argument(
+            '--storage-cache-memory', default=16, type=float,
+            help='Memory limit for the storage cache, in megabytes of pickled data. Default: 16.'
+        )
+        parser.add_argument(
+            '--storage-reap-interval', default=60, type=float,
+            help='Delete expired storage values every this number of seconds. If 0, expired values are kept, but not returned. Default: 60.'
+        )
         parser.add_argument(
             '--reload-on-changes', action='store_true', default=False,
             help='Track source files changes and restart the bot. Default: False.'
         )
+        parser.add_argument(
+            '--profile-startup', action='store_true', default=False,
+            help='Print how long each step of the startup took. Default: False.'
+        )
+        parser.add_argument(
+            '--dispatch-threads', default=0, type=int,
+            help='Number of threads to run plugins\' callbacks. Messages from one conversation are processed in order. '
+                 'If 0, then callbacks are called in the adapter\'s thread. Default: 0.'
+        )
+        parser.add_argument(
+            '--dispatch-queue-size', default=1000, type=int,
+            help='How many requests could wait for a free thread, before adapters will be blocked. Default: 1000.'
+        )
+        parser.add_argument(
+            '--asyncio', action='store_true', default=False,
+            help='Dispatch requests in the asyncio event loop. This allows to use '
+                 '"async def" callbacks and adapters. Requires Python 3.5. Default: False.'
+        )
+        parser.add_argument(
+            '--match-cache-size', default=1024, type=int,
+            help='How many routing decisions for recent messages to remember. If 0, cache is off. Default: 1024.'
+        )
+        parser.add_argument(
+            '--process-pool-size', default=0, type=int,
+            help='Number of processes to run callbacks, decorated with "in_process". '
+                 'If 0, then number of CPUs is used. Default: 0.'
+        )
+        parser.add_argument(
+            '--scheduler-threads', default=4, type=int,
+            help='How many background jobs of plugins could run at once. Default: 4.'
+        )
+
+        group = parser.add_argument_group('Rate limiting options')
+        group.add_argument(
+            '--rate-limit-user-burst', default=0, type=float,
+            help='How many requests each user could send at once. If 0, users are not limited. Default: 0.'
+        )
+        group.add_argument(
+            '--rate-limit-user-rate', default=1, type=float,
+            help='How many requests per second each user could send in a long run. Default: 1.'
+        )
+        group.add_argument(
+            '--rate-limit-room-burst', default=0, type=float,
+            help='How many requests could be sent to a room at once. If 0, rooms are not limited. Default: 0.'
+        )
+        group.add_argument(
+            '--rate-limit-room-rate', default=5, type=float,
+            help='How many requests per second could be sent to a room in a long run. Default: 5.'
+        )
+        group.add_argument(
+            '--rate-limit-window', default=60, type=float,
+            help='User is asked to slow down not more often than once in this number of seconds. Default: 60.'
+        )
 
         group = parser.add_argument_group('General options')
         group.add_argument(
@@ -723,33 +1080,178 @@ class Bot(object):
         )
         return parser
 
+    @property
+    def patterns(self):
+        return self._patterns
+
+    @patterns.setter
+    def patterns(self, value):
+        if not isinstance(value, RouteList):
+            value = RouteList(value)
+        self._patterns = value
+
+    def get_router(self):
+        """Returns router, rebuilding it if patterns were changed."""
+        patterns = self._patterns
+        router = getattr(self, '_router', None)
+
+        if router is None or self._router_key != (id(patterns), patterns.version):
+            if self.match_cache is not None:
+                self.match_cache.clear()
+            router = Router(patterns, cache=self.match_cache)
+            self._router = router
+            self._router_key = (id(patterns), patterns.version)
+        return router
+
+    @staticmethod
+    def get_conversation_key(request):
+        """Returns a key, used to process requests from one conversation in order."""
+        return (
+            getattr(request.adapter, 'name', None),
+            getattr(request.user, 'id', request.user),
+            getattr(request.room, 'id', request.room),
+        )
+
+    def get_rate_limit_key(self, kind, request):
+        """Returns a key for the rate limiter or None if request should not be limited."""
+        adapter_name = getattr(request.adapter, 'name', None)
+
+        if kind == 'user':
+            if self._identity_plugin is not None:
+                identity_id = self._identity_plugin.get_identity_id_by_user(request.adapter, request.user)
+                if identity_id is not None:
+                    return identity_id
+            return (adapter_name, getattr(request.user, 'id', request.user))
+
+        if request.room is not None:
+            return (adapter_name, getattr(request.room, 'id', request.room))
+
+    def admit(self, request, direct=True):
+        """Checks if request is within rate limits.
+
+        Rejected sender is asked to slow down, but only once per window.
+        """
+        for kind, limiter in self.rate_limiters:
+            key = self.get_rate_limit_key(kind, request)
+            if key is not None:
+                admitted, warn = limiter.admit(key, can_warn=direct)
+                if not admitted:
+                    if warn:
+                        request.respond('Slow down, please. I\'ll ignore your requests for a while.')
+                    return False
+        return True
+
     def on_request(self, request, direct=True):
         if request is EXIT:
             self.exiting = True
+        elif not self.admit(request, direct):
+            logging.getLogger('thebot.core.on_request').debug(
+                'Request "{0}" rejected by rate limiter'.format(request))
+        elif self.event_loop is not None:
+            return self.event_loop.submit(request, direct)
+        elif self.executor is None:
+            self.dispatch(request, direct)
         else:
-            for pattern, callback in self.patterns:
-                match = pattern.match(request.message, direct)
-                if match is not None:
-                    try:
-                        result = callback(request, **match.groupdict())
-                    except Exception:
-                        logging.getLogger('thebot.core.on_request').exception(
-                            'During processing "{0}" request'.format(request))
-                    else:
-                        if result is not None:
-                            raise RuntimeError('Plugin {0} should not return response directly. Use request.respond(some message).')
-                    break
+            task = self.executor.submit(
+                self.get_conversation_key(request),
+                self.dispatch,
+                request,
+                direct,
+                time.time(),
+            )
+            if request.synchronous:
+                task.wait()
+            return task
+
+    def dispatch(self, request, direct=True, queued_at=None):
+        """Finds a route for the request and calls plugin's callback."""
+        found = self.match(request, direct, queued_at)
+        if found is not None:
+            pattern, callback, kwargs = found
+            started_at = time.time()
+            try:
+                result = self.call_callback(callback, request, kwargs)
+            except Exception:
+                logging.getLogger('thebot.core.on_request').exception(
+                    'During processing "{0}" request'.format(request))
             else:
-                if direct:
-                    # If message wass addressed to TheBot, then it
-                    # should report that he does not know such command.
-                    request.respond('I don\'t know command "{0}".'.format(request.message))
+                if hasattr(result, '__await__'):
+                    result.close()
+                    raise RuntimeError('Plugin {0} has an async callback, use --asyncio option.'.format(pattern.plugin_name))
+                if result is not None:
+                    raise RuntimeError('Plugin {0} should not return response directly. Use request.respond(some message).')
+            finally:
+                self.record_callback_time(pattern, time.time() - started_at)
+        else:
+            self.on_unknown_command(request, direct)
+
+    def match(self, request, direct, queued_at=None):
+        """Returns (pattern, callback, kwargs) for the request or None.
+
+        Also records time, request spent in the queue and time of matching.
+        """
+        started_at = time.time()
+        if queued_at is not None:
+            self.stats.record('dispatch.queue', started_at - queued_at)
+
+        found = self.get_router().match(request.message, direct)
+        self.stats.record('dispatch.match', time.time() - started_at)
+        return found
+
+    def record_callback_time(self, pattern, elapsed):
+        plugin_name = getattr(pattern, 'plugin_name', None)
+        self.stats.record('plugin:{0}'.format(plugin_name), elapsed)
+        self.stats.record('route:{0}:{1}'.format(plugin_name, pattern.pattern), elapsed)
+
+    def get_stats(self):
+        """Returns all performance counters as a dict, which can be dumped to JSON."""
+        result = dict(histograms=self.stats.dump())
+        if self.executor is not None:
+            result['executor'] = self.executor.get_stats()
+        if self.match_cache is not None:
+            result['match_cache'] = self.match_cache.get_stats()
+        result['scheduler'] = self.scheduler.get_stats()
+        storage = self.storage.get_stats()
+        if storage:
+            result['storage'] = storage
+        if self.rate_limiters:
+            result['rate_limits'] = dict(
+                (kind, dict(
+                    (key if isinstance(key, six.string_types) else ':'.join(map(six.text_type, key)), counters)
+                    for key, counters in limiter.get_stats().items()
+                ))
+                for kind, limiter in self.rate_limiters
+            )
+        return result
+
+    def call_callback(self, callback, request, kwargs):
+        if getattr(callback, '_in_process', False):
+            return self.process_pool.call(callback, request, kwargs)
+        return callback(request, **kwargs)
+
+    def on_unknown_command(self, request, direct):
+        if direct:
+            # If message wass addressed to TheBot, then it
+            # should report that he does not know such command.
+            request.respond('I don\'t know command "{0}".'.format(request.message))
 
     def close(self):
         """Will close all connections here.
         """
+        self.scheduler.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.event_loop is not None:
+            self.event_loop.close()
+        self.process_pool.close()
         self.storage.close()
 
+    def _reap_storage(self, limit=100):
+        """Deletes expired storage values by small batches."""
+        while self.storage.reap(limit) == limit:
+            # let other threads work with the storage
+            time.sleep(0)
+
     def get_adapter(self, name):
         """Returns adapter by it's name."""
         for adapter in self.adapters:
@@ -0,0 +1,189 @@
+# coding: utf-8
+"""Asyncio mode for TheBot.
+
+This module is used only when TheBot is started with `--asyncio`
+option and requires Python 3.5 or later.
+
+In this mode, all requests are dispatched in a single event loop.
+Plugin's callbacks, defined with `async def`, are awaited right
+in the loop, and usual callbacks are called in a thread pool.
+Adapters can be coroutines too, see `Adapter` below.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import logging
+import threading
+import time
+
+import thebot
+
+
+class AwaitableRequest(object):
+    """A proxy for request, which makes `respond` and `shout` awaitable.
+
+    It is passed to the `async def` callbacks. Usual adapters send
+    messages in the event loop's thread pool, to not block the loop.
+    """
+    def __init__(self, request, event_loop):
+        self._request = request
+        self._event_loop = event_loop
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+    def __str__(self):
+        return str(self._request)
+
+    def _send(self, method, message):
+        if isinstance(self._request.adapter, Adapter):
+            result = method(message)
+            if inspect.isawaitable(result):
+                return asyncio.ensure_future(result)
+
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(result)
+            return future
+
+        return self._event_loop.run_in_executor(method, message)
+
+    def respond(self, message):
+        return self._send(self._request.respond, message)
+
+    def shout(self, message):
+        return self._send(self._request.shout, message)
+
+
+class EventLoop(object):
+    """Runs an asyncio event loop in a separate thread and dispatches requests there."""
+    def __init__(self, bot, threads=None):
+        self.bot = bot
+        self.logger = logging.getLogger('thebot.core.asyncio')
+        self.loop = asyncio.new_event_loop()
+        # sync callbacks are called in this pool
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        # a map conversation key -> [lock, number of requests using it]
+        self._locks = {}
+
+        self._thread = threading.Thread(target=self._run, name='thebot.core.asyncio')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self._thread
+
+    def spawn(self, coroutine):
+        """Schedules a coroutine from any thread.
+
+        Returns an asyncio.Task if called from the loop's thread,
+        or concurrent.futures.Future otherwise.
+        """
+        if self.in_loop_thread():
+            return self.loop.create_task(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run_in_executor(self, func, *args):
+        """Calls a blocking function in the thread pool and returns an awaitable future."""
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def submit(self, request, direct=True):
+        future = self.spawn(self.dispatch(request, direct, time.time()))
+        if request.synchronous and not self.in_loop_thread():
+            future.result()
+        return future
+
+    async def dispatch(self, request, direct=True, queued_at=None):
+        """Processes requests from one conversation one after another."""
+        key = self.bot.get_conversation_key(request)
+        item = self._locks.get(key)
+        if item is None:
+            item = self._locks[key] = [asyncio.Lock(), 0]
+
+        item[1] += 1
+        try:
+            async with item[0]:
+                await self._dispatch(request, direct, queued_at)
+        finally:
+            item[1] -= 1
+            if item[1] == 0:
+                del self._locks[key]
+
+    async def _dispatch(self, request, direct, queued_at):
+        found = self.bot.match(request, direct, queued_at)
+        if found is None:
+            # it could respond through an adapter with blocking `send`
+            await self.run_in_executor(self.bot.on_unknown_command, request, direct)
+            return
+
+        pattern, callback, kwargs = found
+        started_at = time.time()
+
+        try:
+            if asyncio.iscoroutinefunction(callback):
+                result = await callback(AwaitableRequest(request, self), **kwargs)
+            else:
+                result = await self.run_in_executor(self.bot.call_callback, callback, request, kwargs)
+        except Exception:
+            self.logger.exception('During processing "{0}" request'.format(request))
+        else:
+            if result is not None:
+                self.logger.error(
+                    'Plugin {0} should not return response directly. '
+                    'Use request.respond(some message).'.format(getattr(pattern, 'plugin_name', None))
+                )
+        finally:
+            self.bot.record_callback_time(pattern, time.time() - started_at)
+
+    def close(self):
+        # these functions were methods of Task before Python 3.7
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+        async def cancel_tasks():
+            tasks = [
+                task for task in all_tasks()
+                    if task is not current_task()
+            ]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(cancel_tasks(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+
+        self.executor.shutdown(wait=True)
+        self.loop.close()
+
+
+class Adapter(thebot.Adapter):
+    """Base class for adapters, implemented as coroutines.
+
+    Override `run` to receive messages and pass them into
+    `self.callback`, and `async_send` to deliver responses.
+    Such adapters work only when TheBot is started with `--asyncio`.
+    """
+    def start(self):
+        if self.bot.event_loop is None:
+            raise RuntimeError('Adapter {0} requires --asyncio option.'.format(self.name))
+        # event loop keeps only weak references to tasks
+        self._task = self.bot.event_loop.spawn(self.run())
+
+    async def run(self):
+        """Main coroutine of the adapter."""
+
+    async def async_send(self, message, user=None, room=None, refer_by_name=False):
+        raise NotImplementedError('Implement "async_send" method to deliver messages.')
+
+    def send(self, message, user=None, room=None, refer_by_name=False):
+        return self.bot.event_loop.spawn(
+            self.async_send(message, user=user, room=room, refer_by_name=refer_by_name)
+        )
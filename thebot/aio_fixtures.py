@@ -0,0 +1,55 @@
+# coding: utf-8
+"""Adapters and plugins with coroutines for `thebot.tests_aio`.
+
+They are kept separately, because `async def` is a syntax error
+before Python 3.5, and tests module should be skipped there.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import thebot.aio
+
+from thebot import Plugin, Request, User, on_command
+
+
+class AsyncTestAdapter(thebot.aio.Adapter):
+    name = 'async-test'
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncTestAdapter, self).__init__(*args, **kwargs)
+        self.lines = []
+        self.received = None
+
+    async def run(self):
+        self.received = asyncio.Queue()
+        while True:
+            line = await self.received.get()
+            self.callback(Request(self, line, user=User('async user')))
+
+    async def async_send(self, message, user=None, room=None, refer_by_name=False):
+        self.lines.append(message)
+
+    def write(self, line, count=1):
+        """Passes line into the adapter and waits for `count` responses."""
+        loop = self.bot.event_loop.loop
+
+        async def write():
+            expected = len(self.lines) + count
+            while self.received is None:
+                await asyncio.sleep(0.001)
+            await self.received.put(line)
+            while len(self.lines) < expected:
+                await asyncio.sleep(0.001)
+
+        asyncio.run_coroutine_threadsafe(write(), loop).result(timeout=5)
+
+
+class AsyncPlugin(Plugin):
+    name = 'async'
+
+    @on_command('sleep and respond')
+    async def sleep_and_respond(self, request):
+        await asyncio.sleep(0.01)
+        await request.respond('first')
+        await request.respond('second')
@@ -0,0 +1,74 @@
+# coding: utf-8
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import os
+
+from thebot import Plugin, on_command
+
+
+class Plugin(Plugin):
+    """Commands to maintain TheBot's storage.
+
+    Nobody can run these commands until users are listed
+    in --admin-users option, together with their adapters,
+    like xmpp:admin@example.com.
+
+    Only list users of adapters, which authenticate them.
+    For example, anybody can take a nick in IRC.
+    """
+    name = 'admin'
+
+    def __init__(self, *args, **kwargs):
+        super(Plugin, self).__init__(*args, **kwargs)
+        self.admins = self._get_admins()
+
+    def _get_admins(self):
+        """Returns a set of pairs (adapter name, user id)."""
+        admins = set()
+        for item in self.bot.config.admin_users.split(','):
+            adapter, sep, user = item.strip().partition(':')
+            if sep and adapter and user:
+                admins.add((adapter, user))
+            elif item.strip():
+                self.logger.warning('Admin user "%s" is ignored, it should look like adapter:user.', item.strip())
+        return admins
+
+    def _check_access(self, request):
+        if (request.adapter.name, request.user.id) not in self.admins:
+            request.respond('Sorry, only admins can do this.')
+            return False
+        return True
+
+    @on_command('compact storage')
+    def compact(self, request):
+        """Rewrite the storage to free space, occupied by deleted data."""
+        if self._check_access(request):
+            result = self.bot.storage.compact()
+            request.respond('Storage was compacted from {before} to {after} bytes.'.format(**result))
+
+    @on_command('backup storage')
+    def backup(self, request):
+        """Save a copy of the storage into the backup directory."""
+        if self._check_access(request):
+            filename = os.path.join(
+                self.bot.config.admin_backup_dir,
+                'thebot-{0:%Y%m%d-%H%M%S}.backup'.format(datetime.datetime.utcnow()),
+            )
+            count = self.bot.storage.snapshot(filename)
+            files = self.bot.storage.get_files(filename)
+            request.respond('{0} keys were saved to {1}.'.format(count, ', '.join(files)))
+
+    @staticmethod
+    def get_options(parser):
+        group = parser.add_argument_group('Admin options')
+        group.add_argument(
+            '--admin-users', default='',
+            help='Comma-separated list of users, allowed to run admin commands, '
+                 'with their adapters, like xmpp:admin@example.com. '
+                 'Don\'t list IRC users, nicks are not authenticated. Default: nobody.'
+        )
+        group.add_argument(
+            '--admin-backup-dir', default='.',
+            help='Where to save storage backups. Default: current directory.'
+        )
@@ -0,0 +1,41 @@
+"""Console adapter for the asyncio mode.
+
+Standard input is read by the event loop itself, without a thread.
+Requires `--asyncio` option and Python 3.5 or later.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import sys
+import thebot
+import thebot.aio
+
+
+class Adapter(thebot.aio.Adapter):
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        while True:
+            sys.stdout.write('> ')
+            sys.stdout.flush()
+            line = await reader.readline()
+            if len(line) == 0:
+                # seems, Ctrl-D was pressed
+                self.callback(thebot.EXIT)
+                return
+
+            request = thebot.Request(
+                self,
+                line.decode('utf-8').strip(),
+                thebot.User('console'),
+            )
+            self.callback(request)
+
+    async def async_send(self, message, user=None, room=None, refer_by_name=False):
+        sys.stdout.write('{0}\n'.format(message))
+        sys.stdout.flush()
+
+    def is_online(self, user):
+        return True
@@ -5,11 +5,14 @@ import logging
 import threading
 
 from wsgiref.simple_server import make_server, WSGIRequestHandler
-from .. import Request, Adapter, User, __version__
+from .. import Request, Adapter, User, get_version
 from ..utils import force_str
 from cgi import parse_qs
 
 class HttpRequest(Request):
+    # response should be sent before the WSGI handler returns
+    synchronous = True
+
     def __init__(self, adapter, environ, start_response):
         super(HttpRequest, self).__init__(adapter, environ['PATH_INFO'], user=User('http service'))
         self.environ = environ
@@ -32,7 +35,7 @@ class HttpRequest(Request):
 
         status = b'200 OK'
         headers = [
-            (b'Server', b'TheBot/' + force_str(__version__)),
+            (b'Server', b'TheBot/' + force_str(get_version())),
             (b'Content-type', b'text/plain; charset=utf-8'),
         ]
 
@@ -6,6 +6,7 @@ import time
 import random
 
 from thebot import Plugin, on_command
+from thebot.storage import DELETE
 from thebot.utils import printable
 
 
@@ -21,11 +22,18 @@ class Person(object):
     def __eq__(self, another):
         return self.adapter == another.adapter and self.user == another.user
 
+    def __reduce__(self):
+        # makes pickle shorter than with the instance's __dict__
+        return (Person, (self.adapter, self.user))
+
 
 class Identity(object):
-    def __init__(self, identity_id):
+    def __init__(self, identity_id, persons=None):
         self.id = identity_id
-        self.persons = []
+        self.persons = persons or []
+
+    def __reduce__(self):
+        return (Identity, (self.id, self.persons))
 
 
 class Plugin(Plugin):
@@ -45,7 +53,7 @@ class Plugin(Plugin):
 
         self.identity_storage = self.storage.with_prefix('i:')
 
-        for identity in self.identity_storage.values():
+        for identity_id, identity in self.identity_storage.scan():
             self._add_identity(identity, save_to_storage=False)
 
     @on_command('build identity')
@@ -91,13 +99,16 @@ class Plugin(Plugin):
                 person = Person(request.adapter, request.user)
                 self.logger.debug('Binding {} to identity {}'.format(person, to_identity.id))
 
-                to_identity.persons.append(person)
-                self._add_identity(to_identity)
+                def add_person(identity):
+                    if person not in identity.persons:
+                        identity.persons.append(person)
+                    return identity
 
-                from_identity.persons.remove(person)
-                if len(from_identity.persons) == 0:
-                    del self.identity_storage[from_identity.id]
-                    del self.identities[from_identity.id]
+                # identity is changed in the storage atomically, because
+                # binds from different accounts could come at the same time
+                to_identity = self.identity_storage.update(to_identity.id, add_person, default=to_identity)
+                self._add_identity(to_identity, save_to_storage=False)
+                self._remove_person(from_identity, person)
             request.respond('ok')
 
     @on_command('unbind')
@@ -107,11 +118,23 @@ class Plugin(Plugin):
         person = Person(request.adapter, request.user)
 
         self.logger.debug('Unbinding {} to identity {}'.format(person, from_identity.id))
-        from_identity.persons.remove(person)
+        self._remove_person(from_identity, person)
+
+    def _remove_person(self, identity, person):
+        """Removes person from identity, and identity itself, if it has no more persons."""
+        def remove_person(identity):
+            if person in identity.persons:
+                identity.persons.remove(person)
+            # empty identity is deleted by the same compare and set
+            return identity if identity.persons else DELETE
 
-        if len(from_identity.persons) == 0:
-            del self.identity_storage[from_identity.id]
-            del self.identities[from_identity.id]
+        identity_id = identity.id
+        identity = self.identity_storage.update(identity_id, remove_person, default=identity)
+
+        if identity is None:
+            self.identities.pop(identity_id, None)
+        else:
+            self.identities[identity_id] = identity
 
     @on_command('show my accounts')
     def show_my_ids(self, request):
@@ -134,6 +157,10 @@ class Plugin(Plugin):
     def get_identity_by_id(self, identity_id):
         return self.identities.get(identity_id)
 
+    def get_identity_id_by_user(self, adapter, user):
+        """Returns identity's id for user or None, if there is no identity yet."""
+        return self.persons.get((adapter.name, user.id))
+
     def get_identity_by_user(self, adapter, user):
         """Returns identity for user.
 
@@ -1,8 +1,6 @@
 # coding: utf-8
 from __future__ import absolute_import, unicode_literals
 
-import requests
-import anyjson
 import random
 
 from thebot import Plugin, on_command
@@ -41,6 +39,10 @@ class Plugin(Plugin):
         )
 
     def _find_image(self, query):
+        # these are imported here, because they are slow to import
+        import anyjson
+        import requests
+
         response = requests.get(
             'http://ajax.googleapis.com/ajax/services/search/images',
             params=dict(
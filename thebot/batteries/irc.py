@@ -13,6 +13,10 @@ from functools import wraps
 
 class IRCConnection(irc.IRCConnection):
     def __init__(self, *args, **kwargs):
+        # if False, callbacks are called in the connection's thread,
+        # this is used when TheBot dispatches requests itself
+        # in the asyncio loop or in a thread pool
+        self.threaded = kwargs.pop('threaded', True)
         super(IRCConnection, self).__init__(*args, **kwargs)
         # a map nick -> list of events
         # to signal about received online status
@@ -31,6 +35,9 @@ class IRCConnection(irc.IRCConnection):
         callbacks.append(
             (re.compile(':(?:.*?)\s+303(?:.*?):(?P<nicks>.*)'), self.on_ison_response)
         )
+        if not self.threaded:
+            return tuple(callbacks)
+
         def threaded_callback(func):
             @wraps(func)
             def wrapper(*args, **kwargs):
@@ -136,7 +143,12 @@ class Adapter(thebot.Adapter):
             )
             return self.callback(request, direct=direct)
 
-        conn = IRCConnection(host, port, nick)
+        conn = IRCConnection(
+            host,
+            port,
+            nick,
+            threaded=self.bot.event_loop is None and self.bot.executor is None,
+        )
         conn.register_callbacks((
             (re.compile('.*'), on_message),
         ))
@@ -1,9 +1,6 @@
 # coding: utf-8
 from __future__ import absolute_import, unicode_literals
 
-import requests
-import anyjson
-
 from thebot import Plugin, on_command
 
 
@@ -13,6 +10,10 @@ class Plugin(Plugin):
     @on_command('(calc|calculate|convert|math)( me)? (?P<expression>.+)')
     def math(self, request, expression):
         """Use Google's calculator to do some math."""
+        # these are imported here, because they are slow to import
+        import anyjson
+        import requests
+
         response = requests.get(
             'http://www.google.com/ig/calculator',
             params=dict(
@@ -1,31 +1,108 @@
 # coding: utf-8
 from __future__ import absolute_import, unicode_literals
 
-import bisect
+import calendar
+import itertools
+import os.path
 import times
 import hashlib
 import six
 
+from datetime import timedelta
+from dateutil import rrule
 from dateutil.parser import parse
 from thebot import ThreadedPlugin, on_command
+from thebot.storage import DELETE
+
+SCHEMA_VERSION = 3
+
+# how many tasks are shown by `my tasks` at once
+PAGE_SIZE = 20
+
+# rules for `remind me every <period>`
+PERIODS = dict(
+    hour='FREQ=HOURLY',
+    day='FREQ=DAILY',
+    week='FREQ=WEEKLY',
+    weekday='FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR',
+    month='FREQ=MONTHLY',
+    year='FREQ=YEARLY',
+    monday='FREQ=WEEKLY;BYDAY=MO',
+    tuesday='FREQ=WEEKLY;BYDAY=TU',
+    wednesday='FREQ=WEEKLY;BYDAY=WE',
+    thursday='FREQ=WEEKLY;BYDAY=TH',
+    friday='FREQ=WEEKLY;BYDAY=FR',
+    saturday='FREQ=WEEKLY;BYDAY=SA',
+    sunday='FREQ=WEEKLY;BYDAY=SU',
+)
+
+
+def _make_task_id(about, number=0):
+    """Task's id is a sha1 of it's text. If user already has
+    a task with the same id, then a number is added to the text.
+    """
+    if number:
+        about = '{0}\n{1}'.format(about, number)
+    return hashlib.sha1(about.encode('utf-8')).hexdigest()
+
+
+def _unique_prefix_length(task_ids):
+    """Returns minimum length of prefix, which is unique for all ids, but not less than 2."""
+    task_ids = sorted(task_ids)
+    length = 2
+    # in a sorted list, longest common prefix is between neighbours
+    for prev, cur in zip(task_ids, task_ids[1:]):
+        length = max(length, len(os.path.commonprefix([prev, cur])) + 1)
+    return length
 
 
-def _gen_hashes(tasks):
-    """Generates sha1 hashes for tasks and minumum subhash's
-    length for which all generated hashes are unique.
+def _due_key(task):
+    """Returns a key in the index of upcoming reminders.
+
+    Keys are sorted by task's time, so the nearest
+    reminders are at the beginning of the index.
     """
-    if not tasks:
-        return [], 0
+    dt, about, identity_id, task_id = task
+    return 'due:{0:%Y-%m-%dT%H:%M:%S.%f}:{1}:{2}'.format(dt, identity_id, task_id)
+
+
+def _id_key(identity_id, task_id):
+    """Returns a key of the task's record. They are also used to find tasks by id's prefix."""
+    return 'id:{0}:{1}'.format(identity_id, task_id)
+
+
+def _time_key(task):
+    """Returns a key in the user's list of tasks, ordered by time."""
+    dt, about, identity_id, task_id = task
+    return 'at:{0}:{1:%Y-%m-%dT%H:%M:%S.%f}:{2}'.format(identity_id, dt, task_id)
+
+
+def _task_keys(task):
+    """All keys, where task is stored."""
+    return _id_key(task[2], task[3]), _time_key(task), _due_key(task)
+
+
+def _rule_key(identity_id, task_id):
+    """Returns a key, where recurring task's rule is stored."""
+    return 'rule:{0}:{1}'.format(identity_id, task_id)
+
+
+def _next_occurrence(recurrence, after):
+    """Returns recurring task's first time after given UTC time, or None if there are no more.
+
+    Rule is applied in the user's local time, so reminders
+    keep their local time when daylight saving time changes.
+    """
+    tz = recurrence['timezone']
+    rule = rrule.rrulestr(recurrence['rule'], dtstart=recurrence['dtstart'])
+    dt = rule.after(times.to_local(after, tz).replace(tzinfo=None))
+    if dt is None:
+        return None
+    return times.to_universal(dt, tz)
+
 
-    shas = [
-        hashlib.sha1(about.encode('utf-8')).hexdigest()
-        for dt, about, r in tasks
-    ]
-    for min_len in range(2, len(shas[0]) + 1):
-        trimmed = set(h[:min_len] for h in shas)
-        if len(trimmed) == len(shas):
-            break
-    return shas, min_len
+def _to_timestamp(dt):
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1000000.0
 
 
 class Plugin(ThreadedPlugin):
@@ -35,6 +112,10 @@ class Plugin(ThreadedPlugin):
     To use your local time everywhere, set timezone like that:
 
     set timezone Europe/Moscow
+
+    Recurring reminders are set like that:
+
+    remind me every weekday at 9:30 to check the mail
     """
     name = 'todo'
     deps = ['notify', 'identity', 'settings']
@@ -42,17 +123,102 @@ class Plugin(ThreadedPlugin):
     def __init__(self, *args, **kwargs):
         super(Plugin, self).__init__(*args, **kwargs)
 
-        # interval between bot's attemts to find expired tasks
+        # interval between bot's attemts to find expired tasks,
+        # besides that, worker wakes up at each task's time
         self.interval = 60
 
+        if self.storage.get('schema_version', 0) < SCHEMA_VERSION:
+            self._migrate()
+
         if not self.bot.config.unittest:
             self.start_worker(interval=self.interval)
 
-    def _get_tasks(self, identity):
-        return self.storage.get('tasks:{}'.format(identity.id), [])
+    def _migrate(self):
+        """Moves tasks from lists `tasks:<identity>` of previous versions into separate records.
 
-    def _set_tasks(self, identity, tasks):
-        self.storage['tasks:{}'.format(identity.id)] = tasks
+        Also assigns ids to tasks and builds the index of upcoming reminders.
+        Lists are deleted only after the schema version is written, so if
+        migration is interrupted, it is repeated from the same data.
+        """
+        now = times.now()
+        identity_ids = self.storage.with_prefix('tasks:').keys()
+
+        # due keys of the previous version or of the interrupted migration, by identity
+        due_keys = {}
+        for key in self.storage.with_prefix('due:').keys():
+            due_keys.setdefault(key.rsplit(':', 2)[1], []).append('due:' + key)
+
+        for identity_id in identity_ids:
+            items = []
+            task_ids = set()
+            for task in self.storage.get('tasks:' + identity_id, []):
+                dt, about, task_identity_id = task[:3]
+                task_id = _make_task_id(about)
+                number = 0
+                while task_id in task_ids:
+                    number += 1
+                    task_id = _make_task_id(about, number)
+                task_ids.add(task_id)
+
+                task = (dt, about, task_identity_id, task_id)
+                items.append((_id_key(identity_id, task_id), task))
+                items.append((_time_key(task), task))
+                if dt > now:
+                    items.append((_due_key(task), task))
+
+            new_keys = set(key for key, task in items)
+            old_keys = list(due_keys.get(identity_id, []))
+            for prefix in ('id:{0}:', 'at:{0}:'):
+                prefix = prefix.format(identity_id)
+                old_keys.extend(prefix + key for key in self.storage.with_prefix(prefix).keys())
+            for key in old_keys:
+                if key not in new_keys:
+                    self.storage.pop(key, None)
+            self.storage.set_many(items)
+
+        self.storage['schema_version'] = SCHEMA_VERSION
+        for identity_id in identity_ids:
+            self.storage.pop('tasks:' + identity_id, None)
+
+    def _get_tasks(self, identity, offset=0, limit=None):
+        """Returns user's tasks, sorted by time.
+
+        Only tasks from the requested page are unpickled.
+        """
+        tasks = self.storage.with_prefix('at:{0}:'.format(identity.id))
+        keys = tasks.keys()[offset:None if limit is None else offset + limit]
+        found = tasks.get_many(keys)
+        return [found[key] for key in keys if key in found]
+
+    def _count_tasks(self, identity):
+        return len(self.storage.with_prefix('at:{0}:'.format(identity.id)))
+
+    def _get_task_ids(self, identity):
+        return self.storage.with_prefix('id:{0}:'.format(identity.id)).keys()
+
+    def _add_task(self, dt, about, identity, recurrence=None):
+        """Stores a new task and returns it.
+
+        Task's id is claimed atomically, so concurrent requests
+        with the same text get different ids.
+        """
+        number = 0
+        while True:
+            task = (dt, about, identity.id, _make_task_id(about, number))
+            if self.storage.add(_id_key(identity.id, task[3]), task):
+                break
+            number += 1
+
+        items = [(key, task) for key in _task_keys(task)[1:]]
+        if recurrence is not None:
+            items.append((_rule_key(identity.id, task[3]), recurrence))
+        self.storage.set_many(items)
+        return task
+
+    def _find_tasks(self, identity, prefix, limit=2):
+        """Returns up to `limit` tasks, which ids start from prefix."""
+        found = self.storage.scan(_id_key(identity.id, prefix), batch_size=limit)
+        return [task for key, task in itertools.islice(found, limit)]
 
     @on_command('remind( me)? at (?P<datetime>.+) to (?P<about>.+)')
     def remind(self, request, datetime, about):
@@ -64,74 +230,177 @@ class Plugin(ThreadedPlugin):
             tz = self._get_user_timezone(identity)
             dt = times.to_universal(dt, tz)
 
-            tasks = self._get_tasks(identity)
-            bisect.insort(tasks, (dt, about, identity.id))
-            self._set_tasks(identity, tasks)
+            self._add_task(dt, about, identity)
+            self.run_job_at(_to_timestamp(dt))
         except Exception as e:
             request.respond('Unable to parse a date: ' + six.text_type(e))
             raise
 
         request.respond('ok')
 
-    @on_command('my tasks')
-    def my_tasks(self, request):
+    @on_command('remind( me)? every (?P<period>[a-z]+) at (?P<datetime>.+) to (?P<about>.+)')
+    def remind_every(self, request, period, datetime, about):
+        """Remind about a TODO every day, weekday, week, monday and so on, starting from given time."""
+        if period not in PERIODS:
+            request.respond('Unknown period "{0}", use one of: {1}.'.format(period, ', '.join(sorted(PERIODS))))
+            return
+        self._add_recurring_task(request, PERIODS[period], 'every ' + period, datetime, about)
+
+    @on_command('remind( me)? by (?P<rule>RRULE:[^ ]+) at (?P<datetime>.+) to (?P<about>.+)')
+    def remind_by_rule(self, request, rule, datetime, about):
+        """Remind about a TODO by iCalendar's rule, like RRULE:FREQ=WEEKLY;BYDAY=MO,WE."""
+        self._add_recurring_task(request, rule, rule, datetime, about)
+
+    def _add_recurring_task(self, request, rule, description, datetime, about):
+        """Only the next reminder of recurring task is stored as a task,
+        the following one is added when it is sent.
+        """
+        identity = self.bot.get_plugin('identity').get_identity_by_request(request)
+        tz = self._get_user_timezone(identity)
+
+        try:
+            dtstart = parse(datetime)
+            recurrence = dict(rule=rule, description=description, dtstart=dtstart, timezone=tz)
+            # reminders could start in the past, but only future ones are sent
+            dt = _next_occurrence(
+                recurrence,
+                max(times.to_universal(dtstart, tz) - timedelta(seconds=1), times.now()),
+            )
+        except Exception as e:
+            request.respond('Unable to parse a rule or date: ' + six.text_type(e))
+            return
+
+        if dt is None:
+            request.respond('There are no reminders by this rule in the future.')
+            return
+
+        self._add_task(dt, about, identity, recurrence=recurrence)
+        self.run_job_at(_to_timestamp(dt))
+
+        request.respond('ok, first time is {0:%Y-%m-%d %H:%M}'.format(times.to_local(dt, tz)))
+
+    def _schedule_next_occurrence(self, task, now):
+        """Replaces sent reminder of recurring task with the next one. Returns new task or None."""
+        dt, about, identity_id, task_id = task
+        recurrence = self.storage.get(_rule_key(identity_id, task_id))
+        if recurrence is None:
+            return None
+
+        next_dt = _next_occurrence(recurrence, now)
+        if next_dt is None:
+            # the last reminder stays as a usual task
+            self.storage.pop(_rule_key(identity_id, task_id), None)
+            return None
+
+        new_task = (next_dt, about, identity_id, task_id)
+        id_key = _id_key(identity_id, task_id)
+
+        def replace_task(current):
+            if current is None:
+                return DELETE
+            # task could be done and added again with the same id
+            return new_task if current == task else current
+
+        # record is replaced only if user didn't mark the task as done
+        if self.storage.update(id_key, replace_task) != new_task:
+            return None
+
+        self.storage.pop(_time_key(task), None)
+        items = [(key, new_task) for key in _task_keys(new_task)[1:]]
+        self.storage.set_many(items)
+
+        # `done` could remove the record while these keys were written
+        if id_key not in self.storage:
+            for key, value in items:
+                self.storage.pop(key, None)
+            return None
+        return new_task
+
+    @on_command('my tasks( page (?P<page>[0-9]+))?')
+    def my_tasks(self, request, page=None):
         """Show my tasks"""
         identity = self.bot.get_plugin('identity').get_identity_by_request(request)
-        tasks = self._get_tasks(identity)
+        page = int(page or 1)
+        if page < 1:
+            request.respond('There is no page {0}.'.format(page))
+            return
+
+        tasks = self._get_tasks(identity, offset=(page - 1) * PAGE_SIZE, limit=PAGE_SIZE)
 
         if tasks:
             tz = self._get_user_timezone(identity)
-            hashes, min_len = _gen_hashes(tasks)
+            length = _unique_prefix_length(self._get_task_ids(identity))
+            recurrences = self.storage.get_many(_rule_key(identity.id, task[3]) for task in tasks)
 
             lines = []
-            for h, (dt, about, identity_id) in zip(hashes, tasks):
+            for dt, about, identity_id, task_id in tasks:
                 dt = times.to_local(dt, tz)
-                lines.append('{0}) {1:%Y-%m-%d %H:%M} {2}'.format(h[:min_len], dt, about))
+                line = '{0}) {1:%Y-%m-%d %H:%M} {2}'.format(task_id[:length], dt, about)
+                recurrence = recurrences.get(_rule_key(identity.id, task_id))
+                if recurrence is not None:
+                    line += ' ({0})'.format(recurrence['description'])
+                lines.append(line)
+
+            pages = (self._count_tasks(identity) + PAGE_SIZE - 1) // PAGE_SIZE
+            if pages > 1:
+                lines.append('Page {0} of {1}. Say "my tasks page N" to see others.'.format(page, pages))
 
             request.respond('\n'.join(lines))
+        elif page > 1:
+            request.respond('There is no page {0}.'.format(page))
         else:
             request.respond('You have no tasks')
 
     @on_command('(?P<task_id>[0-9a-z]{2,40}) done')
     def done(self, request, task_id):
         """Mark given task as done."""
-        # TODO add unittests for two cases:
-        # * when task_id not found
-        # * when there are more than one task which hash started from task_id
         identity = self.bot.get_plugin('identity').get_identity_by_request(request)
-        tasks = self._get_tasks(identity)
-
-        if tasks:
-            hashes, min_len = _gen_hashes(tasks)
-            filtered_tasks = []
-            for h, (dt, about, identity_id) in zip(hashes, tasks):
-                if not h.startswith(task_id):
-                    filtered_tasks.append((dt, about, identity_id))
-
-            self._set_tasks(identity, filtered_tasks)
+        found = self._find_tasks(identity, task_id)
+
+        if not found:
+            request.respond('Task {0} not found.'.format(task_id))
+            return
+        if len(found) > 1:
+            request.respond('There are few tasks with id {0}, please, use more symbols.'.format(task_id))
+            return
+
+        # reminder could be already sent, so some keys could be missing;
+        # the record is removed first, the next reminder relies on this
+        task = found[0]
+        for key in _task_keys(task) + (_rule_key(identity.id, task[3]),):
+            self.storage.pop(key, None)
         request.respond('done')
 
     def _remind_users_about_their_tasks(self):
+        """Sends reminders for due tasks and returns the time of the next one, or None.
+
+        Only the beginning of the due index is read, so this
+        does not depend on the number of users and their tasks.
+        """
         now = times.now()
-        tasks_storage = self.storage.with_prefix('tasks:')
         notify = self.bot.get_plugin('notify').notify
+        upcoming = []
+
+        for key, task in self.storage.scan('due:', batch_size=10):
+            dt, about, identity_id, task_id = task
+            if dt > now:
+                upcoming.append(dt)
+                break
+
+            notify(identity_id, 'TODO: {0} ({1})'.format(about, task_id[:4]))
+            # each reminder is sent once
+            self.storage.pop(key, None)
 
-        for identity_id, todos in tasks_storage.items():
-            idx = bisect.bisect_left(todos, (now, None, None))
-            to_remind = todos[:idx]
+            new_task = self._schedule_next_occurrence(task, now)
+            if new_task is not None:
+                upcoming.append(new_task[0])
 
-            for td, about, id_id in to_remind:
-                delta = (now - td)
-                if delta.seconds <= self.interval:
-                    # Remind only if reminder's datetime is between
-                    # this and previous checks
-                    notify(identity_id, 'TODO: {0} ({1})'.format(
-                        about,
-                        hashlib.sha1(about.encode('utf-8')).hexdigest()[:4]
-                    ))
+        return min(upcoming) if upcoming else None
 
     def do_job(self):
-        self._remind_users_about_their_tasks()
+        next_dt = self._remind_users_about_their_tasks()
+        if next_dt is not None:
+            self.run_job_at(_to_timestamp(next_dt))
 
     def _get_user_timezone(self, identity):
         settings = self.bot.get_plugin('settings')
@@ -0,0 +1,381 @@
+# coding: utf-8
+"""Performance benchmarks for TheBot.
+
+Run them like that:
+
+    python -m thebot.benchmarks --json results.json
+
+and compare with results of the previous release:
+
+    python -m thebot.benchmarks --compare previous.json
+
+All benchmarks use `BenchmarkAdapter`, which keeps messages in memory,
+so network is not involved. Storage is created in a temporary directory.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import thebot
+
+from thebot import Adapter, Plugin, Request, Storage, User, on_command, on_pattern
+from thebot.utils.stats import Histogram
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class BenchmarkAdapter(Adapter):
+    """Like `TestAdapter` from the unittests, but without test dependencies."""
+    name = 'test'
+
+    def __init__(self, *args, **kwargs):
+        super(BenchmarkAdapter, self).__init__(*args, **kwargs)
+        self._lines = []
+
+    def send(self, message, user=None, room=None, refer_by_name=None):
+        self._lines.append(message)
+
+    def write(self, input_line, user='some user'):
+        name = 'TheBot, '
+
+        if input_line.startswith(name):
+            self.callback(Request(self, input_line[len(name):], user=User(user), refer_by_name=True), direct=True)
+        else:
+            self.callback(Request(self, input_line, user=User(user)), direct=False)
+
+    def is_online(self, user):
+        return True
+
+
+def make_bot(workdir, plugins, adapters=(BenchmarkAdapter,), **config):
+    """Creates a bot, which keeps all it's files in the workdir."""
+    config_dict = dict(
+        unittest=True,
+        log_filename=os.path.join(workdir, 'thebot.log'),
+        pid_filename=os.path.join(workdir, 'thebot.pid'),
+        storage_filename=os.path.join(workdir, 'thebot.storage'),
+        rate_limit_user_burst=0,
+        rate_limit_room_burst=0,
+    )
+    config_dict.update(config)
+
+    return thebot.Bot(
+        adapters=list(adapters),
+        plugins=list(plugins),
+        config_dict=config_dict,
+        config_filename=os.path.join(workdir, 'unexistent.conf'),
+    )
+
+
+def make_plugin(idx, commands, reactions):
+    """Generates a plugin class with given number of commands and reactions."""
+    def make_callback(name):
+        def callback(self, request, **kwargs):
+            request.respond(name)
+        callback.__name__ = str(name)
+        return callback
+
+    attrs = dict(name='synthetic{0}'.format(idx))
+
+    for num in range(commands):
+        name = 'cmd_{0}_{1}'.format(idx, num)
+        attrs[name] = on_command('{0} (?P<arg>.+)'.format(name))(make_callback(name))
+
+    for num in range(reactions):
+        name = 'react_{0}_{1}'.format(idx, num)
+        attrs[name] = on_pattern('word{0}x{1}'.format(idx, num))(make_callback(name))
+
+    return type(Plugin)(str('SyntheticPlugin{0}'.format(idx)), (Plugin,), attrs)
+
+
+def make_messages(plugins, count, seed=42):
+    """Generates a realistic mix of messages.
+
+    Most of messages are direct commands, some are unknown commands
+    and the rest is a chatter in the room, which sometimes triggers reactions.
+    """
+    rnd = random.Random(seed)
+    commands = []
+    reactions = []
+
+    for plugin in plugins:
+        for name in sorted(dir(plugin)):
+            if name.startswith('cmd_'):
+                commands.append(name)
+            elif name.startswith('react_'):
+                reactions.append(name)
+
+    messages = []
+    for num in range(count):
+        dice = rnd.random()
+        if dice < 0.6 and commands:
+            messages.append(('TheBot, {0} some argument'.format(rnd.choice(commands)), True))
+        elif dice < 0.7:
+            messages.append(('TheBot, unknown command {0}'.format(rnd.randint(0, 100)), True))
+        elif dice < 0.8 and reactions:
+            _, plugin_idx, reaction_idx = rnd.choice(reactions).split('_')
+            messages.append(('I like word{0}x{1} very much'.format(plugin_idx, reaction_idx), False))
+        else:
+            messages.append(('just a chatter number {0}'.format(rnd.randint(0, 100)), False))
+
+    return messages
+
+
+def run_messages(bot, messages, users=1):
+    """Feeds messages into the bot and returns a dict with results."""
+    adapter = bot.get_adapter('test')
+    histogram = Histogram()
+
+    started_at = clock()
+    for idx, (message, direct) in enumerate(messages):
+        user = 'user{0}'.format(idx % users)
+        request_started_at = clock()
+        adapter.write(message, user=user)
+        histogram.record(clock() - request_started_at)
+        del adapter._lines[:]
+    elapsed = clock() - started_at
+
+    data = histogram.dump()
+    return dict(
+        messages=len(messages),
+        seconds=elapsed,
+        msgs_per_sec=len(messages) / elapsed if elapsed else None,
+        p50=data['p50'],
+        p99=data['p99'],
+        max=data['max'],
+    )
+
+
+def bench_dispatch(workdir, routes, count, match_cache_size=0):
+    """Dispatching through plugins with `routes` commands in total."""
+    per_plugin = 10
+    plugins = [
+        make_plugin(idx, commands=per_plugin, reactions=1)
+        for idx in range(max(1, routes // per_plugin))
+    ]
+    messages = make_messages(plugins, count)
+
+    bot = make_bot(workdir, plugins, match_cache_size=match_cache_size)
+    try:
+        return run_messages(bot, messages)
+    finally:
+        bot.close()
+
+
+def bench_startup(workdir, routes, repeat=5):
+    """Time to create a bot with `routes` commands."""
+    per_plugin = 10
+    plugins = [
+        make_plugin(idx, commands=per_plugin, reactions=1)
+        for idx in range(max(1, routes // per_plugin))
+    ]
+    histogram = Histogram()
+
+    for idx in range(repeat):
+        started_at = clock()
+        bot = make_bot(workdir, plugins)
+        histogram.record(clock() - started_at)
+        bot.close()
+
+    data = histogram.dump()
+    return dict(routes=routes, p50=data['p50'], min=data['min'], max=data['max'])
+
+
+def bench_storage_plugins(workdir, users, tasks_per_user, storage_url='', **config):
+    """Todo, settings and identity plugins on a scratch storage."""
+    if storage_url:
+        storage_url = storage_url.format(workdir=workdir)
+    bot = make_bot(workdir, ['todo'], storage_url=storage_url, **config)
+    try:
+        messages = []
+        for num in range(tasks_per_user):
+            messages.append(('TheBot, remind at 2030-01-{0:02d} 10:00 to do task {1}'.format(num % 28 + 1, num), True))
+        messages.append(('TheBot, set timezone Europe/Moscow', True))
+        messages.append(('TheBot, my tasks', True))
+        messages.append(('TheBot, show my accounts', True))
+        messages.append(('TheBot, now', True))
+
+        # each user sends whole sequence
+        all_messages = [
+            message
+            for message in messages
+                for user in range(users)
+        ]
+        result = run_messages(bot, all_messages, users=users)
+
+        plugin = bot.get_plugin('todo')
+        started_at = clock()
+        plugin._remind_users_about_their_tasks()
+        result['reminder_seconds'] = clock() - started_at
+        return result
+    finally:
+        bot.storage.clear()
+        bot.close()
+
+
+def bench_storage_reads(workdir, url, threads, keys=1000, reads=20000):
+    """Reads from the storage in many threads at once."""
+    storage = Storage(url.format(workdir=workdir))
+    try:
+        for idx in range(keys):
+            storage['key{0}'.format(idx)] = dict(idx=idx, payload='x' * 100)
+
+        def read(offset):
+            for idx in range(reads // threads):
+                storage['key{0}'.format((offset + idx) % keys)]
+
+        workers = [
+            threading.Thread(target=read, args=(num * keys // threads,))
+            for num in range(threads)
+        ]
+        started_at = clock()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = clock() - started_at
+
+        return dict(threads=threads, seconds=elapsed, reads_per_sec=reads / elapsed)
+    finally:
+        storage.close()
+
+
+def bench_codec(workdir, repeat=2000):
+    """Size and speed of the storage's codec, in comparison with plain pickles of 0.4.x."""
+    import datetime
+    from thebot.batteries.identity import Identity, Person
+    from thebot.storage import Codec, dumps, loads
+
+    adapter = BenchmarkAdapter.__new__(BenchmarkAdapter)
+    global_objects = dict(bot=object(), test=adapter)
+    codec = Codec(global_objects)
+
+    values = dict(
+        tasks=[
+            (datetime.datetime(2030, 1, idx % 28 + 1, 10, 0), 'do task number {0}'.format(idx), 'a' * 40)
+            for idx in range(20)
+        ],
+        setting='Europe/Moscow',
+        identity=Identity('a' * 40, [Person(adapter, 'user{0}'.format(idx)) for idx in range(3)]),
+    )
+
+    def measure(func):
+        started_at = clock()
+        for idx in range(repeat):
+            func()
+        return (clock() - started_at) / repeat
+
+    result = {}
+    for name, value in values.items():
+        old = dumps(value, global_objects=global_objects)
+        new = codec.dumps(value)
+        result[name] = dict(
+            old_bytes=len(old),
+            new_bytes=len(new),
+            old_dumps=measure(lambda: dumps(value, global_objects=global_objects)),
+            new_dumps=measure(lambda: codec.dumps(value)),
+            old_loads=measure(lambda: loads(old, global_objects=global_objects)),
+            new_loads=measure(lambda: codec.loads(new)),
+        )
+    return result
+
+
+BENCHMARKS = [
+    ('dispatch_10_routes', lambda workdir, args: bench_dispatch(workdir, 10, args.messages)),
+    ('dispatch_100_routes', lambda workdir, args: bench_dispatch(workdir, 100, args.messages)),
+    ('dispatch_1000_routes', lambda workdir, args: bench_dispatch(workdir, 1000, args.messages)),
+    ('dispatch_1000_routes_cached', lambda workdir, args: bench_dispatch(workdir, 1000, args.messages, match_cache_size=1024)),
+    ('startup_100_routes', lambda workdir, args: bench_startup(workdir, 100)),
+    ('startup_1000_routes', lambda workdir, args: bench_startup(workdir, 1000)),
+    ('storage_plugins', lambda workdir, args: bench_storage_plugins(workdir, args.users, args.tasks)),
+    ('storage_plugins_sqlite', lambda workdir, args: bench_storage_plugins(
+        workdir, args.users, args.tasks, storage_url='sqlite:///{workdir}/thebot.db')),
+    ('storage_reads_dbm_1_thread', lambda workdir, args: bench_storage_reads(
+        workdir, '{workdir}/thebot.storage', 1)),
+    ('storage_reads_dbm_4_threads', lambda workdir, args: bench_storage_reads(
+        workdir, '{workdir}/thebot.storage', 4)),
+    ('storage_reads_sqlite_1_thread', lambda workdir, args: bench_storage_reads(
+        workdir, 'sqlite:///{workdir}/thebot.db', 1)),
+    ('storage_reads_sqlite_4_threads', lambda workdir, args: bench_storage_reads(
+        workdir, 'sqlite:///{workdir}/thebot.db', 4)),
+    ('codec', lambda workdir, args: bench_codec(workdir)),
+    ('storage_plugins_write_behind', lambda workdir, args: bench_storage_plugins(
+        workdir, args.users, args.tasks, storage_write_delay=1)),
+]
+
+
+def run(args):
+    results = dict(
+        meta=dict(
+            python=platform.python_version(),
+            implementation=platform.python_implementation(),
+            messages=args.messages,
+            users=args.users,
+            tasks=args.tasks,
+            created_at=time.time(),
+        ),
+        benchmarks={},
+    )
+
+    for name, func in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+
+        workdir = tempfile.mkdtemp(prefix='thebot-bench-')
+        try:
+            results['benchmarks'][name] = func(workdir, args)
+        finally:
+            shutil.rmtree(workdir)
+
+        print('{0}: {1}'.format(name, json.dumps(results['benchmarks'][name], sort_keys=True)))
+
+    return results
+
+
+def compare(results, previous):
+    """Prints relative change of each metric in comparison with previous results."""
+    for name, data in sorted(results['benchmarks'].items()):
+        old = previous.get('benchmarks', {}).get(name)
+        if old is None:
+            continue
+
+        changes = []
+        for key, value in sorted(data.items()):
+            old_value = old.get(key)
+            if isinstance(value, (int, float)) and isinstance(old_value, (int, float)) and old_value:
+                changes.append('{0} {1:+.1f}%'.format(key, (value - old_value) * 100.0 / old_value))
+        print('{0}: {1}'.format(name, ', '.join(changes)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='TheBot\'s benchmarks.')
+    parser.add_argument('--messages', default=5000, type=int, help='Number of messages for dispatch benchmarks.')
+    parser.add_argument('--users', default=20, type=int, help='Number of users for storage benchmark.')
+    parser.add_argument('--tasks', default=20, type=int, help='Number of tasks per user for storage benchmark.')
+    parser.add_argument('--only', action='append', help='Run only given benchmark. Could be used many times.')
+    parser.add_argument('--json', help='Write results to this file.')
+    parser.add_argument('--compare', help='Compare results with results from this file.')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
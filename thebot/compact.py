@@ -0,0 +1,40 @@
+# coding: utf-8
+"""Compacts TheBot's storage or makes it's backup.
+
+    python -m thebot.compact thebot.storage
+    python -m thebot.compact sqlite:///thebot.db --snapshot backup.db
+
+Storage in SQLite could be processed while bot is running,
+but bot's writes will wait until compaction is finished.
+dbm files should be processed only when the bot is stopped,
+use `compact storage` and `backup storage` commands
+from the `admin` plugin instead.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import sys
+
+from thebot.storage import get_backend
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compacts TheBot\'s storage or makes it\'s backup.')
+    parser.add_argument('storage', help='Filename or URL of the storage, like sqlite:///thebot.db.')
+    parser.add_argument('--snapshot', help='Instead of compaction, save a copy of the storage into this file.')
+    args = parser.parse_args(argv)
+
+    backend = get_backend(args.storage)
+    try:
+        if args.snapshot:
+            count = backend.snapshot(args.snapshot)
+            print('{0} keys were saved to {1}.'.format(count, ', '.join(backend.get_files(args.snapshot))))
+        else:
+            result = backend.compact()
+            print('Storage was compacted from {before} to {after} bytes.'.format(**result))
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,36 @@
+# coding: utf-8
+"""Copies TheBot's storage into another backend.
+
+For example, to move from the dbm file to SQLite:
+
+    python -m thebot.migrate thebot.storage sqlite:///thebot.db
+
+and then start the bot with `--storage-url sqlite:///thebot.db`.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import argparse
+import sys
+
+from thebot.storage import get_backend, migrate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Copies TheBot\'s storage into another backend.')
+    parser.add_argument('source', help='Filename or URL of the storage to copy from.')
+    parser.add_argument('destination', help='Filename or URL of the storage to copy to, like sqlite:///thebot.db.')
+    args = parser.parse_args(argv)
+
+    source = get_backend(args.source)
+    destination = get_backend(args.destination)
+    try:
+        count = migrate(source, destination)
+    finally:
+        source.close()
+        destination.close()
+
+    print('{0} keys were copied.'.format(count))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
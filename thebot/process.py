@@ -0,0 +1,170 @@
+# coding: utf-8
+"""Execution of CPU heavy callbacks in a pool of processes.
+
+Callbacks, decorated with `in_process`, are called in a child process.
+Request and arguments are pickled with TheBot's Pickler, so adapters
+are passed by their names. In the child, each adapter is replaced
+with a `Recorder`, which remembers all calls, like `send`. These calls
+are pickled back and replayed on real adapters in the main process,
+so `request.respond` reaches the right adapter.
+
+Child process has no access to the bot, storage and other plugins,
+plugin's `bot` and `storage` attributes raise an error there.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import importlib
+import logging
+import multiprocessing
+import threading
+import traceback
+
+from .storage import Stub, dumps, loads
+
+
+def in_process(func):
+    """Decorator to mark plugin's callback to be called in a process pool.
+
+    Use it together with `on_command` or `on_pattern`.
+
+    Callback gets only the request and arguments from the pattern.
+    Plugin is created without `__init__`, and any use of `self.bot` or
+    `self.storage` raises RuntimeError, so save results with another
+    callback, running in the main process.
+    """
+    func._in_process = True
+    return func
+
+
+class _Unavailable(object):
+    """Replaces plugin's attributes, which are not available in the child process."""
+    def __init__(self, name):
+        self._name = name
+
+    def _fail(self, *args, **kwargs):
+        raise RuntimeError(
+            '{0} is not available in callbacks, decorated with in_process. '
+            'They can use only the request and arguments.'.format(self._name)
+        )
+
+    def __getattr__(self, attr):
+        self._fail()
+
+    __call__ = __getitem__ = __setitem__ = __delitem__ = __contains__ = __iter__ = __len__ = _fail
+
+
+def _make_recorder(name, calls):
+    class Recorder(Stub):
+        """Replaces an adapter in the child process and records all method calls."""
+        def __getattr__(self, attr):
+            def method(*args, **kwargs):
+                calls.append((self, attr, args, kwargs))
+            return method
+
+    return Recorder(name)
+
+
+class _Recorders(object):
+    """A replacement for global objects, which returns a Recorder for each name."""
+    def __init__(self, calls):
+        self.calls = calls
+        self.recorders = {}
+
+    def __getitem__(self, name):
+        recorder = self.recorders.get(name)
+        if recorder is None:
+            recorder = self.recorders[name] = _make_recorder(name, self.calls)
+        return recorder
+
+
+def _call_in_child(module_name, class_name, plugin_name, method_name, payload):
+    """This function is executed in the child process."""
+    calls = []
+    global_objects = _Recorders(calls)
+
+    try:
+        request, kwargs = loads(payload, global_objects=global_objects)
+
+        cls = getattr(importlib.import_module(module_name), class_name)
+        plugin = cls.__new__(cls)
+        plugin.name = plugin_name
+        plugin.bot = _Unavailable('plugin.bot')
+        plugin.storage = _Unavailable('plugin.storage')
+        plugin.logger = logging.getLogger('thebot.plugin.' + plugin_name)
+
+        result = getattr(plugin, method_name)(request, **kwargs)
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+
+    return dumps((calls, result, error))
+
+
+def _get_context():
+    """Returns multiprocessing context, which does not fork the bot itself.
+
+    Bot has running threads, and a forked child could get
+    their locks in the acquired state.
+    """
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        # Python 2 can only fork
+        return multiprocessing
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return get_context('forkserver')
+    return get_context('spawn')
+
+
+class ProcessPool(object):
+    """Calls plugins' callbacks in the pool of processes.
+
+    Pool is created on the first call.
+    """
+    def __init__(self, bot, processes=None):
+        self.bot = bot
+        self.processes = processes
+        self.logger = logging.getLogger('thebot.core.process')
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = _get_context().Pool(processes=self.processes)
+            return self._pool
+
+    def call(self, callback, request, kwargs):
+        """Calls callback in a child process and replays all it's calls to adapters."""
+        global_objects = self.bot.storage.global_objects
+        plugin = callback.__self__
+        cls = plugin.__class__
+
+        try:
+            payload = dumps((request, kwargs), global_objects=global_objects)
+        except Exception:
+            self.logger.warning(
+                'Unable to pickle request {0}, calling {1} in the main process'.format(request, callback.__name__),
+                exc_info=True,
+            )
+            return callback(request, **kwargs)
+
+        data = self._get_pool().apply(
+            _call_in_child,
+            (cls.__module__, cls.__name__, plugin.name, callback.__name__, payload),
+        )
+        calls, result, error = loads(data, global_objects=global_objects)
+
+        for obj, method, args, kw in calls:
+            getattr(obj, method)(*args, **kw)
+
+        if error is not None:
+            raise RuntimeError('Error in the child process:\n' + error)
+        return result
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -0,0 +1,1527 @@
+# coding: utf-8
+"""TheBot's memory.
+
+Values are pickled with a custom `Pickler`, which replaces
+references to the bot and adapters with their names. This way
+they are restored on unpickling even after the restart.
+
+Pickled values are kept in one of the backends:
+
+* `dbm` — a file in the format of Python's `shelve` module.
+  It is used by default, with `--storage-filename` option.
+* `sqlite` — an SQLite database in the WAL mode, it allows many
+  concurrent readers. Use it with `--storage-url sqlite:///thebot.db`.
+
+Existing storage could be copied into another backend
+with `python -m thebot.migrate`.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import bisect
+import datetime
+import itertools
+import logging
+import os
+import pickle
+import six
+import struct
+import sys
+import threading
+import time
+import weakref
+
+from . import utils
+from .utils.lru import LRUCache
+from .utils.rwlock import RWLock
+from .utils.stats import Histogram
+
+
+@utils.printable
+class Stub(object):
+    """A stub class to replace objects which can't be unpickled.
+
+    It allows to call any method or access any attribute.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, name):
+        return Stub(self.name + '.' + name)
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+    def __unicode__(self):
+        return self.name
+
+
+def get_persistent_ids(global_objects):
+    """Returns a map id(obj) -> name, used by the Pickler."""
+    return dict(
+        (id(obj), persistent_id)
+        for persistent_id, obj in (global_objects or {}).items()
+    )
+
+
+class Pickler(pickle.Pickler):
+    def __init__(self, file, protocol=None, global_objects=None, persistent_ids=None):
+        pickle.Pickler.__init__(self, file, protocol=protocol)
+        if persistent_ids is None:
+            persistent_ids = get_persistent_ids(global_objects)
+        self._persistent_ids = persistent_ids
+
+    def persistent_id(self, obj):
+        persistent_id = self._persistent_ids.get(id(obj))
+        if persistent_id is None and isinstance(obj, Stub):
+            return obj.name
+        return persistent_id
+
+
+class Unpickler(pickle.Unpickler):
+    """A custom unpickler, to restore references to adapters, plugins and the bot."""
+    def __init__(self, file, global_objects=None):
+        pickle.Unpickler.__init__(self, file)
+        self._global_objects = global_objects or {}
+
+    def persistent_load(self, obj_id):
+        try:
+            return self._global_objects[obj_id]
+        except KeyError:
+            return Stub(obj_id)
+
+
+_MISSING = object()
+
+# return this from `Storage.update`'s function to delete the value
+DELETE = object()
+
+
+def dumps(obj, global_objects=None):
+    f = six.BytesIO()
+    Pickler(f, protocol=2, global_objects=global_objects).dump(obj)
+    return f.getvalue()
+
+
+def loads(data, global_objects=None):
+    return Unpickler(six.BytesIO(data), global_objects=global_objects).load()
+
+
+_PLAIN_TYPES = frozenset(
+    (six.text_type, six.binary_type, float, bool, type(None),
+     datetime.datetime, datetime.date, datetime.timedelta) + six.integer_types
+)
+
+
+def _is_plain(value):
+    """Checks if value consists only of builtin types and can't refer to the bot or adapters."""
+    value_type = type(value)
+    if value_type in _PLAIN_TYPES:
+        return True
+    if value_type is list or value_type is tuple:
+        for item in value:
+            if not _is_plain(item):
+                return False
+        return True
+    if value_type is dict:
+        for key, item in value.items():
+            if not (_is_plain(key) and _is_plain(item)):
+                return False
+        return True
+    return False
+
+
+class Codec(object):
+    """Converts values to bytes and back.
+
+    Values are stored with a header: zero byte and format's version.
+    Version 1 has a tag after the header:
+
+    * `s` — a text, encoded to UTF-8;
+    * `p` — a plain pickle, for values built from lists, tuples, dicts,
+      strings, numbers and datetimes. They are unpickled without
+      a custom Unpickler;
+    * `o` — a pickle with references to the bot and adapters;
+    * `t` — a value with expiration time: 8 bytes with a timestamp
+      in milliseconds, followed by the value's data.
+
+    Data without a header is a pickle, written by previous versions.
+    """
+    VERSION = 1
+    HEADER = b'\x00' + six.int2byte(VERSION)
+    PROTOCOL = min(pickle.HIGHEST_PROTOCOL, 4)
+
+    def __init__(self, global_objects=None):
+        self.global_objects = global_objects or {}
+        # this map is built once, not on every write
+        self.persistent_ids = get_persistent_ids(self.global_objects)
+
+    def dumps(self, value):
+        if type(value) is six.text_type:
+            return self.HEADER + b's' + value.encode('utf-8')
+
+        if _is_plain(value):
+            return self.HEADER + b'p' + pickle.dumps(value, self.PROTOCOL)
+
+        f = six.BytesIO()
+        f.write(self.HEADER + b'o')
+        Pickler(f, protocol=self.PROTOCOL, persistent_ids=self.persistent_ids).dump(value)
+        return f.getvalue()
+
+    def loads(self, data):
+        if data[:1] != b'\x00':
+            return loads(data, global_objects=self.global_objects)
+
+        if data[:2] != self.HEADER:
+            raise ValueError('Unknown storage format version {0}.'.format(six.byte2int(data[1:2])))
+
+        tag = data[2:3]
+        if tag == b's':
+            return data[3:].decode('utf-8')
+        if tag == b'p':
+            return pickle.loads(data[3:])
+        if tag == b'o':
+            return Unpickler(six.BytesIO(data[3:]), global_objects=self.global_objects).load()
+        if tag == b't':
+            return self.loads(data[11:])
+        raise ValueError('Unknown value type {0!r}.'.format(tag))
+
+    def add_expiry(self, data, expires_at):
+        """Marks encoded value to expire at given timestamp in milliseconds."""
+        return self.HEADER + b't' + struct.pack('>Q', expires_at) + data
+
+    def get_expiry(self, data):
+        """Returns expiration timestamp in milliseconds or None."""
+        if data[:3] != self.HEADER + b't':
+            return None
+        return struct.unpack('>Q', data[3:11])[0]
+
+
+class Backend(object):
+    """Base class for storage backends.
+
+    Backend keeps pickled values as bytes, under string keys.
+    `keys` and `count` should not scan keys without given prefix.
+    """
+    def get(self, key):
+        """Returns value or raises KeyError."""
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Removes a key or raises KeyError."""
+        raise NotImplementedError()
+
+    def contains(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def keys(self, prefix=''):
+        """Returns sorted list of keys, starting from prefix."""
+        raise NotImplementedError()
+
+    def count(self, prefix=''):
+        return len(self.keys(prefix))
+
+    def get_many(self, keys):
+        """Returns a dict with values of existing keys."""
+        result = {}
+        for key in keys:
+            try:
+                result[key] = self.get(key)
+            except KeyError:
+                pass
+        return result
+
+    def scan(self, prefix='', batch_size=100):
+        """Yields pairs (key, value) for keys with given prefix, in sorted order.
+
+        Values are read by batches.
+        """
+        keys = self.keys(prefix)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            values = self.get_many(batch)
+            for key in batch:
+                if key in values:
+                    yield key, values[key]
+
+    def compare_and_set(self, key, expected, value):
+        """Atomically sets key to value, if it's current value is `expected`.
+
+        None as `expected` means that key should not exist,
+        None as `value` removes the key. Returns True on success.
+        """
+        raise NotImplementedError()
+
+    def snapshot(self, filename):
+        """Writes a consistent copy of all data into a new file and returns number of keys.
+
+        Writes are not blocked while copy is made.
+        """
+        raise NotImplementedError()
+
+    def get_files(self, filename):
+        """Returns paths of existing files of the database with given name, like a snapshot."""
+        if os.path.exists(filename):
+            return [filename]
+        return []
+
+    def compact(self):
+        """Rewrites data to free space, occupied by deleted and overwritten values.
+
+        Returns a dict with file sizes before and after.
+        """
+        raise NotImplementedError()
+
+    def write_batch(self, items, sync=False):
+        """Writes pairs (key, value) at once. None value means deletion.
+
+        Data is flushed to the disk only if `sync` is True.
+        """
+        for key, value in items:
+            if value is None:
+                try:
+                    self.delete(key)
+                except KeyError:
+                    pass
+            else:
+                self.set(key, value)
+        if sync:
+            self.sync()
+
+    def sync(self):
+        """Flushes data to the disk."""
+
+    def get_stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+# files, created by different dbm modules
+_DBM_SUFFIXES = ('', '.db', '.dat', '.dir', '.bak', '.pag')
+
+# os.rename can't overwrite files on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _get_dbm_files(filename):
+    """Returns pairs (path, suffix) for existing files of the dbm database."""
+    return [
+        (filename + suffix, suffix)
+        for suffix in _DBM_SUFFIXES
+            if os.path.exists(filename + suffix)
+    ]
+
+
+def _get_dbm_path(filename):
+    """Returns path of the current dbm database.
+
+    Compaction writes data into a new generation of files, like
+    thebot.storage.gen1.dat, and switches to it by renaming
+    a pointer file thebot.storage.current, which keeps generation's name.
+    """
+    try:
+        with open(filename + '.current') as f:
+            return os.path.join(os.path.dirname(filename), f.read().strip())
+    except (IOError, OSError):
+        return filename
+
+
+def _get_dbm_generation(filename, path):
+    if path == filename:
+        return 0
+    return int(path.rsplit('.gen', 1)[1])
+
+
+class DbmBackend(Backend):
+    """Keeps data in a dbm file, like `shelve` does.
+
+    Also it keeps a sorted list of keys, to find keys
+    with given prefix without scanning whole database.
+
+    dbm modules are not thread-safe, so all access goes through
+    a readers-writer lock: many threads can read at once, but
+    only one can write.
+
+    While a snapshot is made, each write saves the key's previous value
+    into `_shadow`, so snapshot sees data as it was at the start.
+    """
+    def __init__(self, filename):
+        try:
+            import anydbm as dbm
+        except ImportError:
+            import dbm
+
+        self.filename = filename
+        self.path = _get_dbm_path(filename)
+        self._dbm = dbm
+        self.dict = dbm.open(self.path, 'c')
+        self._lock = RWLock()
+        self._snapshot_lock = threading.Lock()
+        self._shadow = None
+
+        keys = self.dict.keys()
+        if six.PY3:
+            keys = (key.decode('utf-8') for key in keys)
+        self._keys = sorted(keys)
+
+    def _prefix_range(self, prefix, after=None):
+        """Returns indices of the first and after the last key with given prefix.
+
+        If `after` is given, range starts from the next key.
+        """
+        if after is None:
+            start = bisect.bisect_left(self._keys, prefix)
+        else:
+            start = bisect.bisect_right(self._keys, after)
+
+        end_key = _next_prefix(prefix)
+        if end_key is None:
+            return start, len(self._keys)
+        return start, max(start, bisect.bisect_left(self._keys, end_key, start))
+
+    def get(self, key):
+        with self._lock.reading():
+            return self.dict[key]
+
+    def get_many(self, keys):
+        result = {}
+        with self._lock.reading():
+            for key in keys:
+                try:
+                    result[key] = self.dict[key]
+                except KeyError:
+                    pass
+        return result
+
+    def _save_to_shadow(self, key):
+        if self._shadow is not None and key not in self._shadow:
+            try:
+                self._shadow[key] = self.dict[key]
+            except KeyError:
+                self._shadow[key] = None
+
+    def _set(self, key, value):
+        self._save_to_shadow(key)
+        self.dict[key] = value
+
+        idx = bisect.bisect_left(self._keys, key)
+        if idx == len(self._keys) or self._keys[idx] != key:
+            self._keys.insert(idx, key)
+
+    def _delete(self, key):
+        if key in self.dict:
+            self._save_to_shadow(key)
+        del self.dict[key]
+
+        idx = bisect.bisect_left(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            del self._keys[idx]
+
+    def set(self, key, value):
+        with self._lock.writing():
+            self._set(key, value)
+
+    def delete(self, key):
+        with self._lock.writing():
+            self._delete(key)
+
+    def compare_and_set(self, key, expected, value):
+        with self._lock.writing():
+            try:
+                current = self.dict[key]
+            except KeyError:
+                current = None
+
+            if current != expected:
+                return False
+
+            if value is not None:
+                self._set(key, value)
+            elif current is not None:
+                self._delete(key)
+            return True
+
+    def write_batch(self, items, sync=False):
+        with self._lock.writing():
+            for key, value in items:
+                if value is None:
+                    try:
+                        self._delete(key)
+                    except KeyError:
+                        pass
+                else:
+                    self._set(key, value)
+            if sync:
+                self._sync()
+
+    def scan(self, prefix='', batch_size=100):
+        after = None
+        while True:
+            with self._lock.reading():
+                start, end = self._prefix_range(prefix, after)
+                batch = [
+                    (key, self.dict[key])
+                    for key in self._keys[start:min(end, start + batch_size)]
+                ]
+
+            for item in batch:
+                yield item
+            if len(batch) < batch_size:
+                return
+            after = batch[-1][0]
+
+    def contains(self, key):
+        with self._lock.reading():
+            idx = bisect.bisect_left(self._keys, key)
+            return idx < len(self._keys) and self._keys[idx] == key
+
+    def keys(self, prefix=''):
+        with self._lock.reading():
+            start, end = self._prefix_range(prefix)
+            return self._keys[start:end]
+
+    def count(self, prefix=''):
+        with self._lock.reading():
+            start, end = self._prefix_range(prefix)
+            return end - start
+
+    def _sync(self):
+        if hasattr(self.dict, 'sync'):
+            self.dict.sync()
+
+    def sync(self):
+        with self._lock.writing():
+            self._sync()
+
+    def _get_size(self):
+        return sum(os.path.getsize(path) for path, suffix in _get_dbm_files(self.path))
+
+    def _copy_snapshot(self, target, batch_size=500):
+        """Copies data as it was when this method was called.
+
+        Should be called with `_snapshot_lock` acquired.
+        """
+        with self._lock.writing():
+            self._shadow = {}
+            keys = list(self._keys)
+
+        try:
+            for start in range(0, len(keys), batch_size):
+                items = []
+                with self._lock.reading():
+                    for key in keys[start:start + batch_size]:
+                        value = self._shadow[key] if key in self._shadow else self.dict[key]
+                        if value is not None:
+                            items.append((key, value))
+                target.write_batch(items)
+        except Exception:
+            with self._lock.writing():
+                self._shadow = None
+            raise
+        return len(keys)
+
+    def snapshot(self, filename):
+        with self._snapshot_lock:
+            target = DbmBackend(filename)
+            try:
+                return self._copy_snapshot(target)
+            finally:
+                target.close()
+                with self._lock.writing():
+                    self._shadow = None
+
+    def get_files(self, filename):
+        # dbm modules add their own suffixes, like .dat and .dir
+        return [path for path, suffix in _get_dbm_files(filename)]
+
+    def compact(self):
+        """Copies data into a new generation of files and switches to it.
+
+        dbm could consist of many files, like thebot.storage.dat and thebot.storage.dir,
+        so they are not replaced one by one. Instead, the pointer file is replaced
+        with one rename, and a crash leaves either old or new database.
+        """
+        # unsynced changes are not in the files yet
+        self.sync()
+        before = self._get_size()
+
+        with self._snapshot_lock:
+            new_path = '{0}.gen{1}'.format(self.filename, _get_dbm_generation(self.filename, self.path) + 1)
+            pointer = self.filename + '.current'
+
+            # removing leftovers of the failed compaction
+            for path, suffix in _get_dbm_files(new_path):
+                os.unlink(path)
+
+            target = DbmBackend(new_path)
+            try:
+                self._copy_snapshot(target)
+
+                with self._lock.writing():
+                    # writing changes, made during the copying
+                    changes = [
+                        (key, self.dict[key] if key in self.dict else None)
+                        for key in self._shadow
+                    ]
+                    self._shadow = None
+                    target.write_batch(changes)
+                    target.close()
+                    self.dict.close()
+
+                    old_path = self.path
+                    try:
+                        with open(pointer + '.tmp', 'w') as f:
+                            f.write(os.path.basename(new_path))
+                            f.flush()
+                            os.fsync(f.fileno())
+                        _replace(pointer + '.tmp', pointer)
+                        self.path = new_path
+                    finally:
+                        self.dict = self._dbm.open(self.path, 'c')
+            except Exception:
+                target.close()
+                with self._lock.writing():
+                    self._shadow = None
+                raise
+
+            # old generation is not used anymore
+            for path, suffix in _get_dbm_files(old_path):
+                os.unlink(path)
+
+        return dict(before=before, after=self._get_size())
+
+    def close(self):
+        with self._lock.writing():
+            self.dict.close()
+
+
+def _next_prefix(prefix):
+    """Returns the smallest string, greater than all strings with given prefix.
+
+    Returns None if there is no such string.
+    """
+    if isinstance(prefix, six.binary_type):
+        prefix = prefix.rstrip(b'\xff')
+        if not prefix:
+            return None
+        return prefix[:-1] + six.int2byte(six.byte2int(prefix[-1:]) + 1)
+
+    while prefix and prefix[-1] == six.unichr(sys.maxunicode):
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + six.unichr(ord(prefix[-1]) + 1)
+
+
+class _ThreadConnection(object):
+    """Holds thread's connection in a thread-local storage.
+
+    When the thread ends, it's local data is deleted,
+    and the connection is closed.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __del__(self):
+        self.connection.close()
+
+
+class SQLiteBackend(Backend):
+    """Keeps data in an SQLite database.
+
+    Database works in the WAL mode, each thread has it's own
+    connection, so readers don't wait for each other and for
+    the writer. Writes are serialized with a lock.
+
+    Adapters could start a thread for each message, so connection
+    lives only while it's thread is alive.
+
+    Connections use synchronous=NORMAL, so single writes are not
+    fsynced and the last of them could be lost on a power failure.
+    `write_batch` with `sync=True`, which is used by write-behind
+    flushes, fsyncs the WAL once for the whole batch.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+        # weak references, to not keep connections of finished threads
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+        with self._write_lock:
+            self._connect().execute(
+                'CREATE TABLE IF NOT EXISTS storage ('
+                '  key TEXT PRIMARY KEY,'
+                '  value BLOB NOT NULL'
+                ')'
+            )
+
+    def _connect(self):
+        holder = getattr(self._local, 'connection', None)
+        if holder is None:
+            import sqlite3
+
+            # isolation_level=None turns on autocommit mode
+            connection = sqlite3.connect(
+                self.filename,
+                timeout=30,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            holder = self._local.connection = _ThreadConnection(connection)
+
+            with self._connections_lock:
+                self._connections.add(holder)
+        return holder.connection
+
+    @staticmethod
+    def _text(key):
+        if isinstance(key, six.binary_type):
+            return key.decode('utf-8')
+        return key
+
+    @staticmethod
+    def _prefix_condition(prefix):
+        """Returns SQL condition and parameters, to select keys by prefix with the index."""
+        next_prefix = _next_prefix(prefix)
+        if next_prefix is None:
+            return 'key >= ?', (prefix,)
+        return 'key >= ? AND key < ?', (prefix, next_prefix)
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM storage WHERE key = ?', (self._text(key),)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return bytes(row[0])
+
+    def get_many(self, keys):
+        keys = [self._text(key) for key in keys]
+        result = {}
+        connection = self._connect()
+        # SQLite limits number of parameters in one query
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = connection.execute(
+                'SELECT key, value FROM storage WHERE key IN ({0})'.format(', '.join('?' * len(batch))),
+                batch,
+            )
+            for key, value in rows:
+                result[key] = bytes(value)
+        return result
+
+    def scan(self, prefix='', batch_size=100):
+        condition, params = self._prefix_condition(self._text(prefix))
+        connection = self._connect()
+        last_key = None
+
+        # each batch is selected by a separate query, starting
+        # after the last key, so we don't keep a cursor open
+        while True:
+            if last_key is None:
+                query, query_params = condition, params
+            else:
+                query, query_params = condition + ' AND key > ?', params + (last_key,)
+
+            rows = connection.execute(
+                'SELECT key, value FROM storage WHERE ' + query + ' ORDER BY key LIMIT ?',
+                query_params + (batch_size,),
+            ).fetchall()
+
+            for key, value in rows:
+                yield key, bytes(value)
+
+            if len(rows) < batch_size:
+                break
+            last_key = rows[-1][0]
+
+    def set(self, key, value):
+        import sqlite3
+
+        with self._write_lock:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO storage (key, value) VALUES (?, ?)',
+                (self._text(key), sqlite3.Binary(value)),
+            )
+
+    def delete(self, key):
+        with self._write_lock:
+            cursor = self._connect().execute(
+                'DELETE FROM storage WHERE key = ?', (self._text(key),)
+            )
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def compare_and_set(self, key, expected, value):
+        import sqlite3
+
+        key = self._text(key)
+        with self._write_lock:
+            connection = self._connect()
+            # IMMEDIATE takes a write lock on the database, so other processes
+            # can't change the value between SELECT and UPDATE
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT value FROM storage WHERE key = ?', (key,)).fetchone()
+                current = bytes(row[0]) if row is not None else None
+
+                if current != expected:
+                    result = False
+                elif value is None:
+                    connection.execute('DELETE FROM storage WHERE key = ?', (key,))
+                    result = True
+                else:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO storage (key, value) VALUES (?, ?)',
+                        (key, sqlite3.Binary(value)),
+                    )
+                    result = True
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            else:
+                connection.execute('COMMIT')
+        return result
+
+    def _get_size(self):
+        return sum(
+            os.path.getsize(self.filename + suffix)
+            for suffix in ('', '-wal')
+                if os.path.exists(self.filename + suffix)
+        )
+
+    def snapshot(self, filename):
+        import sqlite3
+
+        connection = self._connect()
+        count = connection.execute('SELECT COUNT(*) FROM storage').fetchone()[0]
+        if sqlite3.sqlite_version_info >= (3, 27, 0):
+            # makes a copy in one read transaction, which does not block writers in WAL mode
+            connection.execute('VACUUM INTO ?', (filename,))
+        else:
+            target = sqlite3.connect(filename)
+            try:
+                connection.backup(target)
+            finally:
+                target.close()
+        return count
+
+    def compact(self):
+        """Runs VACUUM. Reads are not blocked, but writes wait until it is finished."""
+        before = self._get_size()
+        with self._write_lock:
+            connection = self._connect()
+            # VACUUM rebuilds database in a temporary file and copies it back in one transaction
+            connection.execute('VACUUM')
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return dict(before=before, after=self._get_size())
+
+    def write_batch(self, items, sync=False):
+        # all items are written in one transaction, so with sync=True there is only one fsync
+        with self._write_lock:
+            connection = self._connect()
+            if sync:
+                connection.execute('PRAGMA synchronous=FULL')
+            try:
+                self._write_batch(connection, items)
+            finally:
+                if sync:
+                    connection.execute('PRAGMA synchronous=NORMAL')
+
+    def _write_batch(self, connection, items):
+        import sqlite3
+
+        connection.execute('BEGIN')
+        try:
+            for key, value in items:
+                if value is None:
+                    connection.execute('DELETE FROM storage WHERE key = ?', (self._text(key),))
+                else:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO storage (key, value) VALUES (?, ?)',
+                        (self._text(key), sqlite3.Binary(value)),
+                    )
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    def contains(self, key):
+        return self._connect().execute(
+            'SELECT 1 FROM storage WHERE key = ?', (self._text(key),)
+        ).fetchone() is not None
+
+    def keys(self, prefix=''):
+        condition, params = self._prefix_condition(self._text(prefix))
+        return [
+            row[0]
+            for row in self._connect().execute(
+                'SELECT key FROM storage WHERE ' + condition + ' ORDER BY key', params
+            )
+        ]
+
+    def count(self, prefix=''):
+        condition, params = self._prefix_condition(self._text(prefix))
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM storage WHERE ' + condition, params
+        ).fetchone()[0]
+
+    def close(self):
+        with self._connections_lock:
+            for holder in list(self._connections):
+                holder.connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class WriteBehindBackend(Backend):
+    """Keeps writes in memory and flushes them to another backend in batches.
+
+    Repeated writes to the same key are coalesced. Batch is written when
+    it is `delay` seconds old or has `max_pending` keys, and on close.
+    Reads see pending writes.
+    """
+    def __init__(self, backend, delay=1.0, max_pending=1000):
+        self.backend = backend
+        self.delay = delay
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # a map key -> value, None means that key was deleted
+        self._pending = {}
+        # a batch, which is being written right now
+        self._flushing = {}
+
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.flush_time = Histogram()
+
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='thebot.storage.flusher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed.wait(self.delay):
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger('thebot.storage').exception('Unable to flush storage')
+
+    def _lookup(self, key):
+        """Returns pending value, None for deleted key or _MISSING."""
+        with self._lock:
+            for items in (self._pending, self._flushing):
+                if key in items:
+                    return items[key]
+        return _MISSING
+
+    def get(self, key):
+        value = self._lookup(key)
+        if value is _MISSING:
+            return self.backend.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def contains(self, key):
+        value = self._lookup(key)
+        if value is _MISSING:
+            return self.backend.contains(key)
+        return value is not None
+
+    def get_many(self, keys):
+        result = {}
+        missing = []
+        for key in keys:
+            value = self._lookup(key)
+            if value is _MISSING:
+                missing.append(key)
+            elif value is not None:
+                result[key] = value
+        if missing:
+            result.update(self.backend.get_many(missing))
+        return result
+
+    def _write(self, key, value, expected=_MISSING):
+        with self._lock:
+            if expected is not _MISSING:
+                current = _MISSING
+                for items in (self._pending, self._flushing):
+                    if key in items:
+                        current = items[key]
+                        break
+                if current is _MISSING:
+                    try:
+                        current = self.backend.get(key)
+                    except KeyError:
+                        current = None
+                if current != expected:
+                    return False
+
+            self.writes += 1
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = value
+            full = len(self._pending) >= self.max_pending
+
+        if full:
+            self.flush()
+        return True
+
+    def set(self, key, value):
+        self._write(key, value)
+
+    def delete(self, key):
+        if not self.contains(key):
+            raise KeyError(key)
+        self._write(key, None)
+
+    def compare_and_set(self, key, expected, value):
+        return self._write(key, value, expected=expected)
+
+    def keys(self, prefix=''):
+        keys = set(self.backend.keys(prefix))
+        with self._lock:
+            for items in (self._flushing, self._pending):
+                for key, value in items.items():
+                    if key.startswith(prefix):
+                        if value is None:
+                            keys.discard(key)
+                        else:
+                            keys.add(key)
+        return sorted(keys)
+
+    def count(self, prefix=''):
+        with self._lock:
+            changed = any(
+                key.startswith(prefix)
+                for items in (self._flushing, self._pending)
+                    for key in items
+            )
+        if changed:
+            return len(self.keys(prefix))
+        return self.backend.count(prefix)
+
+    def flush(self):
+        """Writes all pending changes to the backend."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+
+            started_at = time.time()
+            try:
+                self.backend.write_batch(sorted(self._flushing.items()), sync=True)
+            except Exception:
+                # returning batch back, but newer writes win
+                with self._lock:
+                    self._flushing.update(self._pending)
+                    self._pending, self._flushing = self._flushing, {}
+                raise
+
+            with self._lock:
+                self.flushes += 1
+                self.flushed += len(self._flushing)
+                self._flushing = {}
+            self.flush_time.record(time.time() - started_at)
+
+    def snapshot(self, filename):
+        self.flush()
+        return self.backend.snapshot(filename)
+
+    def get_files(self, filename):
+        return self.backend.get_files(filename)
+
+    def compact(self):
+        self.flush()
+        return self.backend.compact()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                backend=self.backend.get_stats(),
+                pending=len(self._pending),
+                writes=self.writes,
+                coalesced=self.coalesced,
+                flushes=self.flushes,
+                flushed=self.flushed,
+                # how many backend writes we do for one write to the storage
+                write_amplification=float(self.flushed) / self.writes if self.writes else 0.0,
+                flush_time=self.flush_time.dump(),
+            )
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+        self.backend.close()
+
+
+BACKENDS = dict(
+    dbm=DbmBackend,
+    sqlite=SQLiteBackend,
+)
+
+
+def get_backend(url):
+    """Creates a backend by URL like "sqlite:///thebot.db".
+
+    Absolute paths have four slashes: "sqlite:////var/lib/thebot.db".
+    A plain filename means a dbm file.
+    """
+    if '://' not in url:
+        return DbmBackend(url)
+
+    scheme, path = url.split('://', 1)
+    if path.startswith('/'):
+        path = path[1:]
+
+    try:
+        cls = BACKENDS[scheme]
+    except KeyError:
+        raise ValueError('Unknown storage backend "{0}", use one of: {1}.'.format(
+            scheme, ', '.join(sorted(BACKENDS))))
+    return cls(path)
+
+
+def _is_immutable(value):
+    if value is None or isinstance(value, (six.text_type, six.binary_type, float, bool) + six.integer_types):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(item) for item in value)
+    return False
+
+
+class StorageCache(object):
+    """LRU cache for storage's values, limited by number of keys and their size in bytes.
+
+    Pickled data is cached for all values, and each read unpickles
+    a new copy, so callers can't change cached values. Only immutable
+    values, like strings and numbers, are cached as objects.
+    Missing keys are cached too.
+    """
+    def __init__(self, max_size=1000, max_bytes=None):
+        self.lru = LRUCache(max_size, max_weight=max_bytes)
+        self._lock = threading.Lock()
+        # incremented on every write, to prevent readers from putting
+        # into the cache a value which was read before the write
+        self.epoch = 0
+
+    def get(self, key):
+        return self.lru.get(key)
+
+    def fill(self, key, epoch, data, value):
+        with self._lock:
+            if epoch == self.epoch:
+                self._set(key, data, value)
+
+    def invalidate(self, key):
+        """Removes key after it's value was changed.
+
+        Value is not put into the cache by writers, otherwise two concurrent
+        writers could leave in the cache a value, which was overwritten.
+        It will be read from the backend on the next read.
+        """
+        with self._lock:
+            self.epoch += 1
+            self.lru.pop(key)
+
+    def _set(self, key, data, value):
+        if not _is_immutable(value):
+            value = _MISSING
+        self.lru.set(key, (data, value), weight=len(data) if data is not None else 1)
+
+    def get_stats(self):
+        return self.lru.get_stats()
+
+
+# Keys, starting with zero byte, are used by the storage itself.
+# Expiring keys are indexed by their expiration time, to find expired
+# keys without a full scan: '\x00expires:<milliseconds>:<key>' -> b''.
+_RESERVED_PREFIX = '\x00'
+_EXPIRES_PREFIX = '\x00expires:'
+_EXPIRES_DIGITS = 15
+
+
+class Storage(utils.MutableMapping):
+    # a function, returning current time in seconds, for expiration of keys
+    clock = staticmethod(time.time)
+
+    def __init__(self, url, prefix='', global_objects=None, cache=None, codec=None):
+        """Specials are used to restore references to some nonserializable objects,
+        such as TheBot itself.
+
+        Cache is an optional `StorageCache`, it is shared with all storages
+        created by `with_prefix`.
+        """
+        if isinstance(url, Backend):
+            self._backend = url
+        else:
+            self._backend = get_backend(url)
+
+        self.prefix = prefix
+        self.global_objects = global_objects or {}
+        self.cache = cache
+        self.codec = codec or Codec(self.global_objects)
+
+    def _key(self, name):
+        return utils.force_str(self.prefix + name)
+
+    def _is_expired(self, data, now=None):
+        expires_at = self.codec.get_expiry(data)
+        if expires_at is None:
+            return False
+        if now is None:
+            now = self.clock() * 1000
+        return expires_at <= now
+
+    def _get_cached(self, key):
+        """Returns a pair (data, value) from cache, or reads it from backend."""
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+
+        epoch = self.cache.epoch
+        try:
+            data = self._backend.get(key)
+        except KeyError:
+            self.cache.fill(key, epoch, None, None)
+            return None, None
+
+        value = self.codec.loads(data)
+        self.cache.fill(key, epoch, data, value)
+        return data, value
+
+    def __getitem__(self, name):
+        key = self._key(name)
+        if self.cache is None:
+            data = self._backend.get(key)
+            if self._is_expired(data):
+                raise KeyError(name)
+            return self.codec.loads(data)
+
+        data, value = self._get_cached(key)
+        if data is None or self._is_expired(data):
+            raise KeyError(name)
+        if value is _MISSING:
+            value = self.codec.loads(data)
+        return value
+
+    def __setitem__(self, name, value):
+        self.set(name, value)
+
+    def set(self, name, value, ttl=None):
+        """Stores a value. If `ttl` is given, value expires after this number of seconds.
+
+        Expired values are not returned, and are deleted by `reap`.
+        """
+        key = self._key(name)
+        data = self.codec.dumps(value)
+
+        if ttl is None:
+            self._backend.set(key, data)
+        else:
+            expires_at = int((self.clock() + ttl) * 1000)
+            data = self.codec.add_expiry(data, expires_at)
+            index_key = utils.force_str('{0}{1:0{2}d}:'.format(_EXPIRES_PREFIX, expires_at, _EXPIRES_DIGITS)) + key
+            # index is written first, so value can't stay without it
+            self._backend.write_batch([(index_key, b''), (key, data)])
+
+        if self.cache is not None:
+            self.cache.invalidate(key)
+
+    def __delitem__(self, name):
+        key = self._key(name)
+        self._backend.delete(key)
+        if self.cache is not None:
+            self.cache.invalidate(key)
+
+    def update(self, name, func, default=None, retries=100):
+        """Atomically replaces a value with `func(value)` and returns the new value.
+
+        If there is no such key, `func` gets a copy of `default`.
+        Nothing is locked while `func` works. If someone changes the value
+        in the meantime, `func` is called again with a fresh value,
+        so it should not have side effects.
+
+        If `func` returns `DELETE`, the value is deleted, and None is returned.
+        """
+        key = self._key(name)
+
+        for attempt in range(retries):
+            if self.cache is None:
+                try:
+                    data = self._backend.get(key)
+                except KeyError:
+                    data = None
+            else:
+                data = self._get_cached(key)[0]
+
+            if data is None or self._is_expired(data):
+                # default is copied through pickle, to keep references to the bot and adapters
+                value = self.codec.loads(self.codec.dumps(default))
+            else:
+                value = self.codec.loads(data)
+
+            value = func(value)
+            if value is DELETE:
+                value = new_data = None
+            else:
+                new_data = self.codec.dumps(value)
+
+            if self._backend.compare_and_set(key, data, new_data):
+                if self.cache is not None:
+                    self.cache.invalidate(key)
+                return value
+
+            if self.cache is not None:
+                self.cache.invalidate(key)
+
+        raise RuntimeError('Unable to update "{0}", it is changed too often.'.format(name))
+
+    def add(self, name, value, retries=100):
+        """Atomically stores a value only if there is no such name yet.
+
+        Returns True if value was stored. Expired value is treated as absent.
+        """
+        key = self._key(name)
+        new_data = self.codec.dumps(value)
+        data = None
+
+        for attempt in range(retries):
+            if self._backend.compare_and_set(key, data, new_data):
+                if self.cache is not None:
+                    self.cache.invalidate(key)
+                return True
+
+            try:
+                data = self._backend.get(key)
+            except KeyError:
+                data = None
+            else:
+                if not self._is_expired(data):
+                    return False
+
+        raise RuntimeError('Unable to add "{0}", it is changed too often.'.format(name))
+
+    def get_many(self, names):
+        """Returns a dict name -> value for all existing names."""
+        keys = dict((self._key(name), name) for name in names)
+        result = {}
+        missing = []
+        now = self.clock() * 1000
+
+        for key, name in keys.items():
+            entry = self.cache.get(key) if self.cache is not None else None
+            if entry is None:
+                missing.append(key)
+            elif entry[0] is not None and not self._is_expired(entry[0], now):
+                data, value = entry
+                result[name] = self.codec.loads(data) if value is _MISSING else value
+
+        if missing:
+            epoch = self.cache.epoch if self.cache is not None else None
+            found = self._backend.get_many(missing)
+            for key in missing:
+                data = found.get(key)
+                value = None
+                if data is not None:
+                    value = self.codec.loads(data)
+                    if not self._is_expired(data, now):
+                        result[keys[key]] = value
+                if self.cache is not None:
+                    self.cache.fill(key, epoch, data, value)
+        return result
+
+    def set_many(self, items):
+        """Writes many values at once, from a dict or a list of pairs."""
+        if isinstance(items, dict):
+            items = items.items()
+
+        batch = [(self._key(name), self.codec.dumps(value)) for name, value in items]
+
+        self._backend.write_batch(batch)
+        if self.cache is not None:
+            for key, data in batch:
+                self.cache.invalidate(key)
+
+    def scan(self, prefix='', batch_size=100):
+        """Yields pairs (name, value) for all names with given prefix.
+
+        Data is read by batches and each value is unpickled only when needed,
+        so memory usage does not depend on the storage size.
+        Scanned values are not put into the cache.
+        """
+        prefix_len = len(self.prefix)
+        now = self.clock() * 1000
+        for key, data in self._backend.scan(utils.force_str(self.prefix + prefix), batch_size=batch_size):
+            if key.startswith(_RESERVED_PREFIX) or self._is_expired(data, now):
+                continue
+            yield key[prefix_len:], self.codec.loads(data)
+
+    def __contains__(self, name):
+        key = self._key(name)
+        if self.cache is None:
+            try:
+                data = self._backend.get(key)
+            except KeyError:
+                return False
+        else:
+            data = self._get_cached(key)[0]
+        return data is not None and not self._is_expired(data)
+
+    def _iter_expired_index(self, now):
+        """Yields pairs (index_key, key) from the expiration index, which are expired by `now`.
+
+        Key's value could be overwritten after it was indexed, so it should be checked.
+        """
+        prefix = utils.force_str(_EXPIRES_PREFIX)
+        key_start = len(prefix) + _EXPIRES_DIGITS + 1
+        for index_key, _ in self._backend.scan(prefix):
+            if int(index_key[len(prefix):key_start - 1]) > now:
+                break
+            yield index_key, index_key[key_start:]
+
+    def _has_expired(self):
+        """Checks if there are expired values, which are not reaped yet.
+
+        Only the first entry of the expiration index is read.
+        """
+        now = self.clock() * 1000
+        return next(self._iter_expired_index(now), None) is not None
+
+    def _iter_keys(self):
+        """Yields keys with this storage's prefix, skipping reserved and expired ones."""
+        prefix = utils.force_str(self.prefix)
+        if not self._has_expired():
+            for key in self._backend.keys(prefix):
+                if not key.startswith(_RESERVED_PREFIX):
+                    yield key
+            return
+
+        # values are checked instead of the index, which is shared with other prefixes
+        now = self.clock() * 1000
+        for key, data in self._backend.scan(prefix):
+            if not key.startswith(_RESERVED_PREFIX) and not self._is_expired(data, now):
+                yield key
+
+    def __len__(self):
+        if self._has_expired():
+            return sum(1 for key in self._iter_keys())
+
+        count = self._backend.count(utils.force_str(self.prefix))
+        if not self.prefix:
+            count -= self._backend.count(utils.force_str(_RESERVED_PREFIX))
+        return count
+
+    def __iter__(self):
+        prefix_len = len(self.prefix)
+        return (key[prefix_len:] for key in self._iter_keys())
+
+    def keys(self):
+        return list(self)
+
+    def clear(self):
+        for key in self.keys():
+            del self[key]
+
+    def with_prefix(self, prefix):
+        storage = Storage(
+            self._backend,
+            prefix=self.prefix + prefix,
+            global_objects=self.global_objects,
+            cache=self.cache,
+            codec=self.codec,
+        )
+        storage.clock = self.clock
+        return storage
+
+    def reap(self, limit=100):
+        """Deletes up to `limit` expired values and returns their number.
+
+        Only the beginning of the expiration index is read,
+        so it is cheap to call it often.
+        """
+        now = int(self.clock() * 1000)
+        found = list(itertools.islice(self._iter_expired_index(now), limit))
+
+        deleted = 0
+        for index_key, key in found:
+            try:
+                data = self._backend.get(key)
+            except KeyError:
+                data = None
+
+            # value could be overwritten after it was indexed
+            if data is not None and self._is_expired(data, now):
+                if self._backend.compare_and_set(key, data, None):
+                    deleted += 1
+                if self.cache is not None:
+                    self.cache.invalidate(key)
+
+        if found:
+            self._backend.write_batch([(index_key, None) for index_key, key in found])
+        return deleted
+
+    def flush(self):
+        """Writes delayed changes, if storage works in write-behind mode."""
+        if isinstance(self._backend, WriteBehindBackend):
+            self._backend.flush()
+
+    def snapshot(self, filename):
+        """Writes a point-in-time copy of the whole storage into a new file.
+
+        It could be used as a storage filename later.
+        """
+        return self._backend.snapshot(filename)
+
+    def get_files(self, filename):
+        """Returns paths of files, which were created by `snapshot` with given filename."""
+        return self._backend.get_files(filename)
+
+    def compact(self):
+        """Rewrites the whole storage, to free space.
+
+        With dbm backend bot continues to work meanwhile, but SQLite
+        backend blocks all writes until VACUUM is finished.
+        """
+        return self._backend.compact()
+
+    def get_stats(self):
+        result = dict(self._backend.get_stats())
+        if self.cache is not None:
+            result['cache'] = self.cache.get_stats()
+        return result
+
+    def close(self):
+        self._backend.close()
+
+
+def migrate(source, destination):
+    """Copies all data from one backend to another and returns number of keys.
+
+    Values are copied as is, without unpickling.
+    """
+    keys = source.keys()
+    for key in keys:
+        destination.set(key, source.get(key))
+    return len(keys)
+
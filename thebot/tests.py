@@ -2,16 +2,30 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import calendar
 import times
 import datetime
+import gc
 import mock
 import thebot
+import json
+import os
 import sys
 import re
+import threading
+import time
 
 from thebot import Request, User, Adapter, Plugin, Storage, Config, on_pattern, on_command, Stub
+from thebot.storage import DELETE, Codec, StorageCache, WriteBehindBackend, dumps, get_backend, migrate, _get_dbm_files
+from thebot import Router, CommandRe, PatternRe, _literal_prefix, in_process
 from thebot.batteries import todo
 from thebot.batteries.identity import Person
+from thebot.utils.executor import KeyedExecutor
+from thebot.utils.ratelimit import RateLimiter
+from thebot.utils.stats import Histogram
+from thebot.utils.lru import LRUCache
+from thebot.utils.rwlock import RWLock
+from thebot.utils.scheduler import Cron, Scheduler, SKIP
 from nose.tools import eq_, assert_raises
 from contextlib import closing
 
@@ -82,6 +96,31 @@ class TestPlugin(Plugin):
         request.respond('I found {0}'.format(this))
 
 
+class HeavyPlugin(Plugin):
+    name = 'heavy'
+
+    @in_process
+    @on_command('pid')
+    def pid(self, request):
+        """Responds with a pid of the process, where callback was called."""
+        request.respond('{0}'.format(os.getpid()))
+
+    @in_process
+    @on_command('fail')
+    def fail(self, request):
+        request.respond('failing')
+        raise ValueError('Something went wrong')
+
+    @in_process
+    @on_command('use storage')
+    def use_storage(self, request):
+        for use in (lambda: self.storage['key'], lambda: self.bot.config):
+            try:
+                use()
+            except RuntimeError as e:
+                request.respond('{0}'.format(e))
+
+
 def test_install_adapters():
     with closing(Bot(adapters=[TestAdapter], plugins=[])) as bot:
         assert len(bot.adapters) == 1
@@ -91,7 +130,7 @@ def test_install_plugins():
     with closing(Bot(adapters=[], plugins=[TestPlugin])) as bot:
         eq_(0, len(bot.adapters))
         eq_(2, len(bot.plugins)) # Help plugin is added by default
-        eq_(7, len(bot.patterns))
+        eq_(9, len(bot.patterns))
 
 
 def test_one_line():
@@ -187,6 +226,162 @@ def test_storage_deep_nesting():
         eq_(['blah'], second.keys())
 
 
+def test_storage_prefix_index():
+    with closing(Storage(STORAGE_FILENAME)) as storage:
+        storage.clear()
+
+        for idx in range(10):
+            storage['a:{0}'.format(idx)] = idx
+            storage['b:{0}'.format(idx)] = idx
+        storage['ab'] = 'not in a:'
+        storage['b:3'] = 'overwritten'
+
+        a = storage.with_prefix('a:')
+        b = storage.with_prefix('b:')
+
+        eq_(10, len(a))
+        eq_(21, len(storage))
+        eq_([str(idx) for idx in range(10)], a.keys())
+        assert '3' in b
+        assert '10' not in b
+
+        del b['3']
+        eq_(9, len(b))
+        assert '3' not in b
+        eq_('3', a.keys()[3])
+
+    # index is restored from the file
+    with closing(Storage(STORAGE_FILENAME)) as storage:
+        eq_(9, len(storage.with_prefix('b:')))
+        storage.clear()
+
+
+def test_sqlite_storage():
+    filename = 'unittest-{}.db'.format(PYTHON_VERSION)
+    bot = Stub('bot')
+    global_objects = dict(bot=bot)
+
+    try:
+        with closing(Storage('sqlite:///' + filename, global_objects=global_objects)) as storage:
+            first = storage.with_prefix('first:')
+            first['blah'] = dict(bot=bot, value='minor')
+            first['foo\uffff'] = 1
+            storage['firstly'] = 2
+            storage['second:one'] = 3
+
+            eq_(['blah', 'foo\uffff'], first.keys())
+            eq_(2, len(first))
+            assert 'blah' in first
+            assert 'blah' not in storage
+
+            # readers in other threads use their own connections
+            results = []
+            thread = threading.Thread(target=lambda: results.append(first['blah']))
+            thread.start()
+            thread.join()
+            eq_('minor', results[0]['value'])
+
+            # and their connections are closed when threads end
+            for idx in range(50):
+                thread = threading.Thread(target=lambda: results.append(first['blah']))
+                thread.start()
+                thread.join()
+            gc.collect()
+            eq_(1, len(storage._backend._connections))
+
+            del first['blah']
+            assert_raises(KeyError, lambda: first['blah'])
+            eq_(['foo\uffff'], first.keys())
+
+        with closing(Storage('sqlite:///' + filename, global_objects=global_objects)) as storage:
+            eq_(['first:foo\uffff', 'firstly', 'second:one'], storage.keys())
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(filename + suffix):
+                os.unlink(filename + suffix)
+
+
+def test_storage_migration():
+    filename = 'unittest-{}-migrated.db'.format(PYTHON_VERSION)
+
+    try:
+        with closing(Bot(adapters=[TestAdapter], plugins=[])) as bot:
+            bot.storage['some'] = dict(bot=bot, adapter=bot.get_adapter('test'))
+            bot.storage.with_prefix('plugin:')['key'] = 'value'
+
+            destination = get_backend('sqlite:///' + filename)
+            eq_(2, migrate(bot.storage._backend, destination))
+
+            storage = Storage(destination, global_objects=bot.storage.global_objects)
+            eq_(['plugin:key', 'some'], storage.keys())
+            assert storage['some']['bot'] is bot
+            assert storage['some']['adapter'] is bot.get_adapter('test')
+            storage.close()
+    finally:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+def test_write_behind_storage():
+    backend = get_backend(STORAGE_FILENAME)
+    buffered = WriteBehindBackend(backend, delay=60, max_pending=3)
+    storage = Storage(buffered)
+
+    try:
+        storage.clear()
+        buffered.flush()
+
+        for idx in range(5):
+            storage['task'] = idx
+        storage['other'] = 'value'
+
+        # nothing is written yet, but reads see the changes
+        eq_([], backend.keys())
+        eq_(4, storage['task'])
+        eq_(['other', 'task'], storage.keys())
+
+        del storage['other']
+        assert 'other' not in storage
+        eq_(1, len(storage))
+
+        # third key triggers a flush
+        storage['third'] = 3
+        storage['fourth'] = 4
+        eq_(['task', 'third'], backend.keys())
+        eq_(['fourth', 'task', 'third'], storage.keys())
+
+        stats = buffered.get_stats()
+        eq_(9, stats['writes'])
+        eq_(5, stats['coalesced'])
+        eq_(3, stats['flushed'])
+        eq_(1, stats['flushes'])
+        eq_(1, stats['pending'])
+    finally:
+        storage.clear()
+        storage.close()
+
+
+def test_bot_flushes_storage_on_close():
+    bot = thebot.Bot(
+        adapters=[TestAdapter],
+        plugins=[],
+        config_dict=dict(
+            unittest=True,
+            log_filename='unittest.log',
+            storage_filename=STORAGE_FILENAME,
+            storage_write_delay=60,
+        ),
+        config_filename='unexistent.conf',
+    )
+    bot.storage['key'] = 'value'
+    eq_(1, bot.get_stats()['storage']['pending'])
+    bot.close()
+
+    with closing(Storage(STORAGE_FILENAME)) as storage:
+        eq_('value', storage['key'])
+        storage.clear()
+
+
 def test_help_command():
     with closing(Bot(adapters=[TestAdapter], plugins=[TestPlugin])) as bot:
         adapter = bot.adapters[0]
@@ -354,6 +549,30 @@ def test_todo_remind():
             eq_([], adapter._lines)
 
 
+def test_todo_remind_uses_due_index():
+    with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
+        adapter = bot.get_adapter('test')
+        plugin = bot.get_plugin('todo')
+
+        adapter.write('TheBot, remind at 2012-09-01 10:00 to do task1')
+        adapter.write('TheBot, remind at 2012-09-05 10:00 to do task2')
+        adapter.write('TheBot, remind at 2012-09-07 10:00 to do task3')
+        adapter.write('TheBot, 26 done')
+
+        with mock.patch.object(times, 'now') as now:
+            # task1 is overdue more than a day, but reminder is still sent
+            now.return_value = datetime.datetime(2012, 9, 3, 12, 0)
+            adapter._lines[:] = []
+            eq_(datetime.datetime(2012, 9, 7, 10, 0), plugin._remind_users_about_their_tasks())
+            eq_(['TODO: do task1 (03f9)'], adapter._lines)
+
+            # task2 was done, so there are no more reminders
+            now.return_value = datetime.datetime(2012, 9, 8, 12, 0)
+            adapter._lines[:] = []
+            eq_(None, plugin._remind_users_about_their_tasks())
+            eq_(['TODO: do task3 (f3ba)'], adapter._lines)
+
+
 def test_todo_done():
     with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
 
@@ -376,6 +595,251 @@ def test_todo_done():
         )
 
 
+def test_todo_task_ids():
+    with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
+        adapter = bot.get_adapter('test')
+
+        adapter.write('TheBot, remind at 2012-09-05 10:00 to do task1')
+        adapter.write('TheBot, remind at 2012-09-06 10:00 to do task1')
+        adapter.write('TheBot, remind at 2012-09-07 10:00 to do task2')
+
+        adapter._lines[:] = []
+        adapter.write('TheBot, 99 done')
+        adapter.write('TheBot, my tasks')
+        eq_(
+            [
+                'Task 99 not found.',
+                '03) 2012-09-05 10:00 do task1\n'
+                'f3) 2012-09-06 10:00 do task1\n'
+                '26) 2012-09-07 10:00 do task2',
+            ],
+            adapter._lines
+        )
+
+        # ids don't change when other tasks are done
+        adapter._lines[:] = []
+        adapter.write('TheBot, 03 done')
+        adapter.write('TheBot, my tasks')
+        eq_(
+            [
+                'done',
+                'f3) 2012-09-06 10:00 do task1\n'
+                '26) 2012-09-07 10:00 do task2',
+            ],
+            adapter._lines
+        )
+
+        # prefix should be unique
+        adapter.write('TheBot, remind at 2012-09-08 10:00 to task11')
+        adapter.write('TheBot, remind at 2012-09-09 10:00 to task31')
+        adapter._lines[:] = []
+        adapter.write('TheBot, 77 done')
+        adapter.write('TheBot, my tasks')
+        eq_(
+            [
+                'There are few tasks with id 77, please, use more symbols.',
+                'f3c) 2012-09-06 10:00 do task1\n'
+                '261) 2012-09-07 10:00 do task2\n'
+                '77d) 2012-09-08 10:00 task11\n'
+                '771) 2012-09-09 10:00 task31',
+            ],
+            adapter._lines
+        )
+
+
+def test_todo_migration():
+    with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
+        adapter = bot.get_adapter('test')
+        identity = bot.get_plugin('identity').get_identity_by_user(adapter, User('some user'))
+        plugin = bot.get_plugin('todo')
+
+        # tasks in the format of the previous versions
+        plugin.storage['tasks:' + identity.id] = [
+            (datetime.datetime(2030, 9, 5, 10, 0), 'do task1', identity.id),
+            (datetime.datetime(2030, 9, 6, 10, 0), 'do task1', identity.id),
+        ]
+        del plugin.storage['schema_version']
+        plugin = todo.Plugin(bot)
+
+        adapter._lines[:] = []
+        adapter.write('TheBot, f3 done')
+        adapter.write('TheBot, my tasks')
+        eq_(['done', '03) 2030-09-05 10:00 do task1'], adapter._lines)
+
+        with mock.patch.object(times, 'now') as now:
+            now.return_value = datetime.datetime(2030, 9, 7, 0, 0)
+            adapter._lines[:] = []
+            plugin._remind_users_about_their_tasks()
+            eq_(['TODO: do task1 (03f9)'], adapter._lines)
+
+
+def test_todo_migration_could_be_repeated():
+    with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
+        adapter = bot.get_adapter('test')
+        identities = bot.get_plugin('identity')
+        plugin = bot.get_plugin('todo')
+
+        identity_ids = []
+        for user in ('user1', 'user2'):
+            identity = identities.get_identity_by_user(adapter, User(user))
+            identity_ids.append(identity.id)
+            plugin.storage['tasks:' + identity.id] = [
+                (datetime.datetime(2030, 9, 5, 10, 0), 'do task of ' + user, identity.id),
+            ]
+        # index of the previous version
+        plugin.storage['due:2030-09-05T10:00:00.000000:{0}:old'.format(identity_ids[0])] = 'old'
+        del plugin.storage['schema_version']
+
+        # migration is interrupted after the first identity
+        set_many = plugin.storage.set_many
+        calls = []
+
+        def interrupted_set_many(items):
+            if calls:
+                raise RuntimeError('Interrupted')
+            calls.append(items)
+            set_many(items)
+
+        with mock.patch.object(plugin.storage, 'set_many', interrupted_set_many):
+            assert_raises(RuntimeError, plugin._migrate)
+        assert 'schema_version' not in plugin.storage
+
+        plugin._migrate()
+        eq_(todo.SCHEMA_VERSION, plugin.storage['schema_version'])
+        eq_([], plugin.storage.with_prefix('tasks:').keys())
+        for user in ('user1', 'user2'):
+            adapter._lines[:] = []
+            adapter.write('TheBot, my tasks', user=user)
+            eq_(1, len(adapter._lines))
+            assert adapter._lines[0].endswith('2030-09-05 10:00 do task of ' + user), adapter._lines
+        eq_(2, len(plugin.storage.with_prefix('due:').keys()))
+
+
+def test_todo_tasks_pagination():
+    with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
+        adapter = bot.get_adapter('test')
+        plugin = bot.get_plugin('todo')
+        identity = bot.get_plugin('identity').get_identity_by_user(adapter, User('some user'))
+
+        for day in range(5, 0, -1):
+            adapter.write('TheBot, remind at 2012-09-{0:02d} 10:00 to do task{0}'.format(day))
+
+        eq_(5, plugin._count_tasks(identity))
+        eq_(
+            ['do task3', 'do task4'],
+            [about for dt, about, identity_id, task_id in plugin._get_tasks(identity, offset=2, limit=2)],
+        )
+
+        with mock.patch.object(todo, 'PAGE_SIZE', 2):
+            adapter._lines[:] = []
+            adapter.write('TheBot, my tasks')
+            adapter.write('TheBot, my tasks page 3')
+            adapter.write('TheBot, my tasks page 4')
+            adapter.write('TheBot, my tasks page 0')
+            eq_(
+                [
+                    '03) 2012-09-01 10:00 do task1\n'
+                    '26) 2012-09-02 10:00 do task2\n'
+                    'Page 1 of 3. Say "my tasks page N" to see others.',
+                    'e1) 2012-09-05 10:00 do task5\n'
+                    'Page 3 of 3. Say "my tasks page N" to see others.',
+                    'There is no page 4.',
+                    'There is no page 0.',
+                ],
+                adapter._lines
+            )
+
+
+def test_todo_recurring_tasks():
+    with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
+        adapter = bot.get_adapter('test')
+        plugin = bot.get_plugin('todo')
+        identity = bot.get_plugin('identity').get_identity_by_user(adapter, User('some user'))
+
+        adapter.write('TheBot, set timezone Asia/Shanghai')
+        with mock.patch.object(times, 'now') as now:
+            now.return_value = datetime.datetime(2012, 9, 5, 0, 0)
+
+            adapter._lines[:] = []
+            adapter.write('TheBot, remind me every day at 2012-09-01 10:00 to do task1')
+            adapter.write('TheBot, remind me every fortnight at 2012-09-01 10:00 to do task1')
+            adapter.write('TheBot, remind by RRULE:FREQ=WEEKLY;BYDAY=FR;COUNT=2 at 2012-09-05 10:00 to do task2')
+            adapter.write('TheBot, my tasks')
+            eq_(
+                [
+                    'ok, first time is 2012-09-05 10:00',
+                    'Unknown period "fortnight", use one of: day, friday, hour, monday, month, '
+                    'saturday, sunday, thursday, tuesday, wednesday, week, weekday, year.',
+                    'ok, first time is 2012-09-07 10:00',
+                    '03) 2012-09-05 10:00 do task1 (every day)\n'
+                    '26) 2012-09-07 10:00 do task2 (RRULE:FREQ=WEEKLY;BYDAY=FR;COUNT=2)',
+                ],
+                adapter._lines
+            )
+
+            # only the next reminder is stored
+            eq_(2, len(plugin._get_tasks(identity)))
+
+            # bot was stopped for a few days, so only one reminder is sent
+            now.return_value = datetime.datetime(2012, 9, 10, 0, 0)
+            adapter._lines[:] = []
+            eq_(datetime.datetime(2012, 9, 10, 2, 0), plugin._remind_users_about_their_tasks())
+            eq_(['TODO: do task1 (03f9)', 'TODO: do task2 (2613)'], adapter._lines)
+
+            adapter._lines[:] = []
+            adapter.write('TheBot, my tasks')
+            eq_(
+                [
+                    '03) 2012-09-10 10:00 do task1 (every day)\n'
+                    '26) 2012-09-14 10:00 do task2 (RRULE:FREQ=WEEKLY;BYDAY=FR;COUNT=2)',
+                ],
+                adapter._lines
+            )
+
+            # the last reminder by rule becomes a usual task
+            now.return_value = datetime.datetime(2012, 9, 20, 0, 0)
+            adapter._lines[:] = []
+            plugin._remind_users_about_their_tasks()
+            adapter.write('TheBot, 03 done')
+            adapter.write('TheBot, my tasks')
+            eq_(
+                [
+                    'TODO: do task1 (03f9)',
+                    'TODO: do task2 (2613)',
+                    'done',
+                    '26) 2012-09-14 10:00 do task2',
+                ],
+                adapter._lines
+            )
+
+
+def test_todo_recurring_task_done_while_rescheduled():
+    with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
+        adapter = bot.get_adapter('test')
+        plugin = bot.get_plugin('todo')
+        identity = bot.get_plugin('identity').get_identity_by_user(adapter, User('some user'))
+
+        with mock.patch.object(times, 'now') as now:
+            now.return_value = datetime.datetime(2012, 9, 5, 0, 0)
+            adapter.write('TheBot, remind me every day at 2012-09-05 10:00 to do task1')
+
+            # user marks task as done, while the next reminder is written
+            set_many = plugin.storage.set_many
+
+            def done_and_set_many(items):
+                adapter.write('TheBot, 03 done')
+                set_many(items)
+
+            now.return_value = datetime.datetime(2012, 9, 6, 0, 0)
+            adapter._lines[:] = []
+            with mock.patch.object(plugin.storage, 'set_many', done_and_set_many):
+                eq_(None, plugin._remind_users_about_their_tasks())
+            eq_(['TODO: do task1 (03f9)', 'done'], adapter._lines)
+
+            eq_([], plugin._get_tasks(identity))
+            eq_([], plugin.storage.with_prefix('due:').keys())
+
+
 def test_todo_remind_at_uses_timezones():
     with closing(Bot(adapters=[TestAdapter], plugins=[todo.Plugin])) as bot:
         adapter = bot.get_adapter('test')
@@ -520,6 +984,7 @@ def test_bind_to_another_identity():
 
         # now there should be only one identity
         eq_(1, len(plugin.identities))
+        eq_([identity], list(plugin.identity_storage.keys()))
         # and still two persons
         eq_(2, len(plugin.persons))
         # pointing to the same identity
@@ -685,3 +1150,1023 @@ def test_direct_commands_require_bot_name_infront():
         eq_(1, len(adapter._lines))
 
 
+
+
+def test_literal_prefix():
+    eq_('help', _literal_prefix('help'))
+    eq_('help ', _literal_prefix('help (?P<plugin>.*)'))
+    eq_('remind', _literal_prefix('remind( me)? at (?P<datetime>.+) to (?P<about>.+)'))
+    eq_('', _literal_prefix('(image|img)( me)? (?P<query>.+)'))
+    # optional chars and alternatives can't be a part of the prefix
+    eq_('colo', _literal_prefix('colou?r'))
+    eq_('', _literal_prefix('foo|bar'))
+    eq_('a.b', _literal_prefix(r'a\.b\d'))
+    eq_('', _literal_prefix('(?i)help'))
+    eq_('', _literal_prefix(r'ab[(]|x'))
+
+
+def test_router_keeps_first_match_semantics():
+    def route(cls, pattern):
+        return (cls(pattern), pattern)
+
+    routes = [
+        route(PatternRe, 'cat'),
+        route(CommandRe, 'find (?P<this>.*)'),
+        route(CommandRe, '(?P<anything>.*)'),
+        route(CommandRe, 'find me'),
+        route(PatternRe, '.*'),
+    ]
+    router = Router(routes)
+
+    def check(message, direct):
+        expected = None
+        for pattern, callback in routes:
+            if pattern.match(message, direct) is not None:
+                expected = callback
+                break
+
+        found = router.match(message, direct)
+        eq_(expected, found and found[1])
+
+    for message in ('find me', 'find a cat', 'I have a cat', 'blah', '', 'fin'):
+        check(message, True)
+        check(message, False)
+
+
+def test_router_is_rebuilt_when_patterns_change():
+    with closing(Bot(adapters=[TestAdapter], plugins=[TestPlugin])) as bot:
+        adapter = bot.get_adapter('test')
+        router = bot.get_router()
+        eq_(router, bot.get_router())
+
+        class AnotherPlugin(Plugin):
+            name = 'another'
+            @on_command('ping')
+            def ping(self, request):
+                request.respond('pong')
+
+        bot.patterns.extend(AnotherPlugin(bot).get_callbacks())
+        assert router is not bot.get_router()
+
+        adapter.write('TheBot, ping')
+        eq_(['pong'], adapter._lines)
+
+
+def test_executor_keeps_order_inside_a_conversation():
+    executor = KeyedExecutor(threads=4)
+    results = {'first': [], 'second': []}
+
+    def job(key, value):
+        # later jobs are faster, to shuffle them if order is not kept
+        time.sleep(0.001 * (10 - value))
+        results[key].append(value)
+
+    for value in range(10):
+        executor.submit('first', job, 'first', value)
+        executor.submit('second', job, 'second', value)
+
+    executor.shutdown()
+    eq_(list(range(10)), results['first'])
+    eq_(list(range(10)), results['second'])
+
+    stats = executor.get_stats()
+    eq_(20, stats['completed'])
+    eq_(0, stats['depth'])
+
+
+def test_executor_runs_conversations_in_parallel():
+    executor = KeyedExecutor(threads=2)
+    blocker = threading.Event()
+
+    executor.submit('slow', blocker.wait)
+    task = executor.submit('fast', lambda: None)
+
+    # fast conversation is not blocked by the slow one
+    assert task.wait(timeout=1)
+    blocker.set()
+    executor.shutdown()
+
+
+def test_bot_dispatches_requests_in_thread_pool():
+    with closing(Bot(['--dispatch-threads', '2'], adapters=[TestAdapter], plugins=[TestPlugin])) as bot:
+        adapter = bot.get_adapter('test')
+
+        adapter.write('TheBot, find Umputun')
+        adapter.write('TheBot, search Umputun')
+        bot.executor.shutdown()
+
+        eq_(['I found Umputun', 'I found Umputun'], adapter._lines)
+
+
+def test_callbacks_in_process_pool():
+    with closing(Bot(['--process-pool-size', '1'], adapters=[TestAdapter], plugins=[HeavyPlugin])) as bot:
+        adapter = bot.get_adapter('test')
+
+        adapter.write('TheBot, pid')
+        eq_(1, len(adapter._lines))
+        assert adapter._lines[0] != '{0}'.format(os.getpid())
+
+        # responses are delivered even if callback failed
+        adapter.write('TheBot, fail')
+        eq_('failing', adapter._lines[-1])
+
+        # bot and storage are not silently replaced with stubs
+        adapter.write('TheBot, use storage')
+        assert adapter._lines[-2].startswith('plugin.storage is not available'), adapter._lines[-2]
+        assert adapter._lines[-1].startswith('plugin.bot is not available'), adapter._lines[-1]
+
+        # concurrent callbacks share one pool
+        pools = []
+        threads = [threading.Thread(target=lambda: pools.append(bot.process_pool._get_pool())) for idx in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(1, len(set(id(pool) for pool in pools)))
+
+
+def test_rate_limiter():
+    clock = mock.Mock(return_value=1000.0)
+    limiter = RateLimiter(burst=2, rate=0.5, window=60, clock=clock)
+
+    eq_((True, False), limiter.admit('user'))
+    eq_((True, False), limiter.admit('user'))
+    # bucket is empty, user should be warned only once
+    eq_((False, True), limiter.admit('user'))
+    eq_((False, False), limiter.admit('user'))
+    # but other users are not affected
+    eq_((True, False), limiter.admit('another'))
+
+    # after two seconds there is one token again
+    clock.return_value = 1002.0
+    eq_((True, False), limiter.admit('user'))
+    eq_((False, False), limiter.admit('user'))
+
+    eq_(dict(allowed=3, rejected=3, tokens=0), limiter.get_stats()['user'])
+
+    # a warning is recorded only if it could be sent
+    eq_((True, False), limiter.admit('third'))
+    eq_((True, False), limiter.admit('third'))
+    eq_((False, False), limiter.admit('third', can_warn=False))
+    eq_((False, True), limiter.admit('third'))
+
+
+def test_rate_limiter_keeps_max_keys():
+    clock = mock.Mock(return_value=1000.0)
+    limiter = RateLimiter(burst=1, rate=0.001, max_keys=100, clock=clock)
+
+    eq_((True, False), limiter.admit('user'))
+    for idx in range(5000):
+        limiter.admit('flood{0}'.format(idx))
+        # recently used bucket is not removed
+        eq_((False, idx == 0), limiter.admit('user'))
+    eq_(100, len(limiter.get_stats()))
+
+
+def test_bot_asks_to_slow_down():
+    with closing(Bot(['--rate-limit-user-burst', '2', '--rate-limit-user-rate', '0.001'],
+                     adapters=[TestAdapter], plugins=[TestPlugin, 'identity'])) as bot:
+        adapter = bot.get_adapter('test')
+
+        for idx in range(4):
+            adapter.write('TheBot, find Umputun')
+
+        eq_(
+            [
+                'I found Umputun',
+                'I found Umputun',
+                'Slow down, please. I\'ll ignore your requests for a while.',
+            ],
+            adapter._lines
+        )
+
+        # another user can talk to the bot
+        adapter.write('TheBot, find Umputun', user='another user')
+        eq_('I found Umputun', adapter._lines[-1])
+
+        adapter.write('TheBot, stats json', user='another user')
+        rate_limits = json.loads(adapter._lines[-1])['rate_limits']['user']
+        eq_(2, sum(counters['rejected'] for counters in rate_limits.values()))
+
+
+def test_bot_warns_only_on_direct_requests():
+    with closing(Bot(['--rate-limit-user-burst', '1', '--rate-limit-user-rate', '0.001'],
+                     adapters=[TestAdapter], plugins=[TestPlugin])) as bot:
+        adapter = bot.get_adapter('test')
+
+        adapter.write('I have a cat')
+        # this one is rejected silently
+        adapter.write('I have a cat')
+        # and the warning is sent on the first direct request
+        adapter.write('TheBot, find Umputun')
+
+        eq_(
+            [
+                'I like cats!!!',
+                'Slow down, please. I\'ll ignore your requests for a while.',
+            ],
+            adapter._lines
+        )
+
+
+def test_rate_limiter_is_off_by_default():
+    with closing(Bot(adapters=[TestAdapter], plugins=[TestPlugin])) as bot:
+        eq_([], bot.rate_limiters)
+
+
+def test_histogram():
+    histogram = Histogram()
+    eq_(None, histogram.percentile(50))
+
+    for value in range(1, 101):
+        histogram.record(value / 1000.0)
+
+    data = histogram.dump()
+    eq_(100, data['count'])
+    eq_(0.001, data['min'])
+    eq_(0.1, data['max'])
+    # percentiles are estimated by buckets' bounds
+    assert 0.05 <= data['p50'] < 0.05 * 1.2, data['p50']
+    assert 0.099 <= data['p99'] <= 0.1, data['p99']
+
+
+def test_stats_command():
+    with closing(Bot(adapters=[TestAdapter], plugins=[TestPlugin])) as bot:
+        adapter = bot.get_adapter('test')
+
+        adapter.write('TheBot, find Umputun')
+        adapter.write('TheBot, find Umputun')
+        adapter.write('I have a cat')
+
+        adapter.write('TheBot, stats')
+        lines = adapter._lines[-1].split('\n')
+        eq_('Dispatching:', lines[0])
+        assert lines[1].startswith('  match — 4 calls'), lines[1]
+        assert '  test — 3 calls' in adapter._lines[-1]
+        assert '  test:find (?P<this>.*) — 2 calls' in adapter._lines[-1]
+
+        adapter.write('TheBot, stats json')
+        histograms = json.loads(adapter._lines[-1])['histograms']
+        eq_(2, histograms['route:test:find (?P<this>.*)']['count'])
+        eq_(1, histograms['route:test:cat']['count'])
+        eq_(5, histograms['dispatch.match']['count'])
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+    cache.set('one', 1)
+    cache.set('two', 2)
+    eq_(1, cache.get('one'))
+
+    # 'two' is least recently used and will be removed
+    cache.set('three', 3)
+    eq_(None, cache.get('two'))
+    eq_(3, cache.get('three'))
+
+    stats = cache.get_stats()
+    eq_(2, stats['hits'])
+    eq_(1, stats['misses'])
+
+
+def test_lru_cache_with_weights():
+    cache = LRUCache(max_size=10, max_weight=10)
+    cache.set('one', 1, weight=4)
+    cache.set('two', 2, weight=4)
+    cache.set('three', 3, weight=4)
+    eq_(None, cache.get('one'))
+    eq_(8, cache.weight)
+
+    # too heavy items are not cached
+    cache.set('heavy', 4, weight=11)
+    eq_(None, cache.get('heavy'))
+
+    cache.pop('two')
+    eq_(4, cache.weight)
+
+
+def test_storage_cache():
+    backend = get_backend(STORAGE_FILENAME)
+    storage = Storage(backend, cache=StorageCache(max_size=10))
+    plugin_storage = storage.with_prefix('plugin:')
+
+    try:
+        storage.clear()
+        plugin_storage['tasks'] = [1, 2]
+        plugin_storage['timezone'] = 'Europe/Moscow'
+
+        # immutable values are cached as is
+        assert plugin_storage['timezone'] is plugin_storage['timezone']
+
+        # but mutable ones are unpickled each time
+        tasks = plugin_storage['tasks']
+        tasks.append(3)
+        eq_([1, 2], plugin_storage['tasks'])
+
+        # cache is shared with other views of the storage and
+        # is not used after delete
+        eq_([1, 2], storage['plugin:tasks'])
+        del storage['plugin:tasks']
+        assert 'tasks' not in plugin_storage
+        assert_raises(KeyError, lambda: plugin_storage['tasks'])
+
+        # another writer changes the value between our write to the backend
+        # and to the cache, but cache doesn't keep our value
+        def set_and_race(key, value):
+            backend.__class__.set(backend, key, value)
+            backend.__class__.set(backend, key, storage.codec.dumps('from B'))
+
+        backend.set = set_and_race
+        plugin_storage['race'] = 'from A'
+        del backend.set
+        eq_('from B', plugin_storage['race'])
+
+        stats = storage.get_stats()['cache']
+        assert stats['hits'] >= 4
+        assert stats['weight'] > 0
+    finally:
+        storage.clear()
+        storage.close()
+
+
+def test_cron():
+    def next_run(expression, after):
+        timestamp = Cron(expression).next(calendar.timegm(after.timetuple()))
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=timestamp)
+
+    now = datetime.datetime(2012, 9, 5, 10, 17, 30)  # wednesday
+    eq_(datetime.datetime(2012, 9, 5, 10, 18), next_run('* * * * *', now))
+    eq_(datetime.datetime(2012, 9, 5, 10, 20), next_run('*/10 * * * *', now))
+    eq_(datetime.datetime(2012, 9, 6, 9, 0), next_run('0 9 * * *', now))
+    eq_(datetime.datetime(2012, 9, 10, 9, 0), next_run('0 9 * * 1', now))
+    eq_(datetime.datetime(2012, 9, 9, 9, 0), next_run('0 9 * * 7', now))
+    eq_(datetime.datetime(2013, 1, 1, 0, 0), next_run('0 0 1 1 *', now))
+    # day or weekday
+    eq_(datetime.datetime(2012, 9, 7, 0, 0), next_run('0 0 15 * 5', now))
+    eq_(datetime.datetime(2016, 2, 29, 0, 0), next_run('0 0 29 2 *', now))
+
+    assert_raises(ValueError, Cron, '* * * *')
+    assert_raises(ValueError, Cron, '60 * * * *')
+    assert_raises(ValueError, Cron('0 0 31 2 *').next, 0)
+
+
+def _wait_for(condition, timeout=10):
+    """Waits until condition() is true, checks are not bound to the exact timing."""
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Condition was not met in {0} seconds'.format(timeout)
+        time.sleep(0.01)
+
+
+def test_scheduler():
+    scheduler = Scheduler(threads=2)
+    runs = []
+    slow_runs = []
+    skipped_runs = []
+    release_slow = threading.Event()
+
+    def slow():
+        slow_runs.append(time.time())
+        release_slow.wait(10)
+
+    try:
+        job = scheduler.add(lambda: runs.append(time.time()), 0.05, start_at=time.time())
+        # runs, missed while job was working, are coalesced into one
+        slow_job = scheduler.add(slow, 0.05, start_at=time.time())
+        skipped_job = scheduler.add(lambda: skipped_runs.append(1), 0.05,
+                                    misfire=SKIP, misfire_grace=0.5, start_at=time.time() - 10)
+        # this one should not run before the scheduler is closed
+        scheduler.add(lambda: runs.append(None), 60, start_at=time.time() + 30)
+
+        _wait_for(lambda: len(runs) >= 3)
+        job.cancel()
+        count = len(runs)
+
+        _wait_for(lambda: slow_job.misfires >= 2)
+        eq_(1, len(slow_runs))
+        # many missed runs become one pending run
+        assert slow_job.pending
+        release_slow.set()
+        _wait_for(lambda: len(slow_runs) >= 2)
+
+        # first run was too late
+        _wait_for(lambda: skipped_runs)
+        assert skipped_job.misfires >= 1
+
+        time.sleep(0.1)
+        eq_(count, len(runs))
+        eq_(3, scheduler.get_stats()['jobs'])
+    finally:
+        release_slow.set()
+        started_at = time.time()
+        scheduler.close()
+    # does not wait for the next run, only for the current one
+    assert time.time() - started_at < 10
+
+
+def test_threaded_plugin():
+    class CounterPlugin(thebot.ThreadedPlugin):
+        name = 'counter'
+
+        def __init__(self, *args, **kwargs):
+            super(CounterPlugin, self).__init__(*args, **kwargs)
+            self.events = []
+
+        def on_start(self):
+            self.events.append('start')
+
+        def do_job(self):
+            self.events.append('job')
+
+        def on_stop(self):
+            self.events.append('stop')
+
+    with closing(Bot(adapters=[TestAdapter], plugins=[CounterPlugin])) as bot:
+        plugin = bot.get_plugin('counter')
+        plugin.start_worker(interval=0.05)
+        assert plugin.is_working()
+        _wait_for(lambda: plugin.events.count('job') >= 3)
+
+        plugin.stop_worker()
+        assert not plugin.is_working()
+        # stop waits for the current job, so nothing runs after it
+        eq_('start', plugin.events[0])
+        eq_('stop', plugin.events[-1])
+        eq_(['job'] * (len(plugin.events) - 2), plugin.events[1:-1])
+        time.sleep(0.1)
+        eq_('stop', plugin.events[-1])
+
+
+def test_rwlock():
+    lock = RWLock()
+    events = []
+
+    def write():
+        with lock.writing():
+            events.append('write')
+
+    def read():
+        with lock.reading():
+            events.append('read')
+
+    lock.acquire_read()
+    # many readers are allowed
+    read()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    _wait_for(lambda: lock._waiting_writers == 1)
+    # writer waits for the first reader, and new readers wait for the writer
+    reader = threading.Thread(target=read)
+    reader.start()
+    time.sleep(0.05)
+    eq_(['read'], events)
+
+    lock.release_read()
+    writer.join()
+    reader.join()
+    eq_(['read', 'write', 'read'], events)
+
+
+def test_storage_codec():
+    bot = object()
+    codec = Codec(dict(bot=bot))
+    values = [
+        'Europe/Moscow',
+        [(datetime.datetime(2030, 1, 1, 10, 0), 'task', 'id')],
+        dict(bot=bot, values=[1, 2]),
+        Stub('adapter'),
+    ]
+
+    for value, tag in zip(values, (b's', b'p', b'o', b'o')):
+        eq_(b'\x00\x01' + tag, codec.dumps(value)[:3])
+
+    eq_('Europe/Moscow', codec.loads(codec.dumps(values[0])))
+    eq_(values[1], codec.loads(codec.dumps(values[1])))
+    assert codec.loads(codec.dumps(values[2]))['bot'] is bot
+    eq_('adapter', codec.loads(codec.dumps(values[3])).name)
+
+    # data, written by previous versions is still readable
+    eq_(values[1], codec.loads(dumps(values[1])))
+    assert codec.loads(dumps(values[2], global_objects=dict(bot=bot)))['bot'] is bot
+
+    assert_raises(ValueError, codec.loads, b'\x00\x02s')
+
+
+def test_storage_update():
+    sqlite_filename = 'unittest-{}-update.db'.format(PYTHON_VERSION)
+    backends = [
+        lambda: get_backend(STORAGE_FILENAME),
+        lambda: get_backend('sqlite:///' + sqlite_filename),
+        lambda: WriteBehindBackend(get_backend(STORAGE_FILENAME), delay=0.01),
+    ]
+    threads, count = 8, 50
+
+    try:
+        for make_backend in backends:
+            storage = Storage(make_backend(), cache=StorageCache())
+            storage.clear()
+
+            # compare and set works with missing keys and deletions
+            backend = storage._backend
+            assert backend.compare_and_set('key', None, b'one')
+            assert not backend.compare_and_set('key', None, b'two')
+            assert backend.compare_and_set('key', b'one', None)
+            assert not backend.contains('key')
+
+            # value could be deleted by update
+            storage['key'] = [1]
+            eq_(None, storage.update('key', lambda value: DELETE if value else value + [1]))
+            assert 'key' not in storage
+
+            # only one of concurrent adds succeeds
+            added = []
+            adders = [
+                threading.Thread(target=lambda num=num: added.append(storage.add('once', num)))
+                for num in range(threads)
+            ]
+            for adder in adders:
+                adder.start()
+            for adder in adders:
+                adder.join()
+            eq_(1, added.count(True))
+            eq_(added.index(True), storage['once'])
+
+            def increment(value):
+                value.append(len(value))
+                return value
+
+            def work():
+                for idx in range(count):
+                    storage.update('counter', increment, default=[])
+
+            workers = [threading.Thread(target=work) for num in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            # no update is lost
+            eq_(list(range(threads * count)), storage['counter'])
+
+            storage.clear()
+            storage.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(sqlite_filename + suffix):
+                os.unlink(sqlite_filename + suffix)
+
+
+def test_storage_snapshot_is_consistent():
+    backend = get_backend(STORAGE_FILENAME)
+    for idx in range(10):
+        backend.set('key{0}'.format(idx), b'old')
+
+    class Target(object):
+        """Changes storage while snapshot is copied."""
+        def __init__(self):
+            self.items = []
+
+        def write_batch(self, items):
+            if not self.items:
+                backend.set('key5', b'new')
+                backend.delete('key7')
+                backend.set('key99', b'new')
+            self.items.extend(items)
+
+    try:
+        target = Target()
+        eq_(10, backend._copy_snapshot(target, batch_size=3))
+        eq_([('key{0}'.format(idx), b'old') for idx in range(10)], target.items)
+        eq_(b'new', backend.get('key5'))
+    finally:
+        for key in backend.keys():
+            backend.delete(key)
+        backend.close()
+
+
+def test_storage_compaction_and_snapshot():
+    import tempfile
+    import shutil
+
+    # compaction switches dbm storage to a new generation of files,
+    # so it is done in a separate directory, to not affect other tests
+    workdir = tempfile.mkdtemp()
+    dbm_filename = os.path.join(workdir, 'thebot.storage')
+    sqlite_filename = os.path.join(workdir, 'thebot.db')
+    filenames = [dbm_filename, 'sqlite:///' + sqlite_filename]
+
+    try:
+        for filename in filenames:
+            snapshot_filename = os.path.join(workdir, 'snapshot-{0}'.format(filenames.index(filename)))
+
+            storage = Storage(filename)
+            for idx in range(100):
+                storage['key{0}'.format(idx)] = 'x' * 1000
+            for idx in range(90):
+                del storage['key{0}'.format(idx)]
+
+            result = storage.compact()
+            # file sizes depend on the dbm module, so only data is checked
+            eq_(['before', 'after'], sorted(result, reverse=True))
+            eq_(10, len(storage))
+            eq_(['key{0}'.format(idx) for idx in range(90, 100)], sorted(storage))
+            eq_('x' * 1000, storage['key90'])
+            storage['key99'] = 'new value'
+            eq_('new value', storage['key99'])
+
+            eq_(10, storage.snapshot(snapshot_filename))
+            files = storage.get_files(snapshot_filename)
+            eq_(sorted(os.path.join(workdir, name) for name in os.listdir(workdir) if name.startswith(os.path.basename(snapshot_filename))), sorted(files))
+            storage.close()
+
+            url = snapshot_filename if filename == dbm_filename else 'sqlite:///' + snapshot_filename
+            with closing(Storage(url)) as snapshot:
+                eq_(10, len(snapshot))
+                eq_('new value', snapshot['key99'])
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_dbm_compaction_switches_generations():
+    filename = 'unittest-{}-generations.storage'.format(PYTHON_VERSION)
+
+    def remove_files():
+        for path in os.listdir('.'):
+            if path.startswith(filename):
+                os.unlink(path)
+
+    try:
+        backend = get_backend(filename)
+        backend.set('key', b'value')
+        # leftovers of the interrupted compaction are ignored
+        with closing(get_backend(filename + '.gen1')) as leftover:
+            leftover.set('key', b'garbage')
+
+        backend.compact()
+        eq_(filename + '.gen1', backend.path)
+        eq_([], _get_dbm_files(filename))
+        backend.set('another', b'value')
+        backend.compact()
+        eq_([], _get_dbm_files(filename + '.gen1'))
+        backend.close()
+
+        with closing(get_backend(filename)) as backend:
+            eq_(filename + '.gen2', backend.path)
+            eq_(['another', 'key'], backend.keys())
+            eq_(b'value', backend.get('key'))
+    finally:
+        remove_files()
+
+
+def test_admin_commands():
+    import tempfile
+    import shutil
+
+    workdir = tempfile.mkdtemp()
+    argv = [
+        '--admin-users', 'test:some user, xmpp:admin@example.com',
+        '--admin-backup-dir', workdir,
+        '--storage-url', os.path.join(workdir, 'thebot.storage'),
+    ]
+    try:
+        with closing(Bot(argv, adapters=[TestAdapter], plugins=['admin'])) as bot:
+            adapter = bot.get_adapter('test')
+            bot.storage['some'] = 'data'
+
+            adapter.write('TheBot, compact storage')
+            assert adapter._lines[-1].startswith('Storage was compacted from')
+
+            adapter.write('TheBot, backup storage')
+            match = re.match(r'1 keys were saved to (.*)\.$', adapter._lines[-1])
+            assert match is not None, adapter._lines[-1]
+            files = match.group(1).split(', ')
+            eq_(sorted(os.path.join(workdir, name) for name in os.listdir(workdir) if '.backup' in name), sorted(files))
+            filename = re.match(r'.*\.backup', files[0]).group(0)
+            with closing(Storage(filename)) as backup:
+                eq_('data', backup['some'])
+
+            adapter.write('TheBot, compact storage', user='another user')
+            eq_('Sorry, only admins can do this.', adapter._lines[-1])
+
+            # the same user id of another adapter is not an admin
+            adapter.name = 'another'
+            adapter.write('TheBot, compact storage')
+            eq_('Sorry, only admins can do this.', adapter._lines[-1])
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_admin_commands_are_denied_by_default():
+    with closing(Bot(adapters=[TestAdapter], plugins=['admin'])) as bot:
+        adapter = bot.get_adapter('test')
+
+        adapter.write('TheBot, compact storage')
+        eq_('Sorry, only admins can do this.', adapter._lines[-1])
+        adapter.write('TheBot, backup storage')
+        eq_('Sorry, only admins can do this.', adapter._lines[-1])
+
+
+def test_storage_bulk_operations():
+    sqlite_filename = 'unittest-{}-bulk.db'.format(PYTHON_VERSION)
+    backends = [
+        lambda: get_backend(STORAGE_FILENAME),
+        lambda: get_backend('sqlite:///' + sqlite_filename),
+        lambda: WriteBehindBackend(get_backend(STORAGE_FILENAME), delay=60),
+    ]
+
+    try:
+        for make_backend in backends:
+            storage = Storage(make_backend(), cache=StorageCache())
+            storage.clear()
+            tasks = storage.with_prefix('tasks:')
+
+            tasks.set_many(('user{0:02d}'.format(idx), [idx]) for idx in range(25))
+            storage['tasksX'] = 'not a task'
+            eq_(25, len(tasks))
+
+            eq_(dict(user01=[1], user02=[2]), tasks.get_many(['user01', 'user02', 'unknown']))
+            # second time values are taken from the cache
+            eq_(dict(user01=[1], user02=[2]), tasks.get_many(['user01', 'user02', 'unknown']))
+
+            eq_(
+                [('user{0:02d}'.format(idx), [idx]) for idx in range(25)],
+                list(tasks.scan(batch_size=7)),
+            )
+            eq_([('user10', [10]), ('user11', [11])], list(tasks.scan('user1', batch_size=1))[:2])
+
+            storage.clear()
+            storage.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(sqlite_filename + suffix):
+                os.unlink(sqlite_filename + suffix)
+
+
+def test_storage_syncs_only_on_flush():
+    backend = get_backend(STORAGE_FILENAME)
+    buffered = WriteBehindBackend(backend, delay=60)
+
+    try:
+        with mock.patch.object(backend, '_sync') as sync:
+            Storage(backend).set_many(dict(first=1))
+            Storage(backend).set('second', 2, ttl=10)
+            eq_(0, sync.call_count)
+
+            Storage(buffered).set_many(dict(third=3))
+            buffered.flush()
+            eq_(1, sync.call_count)
+    finally:
+        for key in buffered.keys():
+            buffered.delete(key)
+        buffered.close()
+
+
+def test_storage_ttl():
+    now = [1000.0]
+    storage = Storage(STORAGE_FILENAME, cache=StorageCache())
+    storage.clock = lambda: now[0]
+    storage.clear()
+    cache = storage.with_prefix('cache:')
+
+    cache.set('short', 'value', ttl=10)
+    cache.set('long', [1, 2], ttl=100)
+    cache.set('overwritten', 'old', ttl=10)
+    cache['overwritten'] = 'new'
+    cache['forever'] = 'value'
+
+    eq_('value', cache['short'])
+    # index is not visible
+    eq_(['cache:forever', 'cache:long', 'cache:overwritten', 'cache:short'], sorted(storage))
+    eq_(4, len(storage))
+
+    now[0] += 10
+    assert 'short' not in cache
+    # expired, but not reaped keys are not visible too
+    eq_(['forever', 'long', 'overwritten'], sorted(cache))
+    eq_(3, len(cache))
+    eq_(dict(forever='value', long=[1, 2], overwritten='new'), dict(cache.items()))
+    eq_(3, len(storage))
+    assert_raises(KeyError, lambda: cache['short'])
+    eq_(dict(long=[1, 2]), cache.get_many(['short', 'long']))
+    eq_(['forever', 'long', 'overwritten'], [name for name, value in cache.scan()])
+    eq_(['x'], cache.update('short', lambda value: value + ['x'], default=[]))
+    eq_('new', cache['overwritten'])
+
+    now[0] += 90
+    eq_(1, storage.reap())
+    eq_(['cache:forever', 'cache:overwritten', 'cache:short'], sorted(storage))
+    eq_(0, storage.reap())
+
+    cache.set('added', 'old', ttl=10)
+    assert not cache.add('added', 'new')
+    now[0] += 10
+    # expired value does not prevent adding
+    assert cache.add('added', 'new')
+    eq_('new', cache['added'])
+    # stale index entry is removed, but the new value stays
+    eq_(0, storage.reap())
+    eq_('new', cache['added'])
+
+    storage.clear()
+    storage.close()
+
+
+def test_storage_stress():
+    sqlite_filename = 'unittest-{}-stress.db'.format(PYTHON_VERSION)
+    backends = [
+        lambda: get_backend(STORAGE_FILENAME),
+        lambda: get_backend('sqlite:///' + sqlite_filename),
+        lambda: WriteBehindBackend(get_backend(STORAGE_FILENAME), delay=0.01, max_pending=20),
+    ]
+    writers, readers, count = 8, 4, 50
+
+    try:
+        for make_backend in backends:
+            storage = Storage(make_backend(), cache=StorageCache(max_size=100))
+            storage.clear()
+            errors = []
+            done = threading.Event()
+
+            def write(num):
+                try:
+                    thread_storage = storage.with_prefix('thread{0}:'.format(num))
+                    for idx in range(count):
+                        thread_storage[str(idx)] = idx
+                        eq_(idx, thread_storage[str(idx)])
+                except Exception as e:
+                    errors.append(e)
+
+            def read():
+                try:
+                    while not done.is_set():
+                        for key in storage.keys():
+                            storage.get(key)
+                        len(storage)
+                except Exception as e:
+                    errors.append(e)
+
+            reader_threads = [threading.Thread(target=read) for num in range(readers)]
+            writer_threads = [threading.Thread(target=write, args=(num,)) for num in range(writers)]
+            for thread in reader_threads + writer_threads:
+                thread.start()
+            for thread in writer_threads:
+                thread.join()
+            done.set()
+            for thread in reader_threads:
+                thread.join()
+
+            eq_([], errors)
+            eq_(writers * count, len(storage))
+            for num in range(writers):
+                thread_storage = storage.with_prefix('thread{0}:'.format(num))
+                eq_(list(range(count)), sorted(thread_storage[key] for key in thread_storage))
+
+            storage.clear()
+            storage.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(sqlite_filename + suffix):
+                os.unlink(sqlite_filename + suffix)
+
+
+def test_match_cache_is_not_shared_by_routers():
+    cache = LRUCache(10)
+    first = lambda request: None
+    second = lambda request: None
+    old = Router([(CommandRe('hello'), first)], cache=cache)
+    new = Router([(CommandRe('bye'), second), (CommandRe('hello'), first)], cache=cache)
+
+    cache.clear()
+    # old router finishes it's lookup after the new one was built
+    eq_(first, old.match('hello', True)[1])
+    eq_(first, new.match('hello', True)[1])
+    eq_(first, new.match('hello', True)[1])
+
+
+def test_match_cache():
+    with closing(Bot(adapters=[TestAdapter], plugins=[TestPlugin])) as bot:
+        adapter = bot.get_adapter('test')
+
+        for idx in range(3):
+            adapter.write('TheBot, find Umputun')
+            adapter.write('TheBot, some command')
+
+        eq_(
+            ['I found Umputun', 'I don\'t know command "some command".'] * 3,
+            adapter._lines
+        )
+        stats = bot.match_cache.get_stats()
+        eq_(4, stats['hits'])
+        eq_(2, stats['misses'])
+
+        # cache is cleared when routes are changed
+        class AnotherPlugin(Plugin):
+            name = 'another'
+            @on_command('some command')
+            def some_command(self, request):
+                request.respond('ok')
+
+        bot.patterns.extend(AnotherPlugin(bot).get_callbacks())
+        adapter.write('TheBot, some command')
+        eq_('ok', adapter._lines[-1])
+
+
+def test_benchmarks_smoke():
+    from thebot import benchmarks
+    import tempfile
+    import shutil
+
+    workdir = tempfile.mkdtemp()
+    try:
+        result = benchmarks.bench_dispatch(workdir, routes=20, count=50)
+        eq_(50, result['messages'])
+        assert result['msgs_per_sec'] > 0
+
+        result = benchmarks.bench_storage_plugins(workdir, users=2, tasks_per_user=2)
+        eq_(12, result['messages'])
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_routes_are_collected_at_class_creation():
+    class BasePlugin(Plugin):
+        name = 'base'
+
+        @property
+        def broken(self):
+            raise AssertionError('Properties should not be called')
+
+        @on_command('hello')
+        def hello(self, request):
+            request.respond('hello')
+
+        @on_command('bye')
+        def bye(self, request):
+            request.respond('bye')
+
+    class ChildPlugin(BasePlugin):
+        name = 'child'
+
+        # overriden method without decorator has no routes
+        def bye(self, request):
+            pass
+
+        @on_command('ping')
+        def ping(self, request):
+            request.respond('pong')
+
+    eq_(
+        [('bye', 1), ('hello', 1)],
+        [(name, len(patterns)) for name, patterns in BasePlugin._routes]
+    )
+    eq_(
+        ['hello', 'ping'],
+        [name for name, patterns in ChildPlugin._routes]
+    )
+
+    with closing(Bot(adapters=[TestAdapter], plugins=[BasePlugin, ChildPlugin])) as bot:
+        base = bot.get_plugin('base')
+        child = bot.get_plugin('child')
+
+        callbacks = list(child.get_callbacks())
+        eq_(['hello', 'ping'], [pattern.pattern for pattern, callback in callbacks])
+        eq_(['child', 'child'], [pattern.plugin_name for pattern, callback in callbacks])
+        eq_(child.ping, callbacks[1][1])
+
+        # shared patterns are not modified
+        eq_(['base'], list(set(pattern.plugin_name for pattern, callback in base.get_callbacks())))
+        assert not hasattr(BasePlugin.hello._patterns[0], 'plugin_name')
+
+
+def test_startup_profile_and_config_file():
+    config_filename = 'unittest-{}.conf'.format(PYTHON_VERSION)
+    with open(config_filename, 'w') as f:
+        f.write('dispatch_queue_size: 10\nmatch_cache_size: 20\n')
+
+    try:
+        bot = thebot.Bot(
+            command_line_args=['--match-cache-size', '30'],
+            adapters=[TestAdapter],
+            plugins=['settings'],
+            config_dict=dict(
+                unittest=True,
+                log_filename='unittest.log',
+                storage_filename=STORAGE_FILENAME,
+            ),
+            config_filename=config_filename,
+        )
+    finally:
+        os.unlink(config_filename)
+
+    with closing(bot):
+        # command line overrides config file
+        eq_(10, bot.config.dispatch_queue_size)
+        eq_(30, bot.config.match_cache_size)
+
+        steps = [name for name, elapsed in bot.startup_profile.steps]
+        eq_('config', steps[0])
+        assert 'import plugin settings' in steps
+        assert 'init plugin settings' in steps
+        assert 'Startup profile:' in bot.startup_profile.report()
+
+    eq_(thebot.get_version(), thebot.__version__)
@@ -0,0 +1,78 @@
+# coding: utf-8
+"""Tests for the asyncio mode. They require Python 3.5 or later."""
+
+from __future__ import absolute_import, unicode_literals
+
+import sys
+
+from nose.plugins.skip import SkipTest
+
+if sys.version_info < (3, 5):
+    raise SkipTest('Asyncio mode requires Python 3.5 or later.')
+
+import io
+import mock
+import os
+import threading
+import time
+
+from thebot import Request, User
+from thebot.aio_fixtures import AsyncPlugin, AsyncTestAdapter
+from thebot.tests import Bot, TestAdapter, TestPlugin
+from nose.tools import eq_
+from contextlib import closing
+
+
+def test_async_callbacks_and_adapters():
+    with closing(Bot(['--asyncio'], adapters=[AsyncTestAdapter], plugins=[AsyncPlugin, TestPlugin])) as bot:
+        adapter = bot.get_adapter('async-test')
+
+        adapter.write('sleep and respond', count=2)
+        eq_(['first', 'second'], adapter.lines)
+
+        # sync callbacks are working as well
+        adapter.write('find Umputun')
+        eq_('I found Umputun', adapter.lines[-1])
+
+
+def test_sync_adapters_in_asyncio_mode():
+    with closing(Bot(['--asyncio'], adapters=[TestAdapter], plugins=[AsyncPlugin])) as bot:
+        adapter = bot.get_adapter('test')
+
+        future = bot.on_request(Request(adapter, 'sleep and respond', user=User('user')))
+        future.result(timeout=5)
+        eq_(['first', 'second'], adapter._lines)
+
+
+def test_sync_adapters_send_outside_of_the_loop():
+    class ThreadAdapter(TestAdapter):
+        def send(self, message, user=None, room=None, refer_by_name=None):
+            self.threads.append(threading.current_thread())
+            super(ThreadAdapter, self).send(message, user=user, room=room, refer_by_name=refer_by_name)
+
+    with closing(Bot(['--asyncio'], adapters=[ThreadAdapter], plugins=[AsyncPlugin])) as bot:
+        adapter = bot.get_adapter('test')
+        adapter.threads = []
+
+        bot.on_request(Request(adapter, 'sleep and respond', user=User('user'))).result(timeout=5)
+        bot.on_request(Request(adapter, 'unknown command', user=User('user'))).result(timeout=5)
+        eq_(['first', 'second', 'I don\'t know command "unknown command".'], adapter._lines)
+        assert bot.event_loop._thread not in adapter.threads
+
+
+def test_async_console_adapter():
+    read_fd, write_fd = os.pipe()
+    output = io.StringIO()
+
+    with mock.patch('sys.stdin', os.fdopen(read_fd)), mock.patch('sys.stdout', output):
+        with closing(Bot(['--asyncio'], adapters=['async_console'], plugins=[TestPlugin])) as bot:
+            os.write(write_fd, b'find Umputun\n')
+            os.close(write_fd)
+
+            started_at = time.time()
+            while not (bot.exiting and 'Umputun' in output.getvalue()) and time.time() - started_at < 5:
+                time.sleep(0.01)
+
+    assert bot.exiting
+    # prompt could be written before or after the response
+    eq_('> > I found Umputun\n', ''.join(sorted(output.getvalue().splitlines(True))))
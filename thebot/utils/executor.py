@@ -0,0 +1,166 @@
+from __future__ import absolute_import, unicode_literals
+
+import collections
+import logging
+import threading
+import time
+
+from six.moves import queue
+
+_SHUTDOWN = object()
+
+
+class Task(object):
+    """A handle for a submitted job, which allows to wait for it's completion."""
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted_at = time.time()
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.func(*self.args, **self.kwargs)
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Returns True if task was finished."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+
+class KeyedExecutor(object):
+    """A pool of threads, which runs tasks with the same key one after another.
+
+    Tasks with different keys are executed in parallel. Bot uses
+    (adapter, user, room) as a key, that way messages from one
+    conversation are processed in order, but a slow plugin
+    does not block other conversations.
+
+    Queue is bounded: `submit` blocks when there are `queue_size`
+    tasks waiting for execution.
+    """
+    def __init__(self, threads=4, queue_size=1000, name='thebot.executor'):
+        self.queue_size = queue_size
+        self.logger = logging.getLogger(name)
+
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        # a map key -> deque of tasks, waiting for execution
+        self._pending = {}
+        # keys which have tasks and are not being processed right now
+        self._ready = queue.Queue()
+        self._local = threading.local()
+        self._size = 0
+
+        # counters
+        self.submitted = 0
+        self.completed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self._threads = []
+        for idx in range(threads):
+            thread = threading.Thread(
+                target=self._worker,
+                name='{0}-{1}'.format(name, idx),
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args, **kwargs):
+        """Schedules func(*args, **kwargs) and returns a Task."""
+        task = Task(func, args, kwargs)
+
+        with self._lock:
+            # a task, submitted from the worker, is never blocked,
+            # otherwise all workers could wait for each other
+            if not getattr(self._local, 'is_worker', False):
+                while self._size >= self.queue_size:
+                    self._not_full.wait()
+
+            self._size += 1
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self._size)
+
+            tasks = self._pending.get(key)
+            if tasks is None:
+                self._pending[key] = collections.deque([task])
+                self._ready.put(key)
+            else:
+                # this key is already in the ready queue or it is processed
+                # by some worker, so we just add one more task for it
+                tasks.append(task)
+
+        return task
+
+    def _worker(self):
+        self._local.is_worker = True
+
+        while True:
+            key = self._ready.get()
+            if key is _SHUTDOWN:
+                return
+
+            with self._lock:
+                task = self._pending[key].popleft()
+
+            wait = time.time() - task.submitted_at
+            try:
+                task.run()
+            except Exception:
+                self.logger.exception('Error during the task execution')
+
+            with self._lock:
+                self._size -= 1
+                self.completed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self._not_full.notify()
+                if self._size == 0:
+                    self._idle.notify_all()
+
+                if self._pending[key]:
+                    # let other conversations go first
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+
+    def get_stats(self):
+        """Returns a dict with queue depth and wait time counters."""
+        with self._lock:
+            return dict(
+                threads=len(self._threads),
+                queue_size=self.queue_size,
+                depth=self._size,
+                max_depth=self.max_depth,
+                conversations=len(self._pending),
+                submitted=self.submitted,
+                completed=self.completed,
+                avg_wait=self.total_wait / self.completed if self.completed else 0.0,
+                max_wait=self.max_wait,
+            )
+
+    def shutdown(self, wait=True):
+        """Stops workers after all submitted tasks will be finished."""
+        if wait:
+            with self._lock:
+                while self._size > 0 and not getattr(self._local, 'is_worker', False):
+                    self._idle.wait()
+
+        for thread in self._threads:
+            self._ready.put(_SHUTDOWN)
+
+        if wait:
+            for thread in self._threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
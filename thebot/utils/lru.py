@@ -0,0 +1,89 @@
+from __future__ import absolute_import, unicode_literals
+
+import collections
+import threading
+
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """A thread-safe mapping, which keeps only `max_size` recently used items.
+
+    If `max_weight` is given, then total weight of items is limited too.
+    For example, weight could be an item's size in bytes.
+
+    Also it counts hits and misses, to see if cache pays off.
+    """
+    def __init__(self, max_size=1024, max_weight=None):
+        self.max_size = max_size
+        self.max_weight = max_weight
+        self.weight = 0
+        self._data = collections.OrderedDict()
+        self._weights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+
+            # moving item to the end
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value, weight=1):
+        with self._lock:
+            self._remove(key)
+            if self.max_weight is not None and weight > self.max_weight:
+                # item will not fit anyway
+                return
+
+            self._data[key] = value
+            self._weights[key] = weight
+            self.weight += weight
+
+            while len(self._data) > self.max_size or (
+                    self.max_weight is not None and self.weight > self.max_weight):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+
+    def _remove(self, key, default=None):
+        value = self._data.pop(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.weight -= self._weights.pop(key)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self.weight = 0
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return dict(
+            size=len(self._data),
+            max_size=self.max_size,
+            weight=self.weight,
+            max_weight=self.max_weight,
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=float(self.hits) / total if total else 0.0,
+        )
@@ -0,0 +1,85 @@
+from __future__ import absolute_import, unicode_literals
+
+import collections
+import threading
+import time
+
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'updated_at', 'allowed', 'rejected', 'warned_at')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+        self.allowed = 0
+        self.rejected = 0
+        self.warned_at = None
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter with a separate bucket for each key.
+
+    Each bucket holds up to `burst` tokens and gets `rate` new tokens
+    per second. Every admitted request takes one token.
+
+    No more than `max_keys` buckets are kept, the least recently
+    used one is removed, when a new key comes.
+
+    When a request is rejected, `admit` tells if the sender should be warned.
+    This happens at most once per `window` seconds for each key, and only
+    for requests which could be answered with a warning.
+    """
+    def __init__(self, burst, rate, window=60, max_keys=10000, clock=time.time):
+        self.burst = burst
+        self.rate = rate
+        self.window = window
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _refill(self, bucket, now):
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+        bucket.updated_at = now
+
+    def admit(self, key, can_warn=True):
+        """Returns a tuple (admitted, warn).
+
+        If `can_warn` is False, the warning is not sent and is not recorded,
+        so the next rejected request which could be answered will get it.
+        """
+        now = self.clock()
+
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+                bucket = TokenBucket(self.burst, now)
+            else:
+                self._refill(bucket, now)
+            # moving bucket to the end
+            self._buckets[key] = bucket
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                bucket.allowed += 1
+                return True, False
+
+            bucket.rejected += 1
+            if can_warn and (bucket.warned_at is None or now - bucket.warned_at >= self.window):
+                bucket.warned_at = now
+                return False, True
+            return False, False
+
+    def get_stats(self):
+        """Returns a map key -> dict with counters."""
+        with self._lock:
+            return dict(
+                (key, dict(
+                    allowed=bucket.allowed,
+                    rejected=bucket.rejected,
+                    tokens=bucket.tokens,
+                ))
+                for key, bucket in self._buckets.items()
+            )
@@ -0,0 +1,309 @@
+from __future__ import absolute_import, unicode_literals
+
+import calendar
+import datetime
+import heapq
+import itertools
+import logging
+import numbers
+import random
+import threading
+import time
+
+from .executor import KeyedExecutor
+
+# what to do with runs, which were missed because the bot was
+# busy or sleeping, or because previous run is not finished yet:
+# run once instead of all missed runs
+COALESCE = 'coalesce'
+# don't run until the next planned time
+SKIP = 'skip'
+
+
+class Interval(object):
+    """Runs a job every `seconds`.
+
+    Time is counted from the previous planned run,
+    so job's own running time does not shift the schedule.
+    """
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError('Interval should be positive.')
+        self.seconds = seconds
+
+    def next(self, after):
+        return after + self.seconds
+
+
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(value) for value in part.split('-', 1)]
+        else:
+            start = int(part)
+            # "5/15" means "every 15, starting from 5"
+            end = high if step != 1 else start
+
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('Bad cron field "{0}".'.format(field))
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class Cron(object):
+    """A schedule in the crontab's format: "minute hour day month weekday".
+
+    Fields could be `*`, numbers, ranges `1-5`, steps `*/10`
+    and lists `1,15`. Sunday is 0 or 7. Times are in UTC.
+    """
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Cron expression "{0}" should have 5 fields.'.format(expression))
+
+        self.expression = expression
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        self.weekdays = frozenset(day % 7 for day in _parse_cron_field(fields[4], 0, 7))
+        # like in cron, if both day and weekday are given, any of them should match
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = dt.isoweekday() % 7 in self.weekdays
+        if self._any_day:
+            return weekday
+        if self._any_weekday:
+            return day
+        return day or weekday
+
+    def next(self, after):
+        dt = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=int(after) // 60 * 60 + 60)
+        limit = dt + datetime.timedelta(days=366 * 5)
+
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return calendar.timegm(dt.timetuple())
+
+        raise ValueError('Cron expression "{0}" never matches.'.format(self.expression))
+
+
+class Job(object):
+    """A handle for a scheduled function."""
+    def __init__(self, scheduler, func, schedule, name, jitter, misfire, misfire_grace):
+        self.scheduler = scheduler
+        self.func = func
+        self.schedule = schedule
+        self.name = name
+        self.jitter = jitter
+        self.misfire = misfire
+        self.misfire_grace = misfire_grace
+
+        # time from the schedule and real time of the next run, with jitter
+        self.planned_at = None
+        self.next_run_at = None
+        # number of the job's actual entry in the scheduler's heap
+        self.number = None
+        self.running = False
+        # a coalesced run, which should start after the current one
+        self.pending = False
+        self.cancelled = False
+
+        self.runs = 0
+        self.misfires = 0
+
+    def run_at(self, timestamp):
+        """Makes the next run not later than given timestamp."""
+        self.scheduler.run_at(self, timestamp)
+
+    def cancel(self, wait=True):
+        """Removes job from the schedule and waits until it's current run will finish."""
+        self.scheduler.cancel(self, wait=wait)
+
+
+class Scheduler(object):
+    """Runs jobs by their schedules in a pool of `threads` threads.
+
+    One thread sleeps until the nearest job's time, which is taken from
+    a heap, so there are no periodic wakeups. A job never runs in parallel
+    with itself, and no more than `threads` jobs run at once.
+    """
+    def __init__(self, threads=4, name='thebot.scheduler'):
+        self.logger = logging.getLogger(name)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        # a heap of (next_run_at, number, job)
+        self._heap = []
+        self._counter = itertools.count()
+        self._jobs = set()
+        self._local = threading.local()
+        self._closed = False
+
+        # there is at most one queued or running task for each job
+        self._executor = KeyedExecutor(threads=threads, queue_size=2 ** 31, name=name + '.worker')
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, func, schedule, name=None, jitter=0, misfire=COALESCE, misfire_grace=1.0, start_at=None):
+        """Schedules `func()` and returns a `Job`.
+
+        Schedule is a number of seconds between runs or an object
+        with method `next(timestamp)`, like `Cron`. First run is at
+        `start_at` timestamp or at the first time from the schedule.
+
+        Each run is delayed by a random number of seconds up to `jitter`,
+        to spread the load. Runs which are late more than `misfire_grace`
+        seconds are handled according to `misfire` policy.
+        """
+        if misfire not in (COALESCE, SKIP):
+            raise ValueError('Unknown misfire policy "{0}".'.format(misfire))
+        if isinstance(schedule, numbers.Number):
+            schedule = Interval(schedule)
+
+        job = Job(self, func, schedule, name or getattr(func, '__name__', 'job'), jitter, misfire, misfire_grace)
+        if start_at is None:
+            start_at = schedule.next(time.time())
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Scheduler is closed.')
+            self._jobs.add(job)
+            self._push(job, start_at)
+        return job
+
+    def _push(self, job, planned_at):
+        job.planned_at = planned_at
+        job.next_run_at = planned_at
+        if job.jitter:
+            job.next_run_at += random.uniform(0, job.jitter)
+        job.number = next(self._counter)
+        heapq.heappush(self._heap, (job.next_run_at, job.number, job))
+        self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._closed:
+                        return
+                    # skipping cancelled jobs and entries, replaced by `run_at`
+                    while self._heap:
+                        run_at, number, job = self._heap[0]
+                        if not job.cancelled and number == job.number:
+                            break
+                        heapq.heappop(self._heap)
+
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._wakeup.wait(self._heap[0][0] - now if self._heap else None)
+
+                job = heapq.heappop(self._heap)[2]
+                should_run = self._reschedule(job, now)
+
+            if should_run:
+                self._executor.submit(job, self._execute, job)
+
+    def _reschedule(self, job, now):
+        """Plans the next run of a due job and returns True if it should run now."""
+        late = now - job.next_run_at
+        next_planned_at = job.schedule.next(job.planned_at)
+        # some runs were missed, only one of them will be done
+        missed = next_planned_at <= now
+        if missed:
+            next_planned_at = job.schedule.next(now)
+        self._push(job, next_planned_at)
+
+        should_run = True
+        if job.running:
+            # previous run is not finished yet
+            missed = True
+            should_run = False
+            if job.misfire == COALESCE:
+                job.pending = True
+        elif job.misfire == SKIP and late > job.misfire_grace:
+            missed = True
+            should_run = False
+
+        if missed:
+            job.misfires += 1
+        if should_run:
+            job.running = True
+        return should_run
+
+    def _execute(self, job):
+        self._local.job = job
+        try:
+            while True:
+                try:
+                    job.func()
+                except Exception:
+                    self.logger.exception('Error during the job "{0}" execution'.format(job.name))
+
+                with self._lock:
+                    job.runs += 1
+                    if job.pending and not job.cancelled and not self._closed:
+                        job.pending = False
+                        continue
+
+                    job.running = False
+                    self._idle.notify_all()
+                    return
+        finally:
+            self._local.job = None
+
+    def run_at(self, job, timestamp):
+        with self._lock:
+            if not job.cancelled and timestamp < job.next_run_at:
+                self._push(job, timestamp)
+
+    def cancel(self, job, wait=True):
+        with self._lock:
+            job.cancelled = True
+            job.pending = False
+            self._jobs.discard(job)
+            self._wakeup.notify()
+
+            if wait and getattr(self._local, 'job', None) is not job:
+                while job.running:
+                    self._idle.wait()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                jobs=len(self._jobs),
+                running=sum(1 for job in self._jobs if job.running),
+                runs=sum(job.runs for job in self._jobs),
+                misfires=sum(job.misfires for job in self._jobs),
+            )
+
+    def close(self):
+        """Stops the scheduler and waits for running jobs."""
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,124 @@
+from __future__ import absolute_import, unicode_literals
+
+import bisect
+import threading
+import time
+
+
+def _make_bounds(lowest=1e-6, highest=100.0, steps_per_octave=4):
+    """Returns exponentially growing upper bounds for histogram's buckets."""
+    bounds = []
+    value = lowest
+    factor = 2 ** (1.0 / steps_per_octave)
+    while value < highest:
+        bounds.append(value)
+        value *= factor
+    bounds.append(value)
+    return bounds
+
+
+class Histogram(object):
+    """A histogram of durations, in seconds, with logarithmic buckets.
+
+    Percentiles are estimated with relative error about 20%, which is
+    enough to find a slow plugin, but recording costs only a bisect.
+    """
+    BOUNDS = _make_bounds()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        idx = bisect.bisect_left(self.BOUNDS, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, percent):
+        """Returns an upper bound of the bucket, containing given percentile."""
+        if self.count == 0:
+            return None
+
+        rank = self.count * percent / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if idx == len(self.BOUNDS):
+                    return self.max
+                return min(self.BOUNDS[idx], self.max)
+        return self.max
+
+    def dump(self):
+        with self._lock:
+            return dict(
+                count=self.count,
+                total=self.total,
+                min=self.min,
+                max=self.max,
+                mean=self.total / self.count if self.count else None,
+                p50=self.percentile(50),
+                p90=self.percentile(90),
+                p99=self.percentile(99),
+            )
+
+
+class Stats(object):
+    """A registry of named histograms."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def get(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def record(self, name, value):
+        self.get(name).record(value)
+
+    def names(self):
+        return sorted(self._histograms)
+
+    def dump(self):
+        """Returns a dict name -> histogram's summary, which can be serialized to JSON."""
+        return dict(
+            (name, self._histograms[name].dump())
+            for name in self.names()
+        )
+
+
+class StartupProfile(object):
+    """Measures how long each step of the bot's startup takes."""
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started_at = self._last = clock()
+        self.steps = []
+
+    def step(self, name):
+        """Records time, passed since previous step."""
+        now = self.clock()
+        self.steps.append((name, now - self._last))
+        self._last = now
+
+    def total(self):
+        return self._last - self.started_at
+
+    def report(self):
+        lines = ['Startup profile:']
+        for name, elapsed in self.steps:
+            lines.append('  {0:>8.1f} ms  {1}'.format(elapsed * 1000, name))
+        lines.append('  {0:>8.1f} ms  total'.format(self.total() * 1000))
+        return '\n'.join(lines) + '\n'
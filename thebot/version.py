@@ -0,0 +1,2 @@
+# Version is kept here, because setup.py reads it without importing the package.
+__version__ = '0.4.1'